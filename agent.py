@@ -1,5 +1,6 @@
 import logging
 import json
+import time
 
 import tornado.httpclient
 import tornado.ioloop
@@ -7,40 +8,300 @@ import tornado.httpserver
 import tornado.options
 import tornado.web
 import tornado.gen
+import tornado.iostream
 from tornado.options import define, options
 
-from paxos.acceptor import PrepareAcceptor, ProposeAcceptor
-from paxos.proposer import Proposer
-from paxos.learner import Learner
-from paxos.models import Promises
+from paxos.acceptor import MultiPrepareAcceptor, PrepareAcceptor, ProposeAcceptor, RecoverAcceptor
+from paxos.proposer import pipeline, propose, Proposer, read_lease
+from paxos.learner import AcceptedLearner, Learner, SkipLearner
+from paxos.membership import Membership, RECONFIGURE
+from paxos.models import (
+    Agent, agents, default_transport, Learn, MultiPrepare, MultiPromise, MultiPromises, Prepare, Promise, Promises,
+    Slots, Success
+)
+from paxos import codec, quorums, snapshot as snapshots, wal
+from paxos.catchup import catchup
+from paxos.contention import contention, node_id
+from paxos.metrics import registry
+from paxos.replica import subscriber
+from paxos.sharding import shards
+from paxos.snapshot import Snapshots
+from paxos.transport import StreamServer
 
 from paxos.api import Handler
 
-from settings import TORNADO_SETTINGS
+from settings import (
+    AGENT_URL, BALLOT_STRIDE, CATCHUP_INTERVAL, JOIN_CATCHUP_INTERVAL, MENCIUS, PIPELINE_WINDOW, READ_CHUNK_SIZE,
+    SNAPSHOT_BYTES, SNAPSHOT_ENTRIES, SNAPSHOT_PATH, STREAM_PORT_OFFSET, SUBSCRIBE_BATCH, SUBSCRIBE_TIMEOUT,
+    TORNADO_SETTINGS, TRANSPORT, WAL_PATH
+)
 
 define("port", default=8888, help="run on the given port", type=int)
+define("wal", default=WAL_PATH, help="write-ahead log file; state is only kept in memory if unset", type=str)
+define("join", default=None, help="port of a member to copy the membership from when starting outside SHARDS",
+       type=int)
+define("learner", default=None, help="run as a learner-only replica of the agent on this port's group", type=int)
+define("snapshot", default=SNAPSHOT_PATH, help="learner snapshot file; the log is never compacted if unset", type=str)
 
 logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
 logger = logging.getLogger('agent')
 
 
+def check_linearizable(handler):
+    if handler.settings.get('replica'):
+        raise tornado.web.HTTPError(status_code=400, log_message="Learner-only replicas can't serve linearizable reads")
+
+
 class Reader(Handler):
 
+    @tornado.gen.coroutine
     def get(self):
-        for promise in Learner.ordered_rounds:
-            self.write(json.dumps(promise.to_json()) + "\n")
+        """
+        Streams learned values as JSON lines, oldest first.
+
+        Optional arguments: `key` for one key's history, `offset` (a log
+        offset) or `since` (a slot) to start from, and `limit`. The
+        `X-Next-Offset` header is the offset to continue from.
+
+        With `linearizable=1` and a `key`, this agent first makes sure it
+        holds the key's lease (see LEASE_DURATION), so the read reflects
+        every write that completed before it. Answers 503 if it can't.
+        """
+        key = self.get_argument('key', None)
+        if self.get_argument('linearizable', None) not in (None, '', '0'):
+            if key is None:
+                raise tornado.web.HTTPError(status_code=400, log_message='linearizable reads need a key')
+            check_linearizable(self)
+            held = yield read_lease(key)
+            if held is None:
+                raise tornado.web.HTTPError(status_code=503, log_message='Could not get the lease on the key')
+        offsets, next_offset = Learner.offsets(key=key,
+                                               offset=self.get_int_argument('offset'),
+                                               since_slot=self.get_int_argument('since'),
+                                               limit=self.get_int_argument('limit'))
         self.set_status(200)
         self.set_header('Content-Type', 'application/json')
+        self.set_header('X-Next-Offset', str(next_offset))
+        self.set_header('X-Next-Slot', str(Learner.next_slot))
+        for i, (_, learn) in enumerate(Learner.entries_at(offsets), 1):
+            self.write(json.dumps(learn.to_json()) + "\n")
+            if i % READ_CHUNK_SIZE == 0:
+                yield self.flush()
         self.finish()
 
+    def get_int_argument(self, name):
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise tornado.web.HTTPError(status_code=400, log_message='{} must be an integer'.format(name))
+
+
+class Subscribe(Reader):
+    closed = False
+
+    def on_connection_close(self):
+        self.closed = True
+
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Streams learned values as JSON lines from log `offset` on, like
+        /read, then keeps the response open and sends the values learned
+        since, up to SUBSCRIBE_BATCH per write. Finishes after
+        SUBSCRIBE_TIMEOUT seconds; resubscribe from the next offset.
+
+        Answers 410 if `offset` is already in the snapshot.
+        """
+        offset = self.get_int_argument('offset') or 0
+        if offset < Learner.base:
+            raise tornado.web.HTTPError(status_code=410, log_message='Offset {} was compacted'.format(offset))
+        self.set_header('Content-Type', 'application/json')
+        deadline = tornado.ioloop.IOLoop.current().time() + SUBSCRIBE_TIMEOUT
+        while not self.closed and tornado.ioloop.IOLoop.current().time() < deadline and offset >= Learner.base:
+            entries = list(Learner.entries(offset=offset, limit=SUBSCRIBE_BATCH))
+            if not entries:
+                yield Learner.appended.wait(timeout=deadline)
+                continue
+            self.write(''.join(json.dumps(learn.to_json()) + "\n" for _, learn in entries))
+            offset = entries[-1][0] + 1
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                return
+        if not self.closed:
+            self.finish()
+
+
+class Getter(Handler):
+
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        A key's current value and version, as JSON. The version is 0 for a
+        key that was never written. `linearizable=1` works as for /read.
+        """
+        key = self.get_argument('key', None)
+        if key is None:
+            raise tornado.web.HTTPError(status_code=400, log_message='/get needs a key')
+        if self.get_argument('linearizable', None) not in (None, '', '0'):
+            check_linearizable(self)
+            held = yield read_lease(key)
+            if held is None:
+                raise tornado.web.HTTPError(status_code=503, log_message='Could not get the lease on the key')
+        value, version = Learner.state.get(key)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'key': key, 'value': value, 'version': version}))
+
+
+class Snapshot(Handler):
+
+    def get(self):
+        """
+        Everything this learner has learned, in the snapshot format, for a
+        peer that is too far behind to catch up from the log.
+        """
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(snapshots.to_json(Learner.capture())))
+
+
+class Reconfigure(Handler):
+
+    @tornado.gen.coroutine
+    def post(self):
+        """
+        Commits a new configuration; see `Membership` for the format. It
+        takes effect on each agent once that agent has learned the log up
+        to the configuration's slot.
+        """
+        config = codec.decode(self.request)
+        try:
+            Membership.check(config)
+        except ValueError as e:
+            raise tornado.web.HTTPError(status_code=400, log_message=str(e))
+        prepare = yield propose(Prepare(key=RECONFIGURE, predicate=RECONFIGURE, argument=config))
+        self.respond(Success(prepare))
+
+
+class Members(Handler):
 
-def get_app():
-    return tornado.web.Application([
+    def get(self):
+        """
+        The members and quorum settings this agent is using, any
+        configuration still waiting for its slot, and whether we vote.
+        """
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(Membership.to_json()))
+
+
+class Contention(Handler):
+
+    def get(self):
+        """
+        How contended each key has been, as JSON. Narrow it down with `key`.
+        """
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(contention.to_json(key=self.get_argument('key', None))))
+
+
+class Metrics(Handler):
+
+    def get(self):
+        """
+        Every metric, in the Prometheus text format.
+        """
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(registry.render())
+
+
+def recover(log, snapshot=None):
+    """
+    Rebuilds the acceptor and learner state from the write-ahead log, and
+    moves the proposal id counter past every id we have seen.
+
+    With a `snapshot`, the learner starts from it. The learns it already
+    covers are skipped by `Learner.learn`: slotted ones by slot, the rest as
+    ballots already learned.
+    """
+    highest, count = -1, 0
+    if snapshot is not None:
+        Learner.restore(snapshot)
+        highest = max([p['id'] for p in snapshot['latest']] or [-1])
+    for record in log.records():
+        count += 1
+        kind = record['type']
+        if kind == wal.PREEMPT:
+            leader = MultiPromises.granted.get(record['key'])
+            if leader:
+                leader.preempt(record['id'])
+            continue
+        if kind == wal.MULTI_PROMISE:
+            multi_prepare = MultiPrepare.from_json(record['prepare'])
+            # We don't know how long ago we granted it, so the lease starts over.
+            expires = time.monotonic() + multi_prepare.lease if multi_prepare.lease else None
+            MultiPromises.granted.add(MultiPromise(multi_prepare, expires=expires))
+            continue
+        prepare = Prepare(**record['prepare'])
+        highest = max(highest, prepare.id)
+        if kind == wal.PROMISE:
+            Promises.current.add(Promise(prepare=prepare))
+            Slots.current.promise(prepare)
+        elif kind == wal.SLOT_PROMISE:
+            Slots.current.promise(prepare)
+            Promises.current.forget_slot(prepare)
+        elif kind == wal.ACCEPT:
+            if Promise(prepare=prepare) in Promises.current:
+                Promises.current.remove(prepare)
+            Slots.current.accept(prepare)
+        elif kind == wal.LEARN:
+            Learner.learn(Learn(prepare=prepare))
+    Prepare.observe(highest)
+    logger.info("Replayed %s records from %s", count, log.path)
+
+
+def join(port):
+    """
+    Starts us off with the membership of the agent on `port`. We don't vote
+    until a reconfiguration adding us has been committed and we have
+    caught up to it, or ever as a learner-only replica.
+    """
+    resp = tornado.httpclient.HTTPClient().fetch(AGENT_URL + ':' + str(port) + '/membership')
+    membership = json.loads(resp.body)
+    agents.update([Agent(AGENT_URL, member, transport=default_transport) for member in membership['members']])
+    if membership['config'] is not None:
+        Membership.apply(membership['config'])
+    Membership.voting = options.port in membership['members']
+    logger.info("Joining %s; voting: %s", membership['members'], Membership.voting)
+
+
+def get_app(replica=False):
+    """
+    A learner-only replica only serves reads; it has no proposer, acceptor
+    or learner endpoints of its own.
+    """
+    reads = [
         (r"/read", Reader),
+        (r"/get", Getter),
+        (r"/subscribe", Subscribe),
+        (r"/snapshot", Snapshot),
+        (r"/membership", Members),
+        (r"/contention", Contention),
+        (r"/metrics", Metrics),
+    ]
+    if replica:
+        return tornado.web.Application(reads, replica=True, **TORNADO_SETTINGS)
+    return tornado.web.Application(reads + [
+        (r"/reconfigure", Reconfigure),
         (r"/write", Proposer),
         (r"/prepare", PrepareAcceptor),
+        (r"/multiprepare", MultiPrepareAcceptor),
         (r"/propose", ProposeAcceptor),
-        (r"/learn", Learner)
+        (r"/recover", RecoverAcceptor),
+        (r"/learn", Learner),
+        (r"/accepted", AcceptedLearner),
+        (r"/skip", SkipLearner)
     ], **TORNADO_SETTINGS)
 
 
@@ -48,16 +309,58 @@ def main():
     """
     This guy has to run synchronously in order to prevent proposal ids from conflicting.
 
-    We're using only a single proposer to avoid the dueling proposers issue.
+    We're using only a single proposer to avoid the dueling proposers issue,
+    unless MENCIUS is on, in which case every agent in the group leads
+    writes in its own share of the log slots.
 
     :return:
     """
     Promises.initialize()
+    MultiPromises.initialize()
+    Slots.initialize()
     tornado.options.parse_command_line()
-    application = get_app()
+    group = shards.group_of(options.port)
+    if group is not None:
+        agents.update([Agent(AGENT_URL, port, transport=default_transport) for port in group])
+    if options.join or options.learner:
+        join(options.join or options.learner)
+    if MENCIUS and not options.learner:
+        if not PIPELINE_WINDOW or group is None:
+            raise ValueError("MENCIUS needs PIPELINE_WINDOW > 0 and this agent's port in SHARDS")
+        pipeline.rotate(group.index(options.port), len(group))
+    quorums.system.check(agents.all(), proposer=None if options.learner else options.port)
+    Prepare.number(node_id(options.port), BALLOT_STRIDE)
+    Snapshots.initialize(options.snapshot, max_entries=SNAPSHOT_ENTRIES, max_bytes=SNAPSHOT_BYTES)
+    snapshot = Snapshots.current.load() if Snapshots.current else None
+    if options.wal:
+        wal.WriteAheadLog.initialize(options.wal)
+        recover(wal.WriteAheadLog.current, snapshot=snapshot)
+    elif snapshot is not None:
+        Learner.restore(snapshot)
+    application = get_app(replica=bool(options.learner))
     http_server = tornado.httpserver.HTTPServer(application)
     http_server.listen(options.port)
+    if options.learner:
+        logger.info("Learner-only replica listening on port %s", options.port)
+        tornado.ioloop.IOLoop.current().add_callback(subscriber.run)
+        tornado.ioloop.IOLoop.current().start()
+        return
     logger.info("Proposer listening on port %s", options.port)
+    if TRANSPORT == 'stream':
+        StreamServer(application).listen(options.port + STREAM_PORT_OFFSET)
+        logger.info("Accepting agent streams on port %s", options.port + STREAM_PORT_OFFSET)
+
+    def catch_up():
+        return catchup.run(agents.peers(excluding=options.port))
+    if CATCHUP_INTERVAL or options.join:
+        tornado.ioloop.IOLoop.current().add_callback(catch_up)
+    if CATCHUP_INTERVAL:
+        tornado.ioloop.PeriodicCallback(catch_up, CATCHUP_INTERVAL * 1000).start()
+    if options.join:
+        def until_voting():
+            if not Membership.voting:
+                return catch_up()
+        tornado.ioloop.PeriodicCallback(until_voting, JOIN_CATCHUP_INTERVAL * 1000).start()
     tornado.ioloop.IOLoop.current().start()
 
 
@@ -0,0 +1,239 @@
+"""
+Drives a workload against a cluster and prints the results as one JSON
+object, so runs can be saved and compared.
+
+    python benchmark.py --keys=1000 --skew=0.99 --payload=100 --concurrency=32 --reads=0.95 --duration=10
+
+By default it starts an agent for every port in SHARDS as a subprocess and
+stops them afterwards. Agents keep their state at class level, so they
+can't share a process. Pass --spawn=false to benchmark a cluster that is
+already running, e.g. one started with bootstrap.sh.
+"""
+import bisect
+import collections
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.options
+from tornado.options import define, options
+
+from paxos import metrics
+from paxos.sharding import shards
+from settings import AGENT_URL, MENCIUS, SHARDS
+
+define("spawn", default=True, help="start the agents in SHARDS as subprocesses", type=bool)
+define("router", default=None, help="send every request through this router URL instead of to the leaders", type=str)
+define("keys", default=1000, help="number of distinct keys", type=int)
+define("skew", default=0.0, help="Zipf exponent for picking keys; 0 is uniform", type=float)
+define("payload", default=100, help="bytes per written value", type=int)
+define("concurrency", default=16, help="requests in flight at once", type=int)
+define("reads", default=0.0, help="fraction of requests that are reads", type=float)
+define("linearizable", default=False, help="ask for linearizable reads", type=bool)
+define("duration", default=10.0, help="seconds to run for", type=float)
+define("seed", default=0, help="random seed for the workload", type=int)
+
+PERCENTILES = [50, 95, 99]
+PHASE_BUCKET = re.compile(r'^paxos_phase_seconds_bucket\{phase="(\w+)",le="([^"]+)"\} (\d+)$', re.M)
+
+
+class Workload:
+    """
+    Picks the next request: a read or a write, and the key, which is drawn
+    from a Zipf distribution with exponent `skew` over `keys` keys.
+    """
+
+    def __init__(self, keys, skew=0.0, payload=100, reads=0.0, seed=0):
+        self.random = random.Random(seed)
+        self.keys = ['key-{}'.format(i) for i in range(keys)]
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, keys + 1):
+            total += 1.0 / rank ** skew
+            self.cumulative.append(total)
+        self.value = 'x' * payload
+        self.reads = reads
+
+    def key(self):
+        i = bisect.bisect_left(self.cumulative, self.random.random() * self.cumulative[-1])
+        return self.keys[min(i, len(self.keys) - 1)]
+
+    def next(self):
+        return 'read' if self.random.random() < self.reads else 'write', self.key()
+
+
+def percentiles(samples, points=PERCENTILES):
+    """
+    Nearest-rank percentiles of `samples`, in the same units.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {'p{}'.format(p): None for p in points}
+    return {'p{}'.format(p): ordered[max(0, -(-p * len(ordered) // 100) - 1)] for p in points}
+
+
+def summarize(latencies, errors, elapsed):
+    summary = {
+        'count': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'max': max(latencies) if latencies else None,
+    }
+    summary.update(percentiles(latencies))
+    return summary
+
+
+def base_url(key):
+    if options.router:
+        return options.router
+    return AGENT_URL + ':' + str(shards.proposer(key, spread=MENCIUS))
+
+
+def request_for(op, key, workload):
+    if op == 'read':
+        query = '?key={}&limit=1'.format(key) + ('&linearizable=1' if options.linearizable else '')
+        return tornado.httpclient.HTTPRequest(url=base_url(key) + '/read' + query, method='GET')
+    return tornado.httpclient.HTTPRequest(
+        url=base_url(key) + '/write',
+        method='POST',
+        headers={'Content-Type': 'application/json'},
+        body=json.dumps({'key': key, 'predicate': 'set', 'argument': workload.value}))
+
+
+@tornado.gen.coroutine
+def worker(workload, deadline, latencies, errors):
+    client = tornado.httpclient.AsyncHTTPClient()
+    while time.monotonic() < deadline:
+        op, key = workload.next()
+        started = time.monotonic()
+        try:
+            resp = yield client.fetch(request_for(op, key, workload), raise_error=False)
+        except OSError:
+            resp = None
+        if resp is not None and resp.code == 200:
+            latencies[op].append(time.monotonic() - started)
+        else:
+            errors[op] += 1
+
+
+@tornado.gen.coroutine
+def contention(ports):
+    """
+    Adds up the proposers' conflict and backoff counts from /contention.
+    """
+    totals = {'conflicts': 0, 'backoffs': 0, 'backoff_seconds': 0.0}
+    client = tornado.httpclient.AsyncHTTPClient()
+    for port in ports:
+        resp = yield client.fetch(AGENT_URL + ':{}/contention'.format(port), raise_error=False)
+        if resp.code != 200:
+            continue
+        for stats in json.loads(resp.body).values():
+            for name in totals:
+                totals[name] += stats[name]
+    raise tornado.gen.Return(totals)
+
+
+@tornado.gen.coroutine
+def phase_buckets(ports):
+    """
+    The proposers' per-phase latency histograms from /metrics, added up
+    over `ports`: {phase: {bucket bound: cumulative count}}.
+    """
+    buckets = collections.defaultdict(lambda: collections.defaultdict(int))
+    client = tornado.httpclient.AsyncHTTPClient()
+    for port in ports:
+        resp = yield client.fetch(AGENT_URL + ':{}/metrics'.format(port), raise_error=False)
+        if resp.code != 200:
+            continue
+        for phase, bound, count in PHASE_BUCKET.findall(resp.body.decode('utf-8')):
+            buckets[phase][float(bound)] += int(count)
+    raise tornado.gen.Return(buckets)
+
+
+def phase_percentiles(before, after):
+    """
+    Percentiles of what each phase's histogram recorded between the
+    `before` and `after` scrapes, as bucket bounds in seconds.
+    """
+    phases = {}
+    for phase, cumulative in after.items():
+        bounds = sorted(cumulative)
+        counts = [cumulative[b] - before.get(phase, {}).get(b, 0) for b in bounds]
+        buckets = list(zip(bounds, [c - p for c, p in zip(counts, [0] + counts[:-1])]))
+        phases[phase] = {'count': counts[-1] if counts else 0}
+        phases[phase].update({'p{}'.format(p): metrics.quantile(buckets, p / 100.0) for p in PERCENTILES})
+    return phases
+
+
+@tornado.gen.coroutine
+def wait_until_up(ports, timeout=10.0):
+    client = tornado.httpclient.AsyncHTTPClient()
+    deadline = time.monotonic() + timeout
+    for port in ports:
+        while True:
+            try:
+                resp = yield client.fetch(AGENT_URL + ':{}/read?limit=0'.format(port), raise_error=False)
+                if resp.code == 200:
+                    break
+            except OSError:  # Not listening yet.
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("Agent on port {} didn't come up".format(port))
+            yield tornado.gen.sleep(0.1)
+
+
+@tornado.gen.coroutine
+def run(ports):
+    yield wait_until_up(ports)
+    workload = Workload(options.keys, skew=options.skew, payload=options.payload,
+                        reads=options.reads, seed=options.seed)
+    latencies = {'read': [], 'write': []}
+    errors = {'read': 0, 'write': 0}
+    before = yield phase_buckets(ports)
+    started = time.monotonic()
+    yield [worker(workload, started + options.duration, latencies, errors)
+           for _ in range(options.concurrency)]
+    elapsed = time.monotonic() - started
+    retries = yield contention(ports)
+    after = yield phase_buckets(ports)
+    raise tornado.gen.Return({
+        'config': {name: options[name] for name in
+                   ['keys', 'skew', 'payload', 'concurrency', 'reads', 'linearizable', 'duration', 'seed']},
+        'elapsed': elapsed,
+        'throughput': sum(len(l) for l in latencies.values()) / elapsed,
+        'operations': {op: summarize(latencies[op], errors[op], elapsed) for op in latencies},
+        'phases': phase_percentiles(before, after),
+        'retries': retries,
+    })
+
+
+def main():
+    tornado.options.parse_command_line()
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=options.concurrency)
+    ports = sorted({port for group in SHARDS for port in group})
+    here = os.path.dirname(os.path.abspath(__file__))
+    processes = []
+    if options.spawn:
+        processes = [subprocess.Popen([sys.executable, 'agent.py', '--port={}'.format(port), '--logging=error'],
+                                      cwd=here)
+                     for port in ports]
+    try:
+        results = tornado.ioloop.IOLoop.current().run_sync(lambda: run(ports))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,13 @@
 #!/bin/bash
 
 echo "Killing existing processes...if any..."
-pgrep -f agent.py | xargs sudo kill -9 &
+pgrep -f "agent.py|router.py" | xargs sudo kill -9 &
 
 sleep 3
 
-python agent.py --port=9999 &
-python agent.py --port=9998 &
-    python3 agent.py --port=9997 &
+# One agent process per member of every shard.
+for port in $(python -c "from settings import SHARDS; print(' '.join(str(p) for g in SHARDS for p in g))"); do
+    python agent.py --port=$port &
+done
 
+python router.py --port=8888 &
@@ -1,42 +1,83 @@
-import random
-import tornado.httpclient
-import tornado.ioloop
+"""
+Generates load through the client library and prints the achieved
+throughput and latency percentiles as one JSON object.
+
+    python client.py --concurrency=64 --batch=8 --keys=1000 --reads=0.5 --duration=10
+
+It takes benchmark.py's workload flags (--keys, --skew, --payload,
+--concurrency, --reads, --linearizable, --duration, --seed), but goes
+through `paxos.client.Client`, so retries and failover are included in the
+latencies. Start the cluster first, e.g. with bootstrap.sh.
+"""
 import json
-import sys
-import collections
+import time
+
+import tornado.gen
+import tornado.ioloop
+import tornado.options
+from tornado.options import define, options
+
+from benchmark import summarize, Workload
+from paxos.client import Client, ClientError
+
+define("batch", default=1, help="operations each worker sends together", type=int)
+define("retries", default=3, help="times to retry a failed request", type=int)
+
 
-from settings import AGENT_URL, AGENT_PORTS
+@tornado.gen.coroutine
+def timed(operation, latencies, errors, op):
+    started = time.monotonic()
+    try:
+        yield operation
+    except ClientError:
+        errors[op] += 1
+        return
+    latencies[op].append(time.monotonic() - started)
 
-failures = collections.defaultdict(int)
 
-# Distinguished proposer/learner
-url = AGENT_URL + ':{}/write'.format(AGENT_PORTS[0])
+@tornado.gen.coroutine
+def worker(client, workload, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        operations = []
+        for _ in range(options.batch):
+            op, key = workload.next()
+            if op == 'read':
+                operation = client.read(key, limit=1, linearizable=options.linearizable)
+            else:
+                operation = client.write(key, 'set', workload.value)
+            operations.append(timed(operation, latencies, errors, op))
+        yield operations
 
-client = tornado.httpclient.AsyncHTTPClient()
 
+@tornado.gen.coroutine
+def run():
+    client = Client(concurrency=options.concurrency * options.batch, retries=options.retries, seed=options.seed)
+    workload = Workload(options.keys, skew=options.skew, payload=options.payload,
+                        reads=options.reads, seed=options.seed)
+    latencies = {'read': [], 'write': []}
+    errors = {'read': 0, 'write': 0}
+    started = time.monotonic()
+    try:
+        yield [worker(client, workload, started + options.duration, latencies, errors)
+               for _ in range(options.concurrency)]
+    finally:
+        client.close()
+    elapsed = time.monotonic() - started
+    raise tornado.gen.Return({
+        'config': {name: options[name] for name in
+                   ['keys', 'skew', 'payload', 'concurrency', 'batch', 'reads', 'linearizable', 'duration',
+                    'retries', 'seed']},
+        'elapsed': elapsed,
+        'throughput': sum(len(l) for l in latencies.values()) / elapsed,
+        'operations': {op: summarize(latencies[op], errors[op], elapsed) for op in latencies},
+    })
 
-def get_results(resp):
-    if 200 <= resp.code < 300:
-        sys.stdout.write(resp.body.decode('utf-8') + "\n")
-        # sys.stdout.write('.')
-    else:
-        print(resp.body)
-        sys.stdout.write('x')
-    sys.stdout.flush()
 
+def main():
+    tornado.options.parse_command_line()
+    results = tornado.ioloop.IOLoop.current().run_sync(run)
+    print(json.dumps(results, indent=2, sort_keys=True))
 
-for i in range(10):
-    print("url", url)
-    request = tornado.httpclient.HTTPRequest(
-        url=url,
-        method='POST',
-        headers={'Content-Type': 'application/json'},
-        body=json.dumps({
-            "key": "foo",
-            "predicate": "This is update #{}".format(i),
-            "argument": random.random()
-        }),
-    )
-    client.fetch(request, callback=get_results)
 
-tornado.ioloop.IOLoop.current().start()
+if __name__ == '__main__':
+    main()
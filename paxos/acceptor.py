@@ -1,28 +1,77 @@
 import logging
+import time
 
 import tornado.gen
+import tornado.web
+from tornado.options import options
 
 from paxos.api import Handler
+from paxos.metrics import registry
 from paxos.learner import Learner
+from paxos.membership import Membership
 from paxos.models import (
     Accept,
+    Accepted,
+    agents,
+    MultiPrepare,
+    MultiPromise,
+    MultiPromises,
     Prepare,
     Promise,
     Promises,
     Propose,
+    Recover,
+    Slots,
+    Success,
 )
+from paxos.proposer import skip_past
+from paxos.wal import ACCEPT, MULTI_PROMISE, PREEMPT, PROMISE, SLOT_PROMISE, log
+from settings import DIRECT_LEARN, MENCIUS
 
 logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
 logger = logging.getLogger('agent')
 
 
-class PrepareAcceptor(Handler):
+class Voter(Handler):
+    bare = True
+
+    def prepare(self):
+        """
+        Only members of the configuration we have learned take part in
+        quorums; until then we answer 503.
+        """
+        if not Membership.voting:
+            raise tornado.web.HTTPError(status_code=503, log_message='Not a voting member')
+
+
+class PrepareAcceptor(Voter):
 
     @tornado.gen.coroutine
     def post(self):
         prepare = Prepare.from_request(self.request)
         in_progress = Promises.current.get(prepare.key)
         last_accepted = Learner.completed_rounds.highest_numbered(prepare.key)
+        leader = MultiPromises.granted.get(prepare.key)
+        Slots.current.prune(Learner.next_slot)
+        if not Slots.current.allows(prepare):
+            logger.warning("Slot %s has a higher ballot; rejecting %s", prepare.slot, prepare)
+            self.respond(code=400, message=Slots.current.rejection(prepare))
+            return
+        if leader:
+            if prepare.id < leader.prepare.start:
+                logger.warning("Prepare %s is below the leader's range %s", prepare, leader)
+                self.respond(code=400, message=Promise(
+                    prepare=Prepare(id=leader.prepare.start, key=prepare.key)))
+                return
+            if leader.leased():
+                logger.warning("%s holds a lease; rejecting %s", leader, prepare)
+                self.respond(code=400, message=Promise(
+                    prepare=Prepare(id=leader.prepare.start, key=prepare.key)))
+                return
+            logger.info("Prepare %s pre-empts the leader's range %s", prepare, leader)
+            leader.preempt(prepare.id)
+            yield log(PREEMPT, key=prepare.key, id=prepare.id)
+
         if in_progress:
             logger.info("Promise in progress already %s", in_progress)
             if in_progress.prepare.id == prepare.id:
@@ -44,6 +93,8 @@ class PrepareAcceptor(Handler):
         elif last_accepted is None or prepare.id > last_accepted.prepare.id:
             logger.info("Adding a new promise for prepare %s", prepare)
             Promises.current.add(Promise(prepare=prepare))
+            Slots.current.promise(prepare)
+            yield log(PROMISE, prepare=prepare.to_json())
             self.respond(code=200, message=Promise())
         else:
             logger.warning("Prepare has a lower ID than the last accepted proposal")
@@ -51,12 +102,108 @@ class PrepareAcceptor(Handler):
             self.respond(code=400, message=last_accepted)
 
 
-class ProposeAcceptor(Handler):
+class MultiPrepareAcceptor(Voter):
+
+    @tornado.gen.coroutine
+    def post(self):
+        multi_prepare = MultiPrepare.from_request(self.request)
+        key = multi_prepare.key
+        in_progress = Promises.current.get(key)
+        last_accepted = Learner.completed_rounds.highest_numbered(key)
+        leader = MultiPromises.granted.get(key)
+
+        if leader and leader.prepare.start == multi_prepare.start and multi_prepare.lease and (
+                leader.prepare.stop == float('inf')):
+            logger.info("Renewing the lease on %s", leader)
+            leader.prepare.lease = multi_prepare.lease
+            leader.expires = time.monotonic() + multi_prepare.lease
+            yield log(MULTI_PROMISE, prepare=multi_prepare.to_json())
+            self.respond(code=200, message=in_progress or Promise())
+        elif leader and (leader.prepare.start >= multi_prepare.start or leader.leased()):
+            logger.warning("Existing range %s is higher than %s", leader, multi_prepare)
+            self.respond(code=400, message=Promise(
+                prepare=Prepare(id=leader.prepare.start, key=key)))
+        elif in_progress and in_progress.prepare.id > multi_prepare.start:
+            logger.warning("Existing promise is higher than %s", multi_prepare)
+            self.respond(code=400, message=in_progress)
+        elif last_accepted and last_accepted.prepare.id >= multi_prepare.start:
+            logger.warning("%s starts below the last accepted proposal", multi_prepare)
+            self.respond(code=400, message=last_accepted)
+        else:
+            logger.info("Granting %s", multi_prepare)
+            expires = time.monotonic() + multi_prepare.lease if multi_prepare.lease else None
+            MultiPromises.granted.add(MultiPromise(multi_prepare, expires=expires))
+            yield log(MULTI_PROMISE, prepare=multi_prepare.to_json())
+            # Hand back any unfinished promise so the leader can repair it.
+            self.respond(code=200, message=in_progress or Promise())
+
+
+class ProposeAcceptor(Voter):
 
     @tornado.gen.coroutine
     def post(self):
         propose = Propose.from_request(self.request)
-        logger.info("Removing old promise, %s, on Accept", propose.prepare)
-        Promises.current.remove(propose.prepare)
+        prepare = propose.prepare
+        leader = MultiPromises.granted.get(prepare.key)
+        if leader and prepare.id < leader.prepare.start:
+            logger.warning("%s is below %s; rejecting it", prepare, leader)
+            self.respond(code=400, message=Promise(
+                prepare=Prepare(id=leader.prepare.start, key=prepare.key)))
+            return
+        if leader:
+            in_progress = Promises.current.get(prepare.key)
+            if not leader.covers(prepare) or (
+                    in_progress and in_progress.prepare.id > prepare.id):
+                logger.warning("%s was pre-empted; rejecting %s", leader, prepare)
+                self.respond(code=400, message=in_progress or Promise(
+                    prepare=Prepare(id=leader.prepare.stop, key=prepare.key)))
+                return
+        Slots.current.prune(Learner.next_slot)
+        if not Slots.current.allows(prepare):
+            logger.warning("Slot %s has a higher ballot; rejecting %s", prepare.slot, prepare)
+            self.respond(code=400, message=Slots.current.rejection(prepare))
+            return
+        logger.info("Removing old promise, %s, on Accept", prepare)
+        Promises.current.remove(prepare)
+        Slots.current.accept(prepare)
+        yield log(ACCEPT, prepare=prepare.to_json())
+        if DIRECT_LEARN:
+            Accepted(prepare=prepare, acceptor=options.port).broadcast(agents.all())
+        if MENCIUS and prepare.slot is not None:
+            skip_past(prepare.slot)
         self.respond(code=200,
-                     message=Accept(prepare=propose.prepare))
+                     message=Accept(prepare=prepare))
+
+
+class RecoverAcceptor(Voter):
+
+    @tornado.gen.coroutine
+    def post(self):
+        """
+        Phase 1 for one slot. Answers with what we learned there if we did,
+        else promises the ballot in the slot and answers with the highest
+        numbered value we accepted there, if any. A slot we learned but
+        have since put in the snapshot gets a 410.
+        """
+        prepare = Recover.from_request(self.request).prepare
+        learned = Learner.entry_at(prepare.slot)
+        if learned is not None:
+            self.respond(code=200, message=Success(prepare=learned.prepare))
+            return
+        if prepare.slot < Learner.next_slot:
+            self.respond(code=410, message=Promise())
+            return
+        Slots.current.prune(Learner.next_slot)
+        if not Slots.current.allows(prepare):
+            logger.warning("Slot %s has a higher ballot; rejecting %s", prepare.slot, prepare)
+            self.respond(code=400, message=Slots.current.rejection(prepare))
+            return
+        logger.info("Promising %s in slot %s", prepare, prepare.slot)
+        Slots.current.promise(prepare)
+        Promises.current.forget_slot(prepare)
+        yield log(SLOT_PROMISE, prepare=prepare.to_json())
+        self.respond(code=200, message=Promise(prepare=Slots.current.accepted.get(prepare.slot)))
+
+
+registry.gauge('paxos_promises', 'Promises this acceptor has made that are still in progress.',
+               lambda: len(Promises.current))
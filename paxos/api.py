@@ -1,12 +1,19 @@
-import json
-
 import tornado.web
 
+from paxos import codec
+
 
 class Handler(tornado.web.RequestHandler):
+    # Whether the handler only uses `request` and `respond`, so that it can
+    # be run without a RequestHandler at all (see paxos/simulation.py).
+    bare = False
 
     def respond(self, message, code=200):
+        """
+        Writes `message` back in the same encoding the request came in.
+        """
+        response_codec = codec.get(self.request.headers.get('Content-Type'))
         self.set_status(code)
-        self.set_header('Content-Type', 'application/json')
-        self.write(json.dumps(message.to_json()))
+        self.set_header('Content-Type', response_codec.content_type)
+        self.write(response_codec.encode(message.to_json()))
         self.finish()
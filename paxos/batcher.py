@@ -0,0 +1,81 @@
+import logging
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+from paxos.models import Prepare
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+BATCH = 'batch'
+
+
+class Batcher:
+    """
+    Collects concurrent writes to the same key into a single proposal.
+
+    A batch is committed once it holds `max_size` writes or once the first
+    write in it has waited `linger` seconds, whichever comes first. The
+    committed value is a Prepare with predicate `batch` whose argument is
+    the list of `{predicate, argument}` writes, in arrival order.
+    """
+
+    def __init__(self, commit, max_size, linger):
+        self.commit = commit
+        self.max_size = max_size
+        self.linger = linger
+        self.pending = {}
+        self.timers = {}
+
+    def submit(self, request):
+        """
+        Queues one client write. Returns a future that resolves to that
+        write's own Prepare, carrying the id of the batch that committed it,
+        and the write's position in the batch.
+        """
+        future = tornado.concurrent.Future()
+        key = request.get('key')
+        batch = self.pending.setdefault(key, [])
+        batch.append((request, future))
+        if len(batch) >= self.max_size:
+            self.flush(key)
+        elif key not in self.timers:
+            self.timers[key] = tornado.ioloop.IOLoop.current().call_later(
+                self.linger, self.flush, key)
+        return future
+
+    def flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(timer)
+        batch = self.pending.pop(key, None)
+        if batch:
+            tornado.ioloop.IOLoop.current().spawn_callback(self.run, key, batch)
+
+    @tornado.gen.coroutine
+    def run(self, key, batch):
+        if len(batch) == 1:
+            request, _ = batch[0]
+            prepare = Prepare(key=key,
+                              predicate=request.get('predicate'),
+                              argument=request.get('argument'))
+        else:
+            prepare = Prepare(key=key, predicate=BATCH, argument=[
+                {'predicate': request.get('predicate'),
+                 'argument': request.get('argument')}
+                for request, _ in batch])
+        logger.info("Committing a batch of %s writes as %s", len(batch), prepare)
+        try:
+            committed = yield self.commit(prepare)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for position, (request, future) in enumerate(batch):
+            future.set_result((Prepare(id=committed.id,
+                                       key=key,
+                                       predicate=request.get('predicate'),
+                                       argument=request.get('argument'),
+                                       slot=committed.slot), position))
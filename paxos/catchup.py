@@ -0,0 +1,124 @@
+import json
+import logging
+
+import tornado.gen
+import tornado.httpclient
+
+from paxos.learner import Learner
+from paxos.metrics import registry
+from paxos.models import Learn, Prepare
+from paxos.snapshot import Snapshots
+from paxos.wal import LEARN, log
+from settings import CATCHUP_BATCH, CATCHUP_RATE
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+PULLED = registry.counter('paxos_catchup_entries_total', 'Log entries pulled from peers to fill gaps.')
+TRANSFERS = registry.counter('paxos_catchup_snapshots_total', 'Snapshots taken from peers to catch up.')
+
+
+class CatchUp:
+    """
+    Brings this learner up to date from its peers.
+
+    For each peer we ask how far its log goes (the `X-Next-Slot` header of
+    an empty /read). If it is ahead, we pull the slots from our
+    `next_slot` on through /read, `batch` at a time, waiting in between so
+    we take no more than `rate` entries a second. If the peer has already
+    compacted the first slot we need, we start from its /snapshot instead
+    and pull the tail after it.
+    """
+
+    def __init__(self, batch, rate):
+        self.batch = batch
+        self.rate = rate
+        self.running = False
+
+    @tornado.gen.coroutine
+    def get(self, peer, endpoint):
+        try:
+            resp = yield tornado.httpclient.AsyncHTTPClient().fetch(
+                peer.url + ':' + str(peer.port) + endpoint, raise_error=False)
+        except OSError as e:
+            logger.info("Couldn't reach %s to catch up: %s", peer, e)
+            raise tornado.gen.Return(None)
+        if resp.code != 200:
+            logger.info("%s answered %s to %s", peer, resp.code, endpoint)
+            raise tornado.gen.Return(None)
+        raise tornado.gen.Return(resp)
+
+    @tornado.gen.coroutine
+    def run(self, peers):
+        """
+        Catches up from each of `peers` in turn. Resolves to the number of
+        entries pulled.
+        """
+        if self.running:
+            raise tornado.gen.Return(0)
+        self.running = True
+        pulled = 0
+        try:
+            for peer in peers:
+                count = yield self.pull(peer)
+                pulled += count
+        finally:
+            self.running = False
+        raise tornado.gen.Return(pulled)
+
+    @tornado.gen.coroutine
+    def pull(self, peer):
+        pulled = 0
+        while True:
+            since = Learner.next_slot
+            resp = yield self.get(peer, '/read?since={}&limit=0'.format(since))
+            if resp is None or int(resp.headers.get('X-Next-Slot', 0)) <= since:
+                break
+            resp = yield self.get(peer, '/read?since={}&limit={}'.format(since, self.batch))
+            if resp is None:
+                break
+            learns = [Learn(prepare=Prepare(**json.loads(line)['prepare']))
+                      for line in resp.body.decode('utf-8').splitlines() if line]
+            if not learns or learns[0].prepare.slot != since:
+                # The peer has compacted the slots we're missing.
+                restored = yield self.restore(peer)
+                if not restored:
+                    break
+                continue
+            logger.info("Pulling slots %s to %s from %s", since, learns[-1].prepare.slot, peer)
+            yield [log(LEARN, prepare=learn.prepare.to_json()) for learn in learns if self.learn(learn)]
+            pulled += len(learns)
+            PULLED.inc(len(learns))
+            if self.rate:
+                yield tornado.gen.sleep(len(learns) / float(self.rate))
+        raise tornado.gen.Return(pulled)
+
+    def learn(self, learn):
+        """
+        Learns `learn` unless we already have its slot. Returns whether we
+        didn't.
+        """
+        slot = learn.prepare.slot
+        if slot is None or slot < Learner.next_slot or slot in Learner.out_of_order:
+            return False
+        return Learner.learn(learn)
+
+    @tornado.gen.coroutine
+    def restore(self, peer):
+        resp = yield self.get(peer, '/snapshot')
+        if resp is None:
+            raise tornado.gen.Return(False)
+        snapshot = json.loads(resp.body)
+        if snapshot['next_slot'] <= Learner.next_slot:
+            raise tornado.gen.Return(False)
+        logger.warning("Restoring %s's snapshot up to slot %s", peer, snapshot['next_slot'])
+        waiting, tallies, learned = Learner.waiting, Learner.tallies, Learner.learned
+        Learner.restore(snapshot)
+        Learner.waiting, Learner.tallies, Learner.learned = waiting, tallies, learned
+        TRANSFERS.inc()
+        if Snapshots.current is not None:  # So a restart doesn't need the entries we skipped.
+            yield Snapshots.current.take(Learner)
+        raise tornado.gen.Return(True)
+
+
+catchup = CatchUp(CATCHUP_BATCH, CATCHUP_RATE)
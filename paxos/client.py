@@ -0,0 +1,210 @@
+import datetime
+import json
+import logging
+import random
+import urllib.parse
+
+import tornado.gen
+import tornado.httpclient
+import tornado.locks
+
+from paxos import codec
+from paxos import transport as transports
+from paxos.models import Agent
+from paxos.sharding import Shards, shards as default_shards
+from settings import AGENT_URL, MENCIUS, STREAM_PORT_OFFSET, TRANSPORT
+
+try:
+    import tornado.curl_httpclient as curl_httpclient  # Needs pycurl.
+except ImportError:
+    curl_httpclient = None
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('client')
+
+RETRIED = (500, 502, 503, 599)
+IDEMPOTENT = {'set', 'delete'}  # Writes that do no harm if they are applied twice.
+
+
+class ClientError(Exception):
+
+    def __init__(self, message, code=None):
+        super(ClientError, self).__init__(message)
+        self.code = code
+
+
+class Client:
+    """
+    Reads and writes a cluster on behalf of an application.
+
+    Requests for a key go to the leader of its group: the distinguished
+    proposer (the group's first agent, or with `spread` the agent the key
+    picks) to begin with, then the next agent along whenever the one we're
+    using can't be reached. A request that
+    fails is retried up to `retries` times, waiting a random time of up to
+    `backoff` * 2 ** attempt (capped at `backoff_max`) seconds in between.
+    A write that failed may still have been learned, so only writes with
+    an IDEMPOTENT predicate are retried.
+
+    At most `concurrency` requests are in flight at once; the rest wait.
+    With the 'stream' transport, writes are pipelined over one persistent
+    connection per agent. Otherwise they, and reads, go over HTTP, with
+    keep-alive connections when pycurl is installed.
+    """
+
+    def __init__(self, groups=None, url=AGENT_URL, concurrency=64, retries=3, backoff=0.01, backoff_max=1.0,
+                 transport=TRANSPORT, timeout=20.0, seed=None, spread=MENCIUS):
+        self.shards = default_shards if groups is None else Shards(groups)
+        self.url = url
+        self.concurrency = concurrency
+        self.semaphore = tornado.locks.Semaphore(concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.spread = spread
+        self.random = random.Random(seed)
+        self.leaders = {}  # group index -> how many agents along the group the leader is
+        self.stream = None
+        if transport == 'stream':
+            self.stream = transports.StreamTransport(STREAM_PORT_OFFSET, timeout=timeout)
+        http_class = curl_httpclient.CurlAsyncHTTPClient if curl_httpclient else tornado.httpclient.AsyncHTTPClient
+        self.http = http_class(force_instance=True, max_clients=concurrency)
+
+    def leader(self, key):
+        index = self.shards.index(key)
+        group = self.shards.groups[index]
+        first = group.index(self.shards.proposer(key, spread=self.spread))
+        return group[(first + self.leaders.get(index, 0)) % len(group)]
+
+    def failover(self, key, port):
+        """
+        Moves on from `port` to the next agent in the key's group, unless
+        another request has already done so.
+        """
+        if self.leader(key) == port:
+            index = self.shards.index(key)
+            self.leaders[index] = self.leaders.get(index, 0) + 1
+            logger.warning("Agent %s isn't answering; following %s for its group", port, self.leader(key))
+
+    def delay(self, attempt):
+        return self.random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    @tornado.gen.coroutine
+    def request(self, key, send, retry=True):
+        """
+        Calls `send(port)` for the key's leader until it answers 200, and
+        resolves to that response. Without `retry` it is only called once.
+        """
+        attempt = 0
+        while True:
+            port = self.leader(key)
+            with (yield self.semaphore.acquire()):
+                try:
+                    resp = yield send(port)
+                except (OSError, tornado.gen.TimeoutError) as e:  # OSError includes StreamClosedError.
+                    logger.info("Request to %s failed: %s", port, e)
+                    resp = None
+            code = resp.code if resp is not None else 599
+            if code == 200:
+                raise tornado.gen.Return(resp)
+            if code not in RETRIED:
+                raise ClientError("Agent {} answered {}".format(port, code), code=code)
+            if code == 599:
+                self.failover(key, port)
+            attempt += 1
+            if not retry:
+                raise ClientError("Request for {} to {} failed with {}; it may still have been applied".format(
+                    key, port, code), code=code)
+            if attempt > self.retries:
+                raise ClientError("Gave up on {} after {} attempts".format(key, attempt), code=code)
+            yield tornado.gen.sleep(self.delay(attempt))
+
+    def post(self, port, endpoint, body):
+        if self.stream is not None:
+            return tornado.gen.with_timeout(
+                datetime.timedelta(seconds=self.timeout),
+                self.stream.send(Agent(self.url, port), endpoint, codec.JSON.content_type, body))
+        return self.http.fetch(tornado.httpclient.HTTPRequest(
+            url=self.url + ':' + str(port) + endpoint,
+            method='POST',
+            headers={'Content-Type': codec.JSON.content_type},
+            body=body,
+            request_timeout=self.timeout), raise_error=False)
+
+    def fetch(self, port, endpoint):
+        return self.http.fetch(self.url + ':' + str(port) + endpoint, request_timeout=self.timeout,
+                               raise_error=False)
+
+    @tornado.gen.coroutine
+    def write(self, key, predicate, argument=None):
+        """
+        Commits one write and resolves to the prepare it was learned as.
+        """
+        body = codec.JSON.encode({'key': key, 'predicate': predicate, 'argument': argument})
+        resp = yield self.request(key, lambda port: self.post(port, '/write', body),
+                                  retry=predicate in IDEMPOTENT)
+        raise tornado.gen.Return(codec.decode(resp)['prepare'])
+
+    @tornado.gen.coroutine
+    def read(self, key, limit=None, since=None, linearizable=False):
+        """
+        Resolves to the learned entries for `key`, oldest first.
+        """
+        query = {'key': key}
+        if limit is not None:
+            query['limit'] = limit
+        if since is not None:
+            query['since'] = since
+        if linearizable:
+            query['linearizable'] = 1
+        endpoint = '/read?' + urllib.parse.urlencode(query)
+        resp = yield self.request(key, lambda port: self.fetch(port, endpoint))
+        raise tornado.gen.Return([json.loads(line) for line in resp.body.splitlines() if line])
+
+    @tornado.gen.coroutine
+    def get(self, key, linearizable=False):
+        """
+        Resolves to `(value, version)` for `key` from the agents' key-value
+        state; the version is 0 if it was never written.
+        """
+        query = {'key': key}
+        if linearizable:
+            query['linearizable'] = 1
+        endpoint = '/get?' + urllib.parse.urlencode(query)
+        resp = yield self.request(key, lambda port: self.fetch(port, endpoint))
+        js = json.loads(resp.body)
+        raise tornado.gen.Return((js['value'], js['version']))
+
+    @tornado.gen.coroutine
+    def settle(self, future):
+        try:
+            result = yield future
+        except ClientError as e:
+            raise tornado.gen.Return(e)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def write_many(self, writes):
+        """
+        Sends every `(key, predicate, argument)` in `writes` at once, up to
+        the concurrency limit. Resolves to each write's result, or the
+        `ClientError` it failed with, in the same order.
+        """
+        results = yield [self.settle(self.write(*write)) for write in writes]
+        raise tornado.gen.Return(results)
+
+    @tornado.gen.coroutine
+    def read_many(self, keys, **kwargs):
+        """
+        Like `write_many`, for a `read` of each of `keys`.
+        """
+        results = yield [self.settle(self.read(key, **kwargs)) for key in keys]
+        raise tornado.gen.Return(results)
+
+    def close(self):
+        self.http.close()
+        if self.stream is not None:
+            for connection in self.stream.connections.values():
+                if connection.stream is not None:
+                    connection.stream.close()
@@ -0,0 +1,132 @@
+import json
+import struct
+
+
+class JSONCodec:
+    content_type = 'application/json'
+
+    def encode(self, js):
+        return json.dumps(js)
+
+    def decode(self, body):
+        return json.loads(body)
+
+
+class BinaryCodec:
+    """
+    A compact encoding for the messages agents send each other.
+
+    Nearly every message is a Prepare, or a phase wrapping one. Those are
+    packed as a kind byte, the id and slot as fixed 8 byte ints, the key
+    and predicate as length-prefixed strings, and the argument (which can
+    be anything) as JSON. Any other message is sent as JSON behind its kind
+    byte.
+    """
+    content_type = 'application/x-paxos'
+
+    EMPTY, PHASE, PREPARE, SUCCESS, OTHER = range(5)
+    NONE = 0xFFFF
+    HEADER = struct.Struct('!BqqHH')
+    FIELDS = {'id', 'key', 'predicate', 'argument', 'slot'}
+
+    @classmethod
+    def is_prepare(cls, js):
+        return (isinstance(js, dict)
+                and set(js) <= cls.FIELDS
+                and isinstance(js.get('id'), int)
+                and isinstance(js.get('slot', 0), int)
+                and all(js.get(field) is None or isinstance(js.get(field), str)
+                        for field in ('key', 'predicate')))
+
+    def encode(self, js):
+        try:
+            body = self.pack(js)
+        except struct.error:  # Doesn't fit the fixed fields.
+            body = None
+        if body is None:
+            body = bytes([self.OTHER]) + json.dumps(js).encode('utf-8')
+        return body
+
+    def pack(self, js):
+        if isinstance(js, dict) and set(js) == {'prepare'}:
+            if js['prepare'] is None:
+                return bytes([self.EMPTY])
+            if self.is_prepare(js['prepare']):
+                return self.pack_prepare(self.PHASE, js['prepare'])
+        elif isinstance(js, dict) and set(js) == {'prepare', 'status'} and js['status'] == 'SUCCESS':
+            if self.is_prepare(js['prepare']):
+                return self.pack_prepare(self.SUCCESS, js['prepare'])
+        elif self.is_prepare(js):
+            return self.pack_prepare(self.PREPARE, js)
+        return None
+
+    def pack_prepare(self, kind, prepare):
+        key = self.pack_str(prepare.get('key'))
+        predicate = self.pack_str(prepare.get('predicate'))
+        if any(s is not None and len(s) >= self.NONE for s in (key, predicate)):
+            return None  # The length would read as NONE, or not fit at all.
+        slot = prepare.get('slot')
+        return b''.join([
+            self.HEADER.pack(kind, prepare['id'], -1 if slot is None else slot,
+                             self.NONE if key is None else len(key),
+                             self.NONE if predicate is None else len(predicate)),
+            key or b'',
+            predicate or b'',
+            json.dumps(prepare.get('argument')).encode('utf-8'),
+        ])
+
+    @staticmethod
+    def pack_str(s):
+        return None if s is None else s.encode('utf-8')
+
+    def decode(self, body):
+        body = memoryview(body)
+        kind = body[0]
+        if kind == self.EMPTY:
+            return {'prepare': None}
+        if kind == self.OTHER:
+            return json.loads(bytes(body[1:]).decode('utf-8'))
+        _, id, slot, key_len, predicate_len = self.HEADER.unpack_from(body)
+        offset = self.HEADER.size
+        key, offset = self.unpack_str(body, offset, key_len)
+        predicate, offset = self.unpack_str(body, offset, predicate_len)
+        prepare = {
+            'id': id,
+            'key': key,
+            'predicate': predicate,
+            'argument': json.loads(bytes(body[offset:]).decode('utf-8')),
+        }
+        if slot >= 0:
+            prepare['slot'] = slot
+        if kind == self.PREPARE:
+            return prepare
+        if kind == self.SUCCESS:
+            return {'prepare': prepare, 'status': 'SUCCESS'}
+        return {'prepare': prepare}
+
+    def unpack_str(self, body, offset, length):
+        if length == self.NONE:
+            return None, offset
+        return bytes(body[offset:offset + length]).decode('utf-8'), offset + length
+
+
+JSON = JSONCodec()
+BINARY = BinaryCodec()
+CODECS = {codec.content_type: codec for codec in [JSON, BINARY]}
+
+
+def get(content_type):
+    """
+    The codec for a Content-Type header value. Anything we don't recognize
+    is treated as JSON.
+    """
+    return CODECS.get(str(content_type).split(';')[0].strip(), JSON)
+
+
+def decode(message):
+    """
+    Decodes the body of a request or response according to its Content-Type.
+    """
+    headers = getattr(message, 'headers', None)
+    content_type = headers.get('Content-Type') if headers is not None else None
+    return get(content_type).decode(message.body)
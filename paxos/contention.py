@@ -0,0 +1,86 @@
+import logging
+import random
+
+import tornado.gen
+
+from paxos.metrics import CONFLICTS, RETRIES
+from paxos.models import Prepare, Promises
+from settings import BACKOFF_BASE, BACKOFF_MAX, BALLOT_STRIDE, SHARDS
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+
+def node_id(port, groups=SHARDS, stride=BALLOT_STRIDE):
+    """
+    A number for the agent on `port` that no other agent shares, for
+    making its ballots unique.
+
+    The agents in `groups` take the first numbers in port order. An agent
+    that joins from outside them gets one of the numbers after those, so
+    it never shares a number with a static member.
+    """
+    ports = sorted({p for group in groups for p in group})
+    if port in ports:
+        return ports.index(port)
+    if len(ports) >= stride:
+        raise ValueError("BALLOT_STRIDE must be more than the number of agents in SHARDS ({}) "
+                         "to leave room for agents that join".format(len(ports)))
+    return len(ports) + port % (stride - len(ports))
+
+
+class ContentionManager:
+    """
+    Keeps dueling proposers from live-locking each other.
+
+    When a ballot is turned down we skip our next ballot past the highest
+    competing one we were told about, then wait a random time of up to
+    `base` * 2 ** attempt (capped at `cap`) seconds before trying again.
+    It also keeps a few counters for each key that has seen contention.
+    """
+
+    def __init__(self, base, cap):
+        self.base = base
+        self.cap = cap
+        self.stats = {}
+        self.random = random.Random()
+
+    def stats_for(self, key):
+        if key not in self.stats:
+            self.stats[key] = {'conflicts': 0, 'backoffs': 0, 'backoff_seconds': 0.0,
+                               'highest_competitor': None}
+        return self.stats[key]
+
+    def conflict(self, key, conflicting):
+        """
+        Records that a ballot for `key` was turned down with the
+        `conflicting` responses.
+        """
+        stats = self.stats_for(key)
+        stats['conflicts'] += 1
+        CONFLICTS.inc()
+        competitor = Promises.from_responses(conflicting).highest_numbered(key)
+        if competitor is not None and competitor.prepare.id is not None:
+            Prepare.observe(competitor.prepare.id)
+            stats['highest_competitor'] = max(stats['highest_competitor'] or -1, competitor.prepare.id)
+
+    def delay(self, attempt):
+        return self.random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    @tornado.gen.coroutine
+    def backoff(self, key, attempt):
+        delay = self.delay(attempt)
+        stats = self.stats_for(key)
+        stats['backoffs'] += 1
+        RETRIES.inc()
+        stats['backoff_seconds'] += delay
+        logger.info("Backing off %.3fs before retrying %s (attempt %s)", delay, key, attempt)
+        yield tornado.gen.sleep(delay)
+
+    def to_json(self, key=None):
+        if key is not None:
+            return {key: self.stats[key]} if key in self.stats else {}
+        return dict(self.stats)
+
+
+contention = ContentionManager(BACKOFF_BASE, BACKOFF_MAX)
@@ -0,0 +1,91 @@
+import functools
+import logging
+
+import tornado.concurrent
+import tornado.ioloop
+
+from paxos import codec
+from settings import WIRE_CODEC
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+
+class Fanout:
+    """
+    Sends one message to every target at once.
+
+    `done` resolves as soon as `required` agents have answered 200, as soon
+    as any agent answers 400 (our ballot lost), or once everyone has
+    answered. `finished` resolves once every target has answered, so the
+    stragglers are still available after the caller has moved on.
+
+    `required` is a number of agents, or a quorum from `paxos.quorums`.
+    Each response notes the `agent` it came from, so quorums can check
+    which agents answered as well as how many.
+
+    Both futures resolve to a `(responses, issued, conflicting)` tuple.
+    """
+
+    def __init__(self, message, targets, required=None):
+        self.message = message
+        self.targets = list(targets)
+        self.required = len(self.targets) if required is None else required
+        self.responses = []
+        self.issued = []
+        self.conflicting = []
+        self.failed = []
+        self.done = tornado.concurrent.Future()
+        self.finished = tornado.concurrent.Future()
+
+    @property
+    def pending(self):
+        return len(self.targets) - len(self.responses) - len(self.failed)
+
+    def start(self):
+        if not self.targets:
+            self.done.set_result(self.result())
+            self.finished.set_result(self.result())
+            return self
+        io_loop = tornado.ioloop.IOLoop.current()
+        body = codec.get(WIRE_CODEC).encode(self.message.to_json())
+        for agent in self.targets:
+            logger.info("Sending request to agent %s", agent)
+            future = agent.send(self.message, body=body)
+            if future.done():
+                self.on_response(future, agent)
+            else:
+                io_loop.add_future(future, functools.partial(self.on_response, agent=agent))
+        return self
+
+    def on_response(self, future, agent=None):
+        try:
+            resp = future.result()
+        except Exception as e:
+            logger.warning("Request for %s failed: %s", self.message, e)
+            self.failed.append(e)
+        else:
+            resp.agent = agent
+            self.responses.append(resp)
+            if resp.code == 200:
+                self.issued.append(resp)
+            elif resp.code == 400:
+                self.conflicting.append(resp)
+
+        if not self.done.done() and self.decided():
+            self.done.set_result(self.result())
+        if not self.pending:
+            self.finished.set_result(self.result())
+
+    def reached(self):
+        if isinstance(self.required, int):
+            return len(self.issued) >= self.required
+        return self.required.reached(self.issued)
+
+    def decided(self):
+        return (self.reached()
+                or bool(self.conflicting)
+                or not self.pending)
+
+    def result(self):
+        return tuple([list(self.responses), list(self.issued), list(self.conflicting)])
@@ -0,0 +1,138 @@
+import collections
+import logging
+
+from paxos.batcher import BATCH
+from paxos.membership import RECONFIGURE
+from paxos.pipeline import NOOP
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+predicates = {}
+
+
+class Rejected(Exception):
+    """
+    Raised by a predicate to leave the key as it was, e.g. a failed CAS.
+    """
+
+
+def predicate(name):
+    """
+    Registers the decorated `f(current value, argument)` as the handler
+    for `name`. It returns the key's new value.
+    """
+    def register(f):
+        predicates[name] = f
+        return f
+    return register
+
+
+@predicate('set')
+def set_value(current, argument):
+    return argument
+
+
+@predicate('incr')
+def incr(current, argument):
+    return (current or 0) + (1 if argument is None else argument)
+
+
+@predicate('cas')
+def cas(current, argument):
+    """
+    `argument` is `{expected, value}`; the key is only set if it holds
+    `expected`.
+    """
+    if current != argument.get('expected'):
+        raise Rejected()
+    return argument.get('value')
+
+
+@predicate('delete')
+def delete(current, argument):
+    return None
+
+
+class KeyValueState:
+    """
+    The current value and version of every key, kept up to date by
+    applying each learned command as it is appended to the log, in log
+    order. A key's version is the number of commands that have changed
+    it, so it starts at 0 and only goes up.
+
+    No-ops and reconfigurations are skipped, a batch is applied write by
+    write, and predicates nobody registered leave the key alone.
+
+    What became of each write ('applied', 'rejected' or 'unknown') is kept
+    for the last `keep` entries, so the proposer can tell its client.
+    """
+    APPLIED, REJECTED, UNKNOWN = 'applied', 'rejected', 'unknown'
+    keep = 10000
+
+    def __init__(self, values=None, versions=None, applied=0):
+        self.values = values or {}
+        self.versions = versions or {}
+        self.applied = applied  # Log entries applied so far.
+        self.rejected = 0
+        self.unknown = 0
+        # (key, id) -> its outcome, or a tuple of them for a batch
+        self.outcomes = collections.OrderedDict()
+
+    def apply(self, learn):
+        prepare = learn.prepare
+        self.applied += 1
+        if prepare.predicate in (NOOP, RECONFIGURE):
+            return
+        if prepare.predicate == BATCH:
+            outcome = tuple(self.run(prepare.key, write.get('predicate'), write.get('argument'))
+                            for write in prepare.argument)
+        else:
+            outcome = self.run(prepare.key, prepare.predicate, prepare.argument)
+        self.outcomes[(prepare.key, prepare.id)] = outcome
+        if len(self.outcomes) > self.keep:
+            self.outcomes.popitem(last=False)
+
+    def run(self, key, name, argument):
+        handler = predicates.get(name)
+        if handler is None:
+            self.unknown += 1
+            return self.UNKNOWN
+        try:
+            value = handler(self.values.get(key), argument)
+        except Rejected:
+            self.rejected += 1
+            return self.REJECTED
+        except Exception as e:
+            logger.warning("Couldn't apply %s(%r) to %s: %s", name, argument, key, e)
+            self.rejected += 1
+            return self.REJECTED
+        if value is None:
+            self.values.pop(key, None)
+        else:
+            self.values[key] = value
+        self.versions[key] = self.versions.get(key, 0) + 1
+        return self.APPLIED
+
+    def outcome(self, key, id, position=0):
+        """
+        What became of write number `position` in the entry for `(key, id)`,
+        or None if we haven't applied it (or no longer remember).
+        """
+        outcome = self.outcomes.get((key, id))
+        if isinstance(outcome, tuple):
+            return outcome[position] if position < len(outcome) else None
+        return outcome if position == 0 else None
+
+    def get(self, key):
+        """
+        `(value, version)` for `key`; `(None, 0)` if it was never written.
+        """
+        return self.values.get(key), self.versions.get(key, 0)
+
+    def to_json(self):
+        return {'values': dict(self.values), 'versions': dict(self.versions), 'applied': self.applied}
+
+    @classmethod
+    def from_json(cls, js):
+        return cls(values=js['values'], versions=js['versions'], applied=js['applied'])
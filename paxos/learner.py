@@ -1,25 +1,385 @@
+import bisect
+import datetime
 import logging
 
 from paxos.api import Handler
-from paxos.models import Learn, Promises, Success
+from paxos.kv import KeyValueState
+from paxos.membership import Membership
+from paxos.metrics import registry
+from paxos.models import Accepted, agents, Learn, Prepare, Promises, Skip, Success
+from paxos.pipeline import NOOP
+from paxos.quorums import system as quorums
+from paxos.snapshot import Snapshots
+from paxos.wal import LEARN, log
 
+import tornado.concurrent
 import tornado.gen
+import tornado.ioloop
+import tornado.locks
 
 logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
 logger = logging.getLogger('agent')
 
 
+def same_value(prepare, other):
+    """
+    Whether two proposals carry the same value, whatever their ballots.
+    Every no-op is the same.
+    """
+    if prepare.predicate == NOOP or other.predicate == NOOP:
+        return prepare.predicate == other.predicate
+    return (prepare.key, prepare.predicate, prepare.argument) == (other.key, other.predicate, other.argument)
+
+
 class Learner(Handler):
+    bare = True
     ordered_rounds = []
     completed_rounds = Promises()
+    next_slot = 0
+    out_of_order = {}
+    base = 0  # Log offset of ordered_rounds[0]; earlier entries are in the snapshot.
+    learned = 0
+    key_index = {}  # key -> log offsets of its entries, ascending.
+    tallies = {}  # key -> {id: (prepare, ports of the acceptors that accepted it)}
+    waiting = {}  # (key, id) -> future resolved once we learn it.
+    applying = {}  # (key, id) -> future resolved once our log has applied it.
+    state = KeyValueState()  # What the log adds up to.
+    appended = tornado.locks.Condition()  # Notified whenever the log grows.
+
+    @classmethod
+    def reset(cls):
+        cls.ordered_rounds = []
+        cls.completed_rounds = Promises()
+        cls.next_slot = 0
+        cls.out_of_order = {}
+        cls.base = 0
+        cls.learned = 0
+        cls.key_index = {}
+        cls.tallies = {}
+        cls.waiting = {}
+        cls.applying = {}
+        cls.state = KeyValueState()
+
+    @classmethod
+    def append(cls, learn):
+        cls.key_index.setdefault(learn.prepare.key, []).append(cls.base + len(cls.ordered_rounds))
+        cls.ordered_rounds.append(learn)
+        cls.state.apply(learn)
+        Membership.learned(learn)
+        waiter = cls.applying.pop((learn.prepare.key, learn.prepare.id), None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+        cls.appended.notify_all()
+
+    @classmethod
+    def learn(cls, learn):
+        """
+        Records a learned value. Learns that carry a slot are appended to
+        `ordered_rounds` in slot order; ones that arrive early wait in
+        `out_of_order` until the slots before them have been learned.
+        Returns whether it was new: a ballot or slot learned again, e.g.
+        after a repair or from a log a snapshot already covers, is ignored.
+        Ballots are told apart by their exact ids since the last snapshot.
+
+        A slot learned again with the same value under another ballot, as
+        when a proposer fills a slot some learners already have, counts
+        that ballot as learned too but isn't appended again.
+        """
+        slot = learn.prepare.slot
+        if slot is None and learn in cls.completed_rounds:
+            logger.info("Already learned %s", learn.prepare)
+            return False
+        if slot is not None and (slot < cls.next_slot or slot in cls.out_of_order):
+            entry = cls.entry_at(slot)
+            if entry is None or same_value(entry.prepare, learn.prepare):
+                logger.info("Already learned slot %s", slot)
+                cls.completed_rounds.add(learn)
+                cls.resolve(learn)
+            return False
+        cls.learned += 1
+        cls.completed_rounds.add(learn)
+        cls.prune(learn.prepare)
+        cls.resolve(learn)
+        if slot is None:
+            cls.append(learn)
+        else:
+            cls.out_of_order[slot] = learn
+            while cls.next_slot in cls.out_of_order:
+                cls.append(cls.out_of_order.pop(cls.next_slot))
+                cls.next_slot += 1
+        if Snapshots.current is not None:
+            Snapshots.current.observe(cls, learn)
+        return True
+
+    @classmethod
+    def resolve(cls, learn):
+        waiter = cls.waiting.pop((learn.prepare.key, learn.prepare.id), None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(learn)
+
+    @classmethod
+    def entry_at(cls, slot):
+        """
+        The entry learned in `slot`, or None if we haven't learned one or the
+        snapshot covers it.
+        """
+        if slot in cls.out_of_order:
+            return cls.out_of_order[slot]
+        if slot >= cls.next_slot:
+            return None
+        index = cls.offset_of_slot(slot) - cls.base
+        if index < len(cls.ordered_rounds) and cls.ordered_rounds[index].prepare.slot == slot:
+            return cls.ordered_rounds[index]
+        return None
+
+    @classmethod
+    @tornado.gen.coroutine
+    def outcome(cls, prepare, position=0, timeout=None):
+        """
+        Resolves to what applying write number `position` of `prepare` did
+        (see `KeyValueState.outcome`), once our own log has got that far.
+        Resolves to None at once if we haven't learned `prepare` at all, and
+        raises `tornado.gen.TimeoutError` if it isn't applied within
+        `timeout` seconds, e.g. while an earlier slot is still missing.
+        """
+        if Learn(prepare=prepare) not in cls.completed_rounds:
+            raise tornado.gen.Return(None)
+        outcome = cls.state.outcome(prepare.key, prepare.id, position)
+        if outcome is not None:
+            raise tornado.gen.Return(outcome)
+        waiter = cls.applying.setdefault((prepare.key, prepare.id), tornado.concurrent.Future())
+        try:
+            if timeout is None:
+                yield waiter
+            else:
+                yield tornado.gen.with_timeout(datetime.timedelta(seconds=timeout), waiter)
+        except tornado.gen.TimeoutError:
+            cls.applying.pop((prepare.key, prepare.id), None)
+            raise
+        raise tornado.gen.Return(cls.state.outcome(prepare.key, prepare.id, position))
+
+    @classmethod
+    def skip(cls, skip):
+        """
+        Learns a no-op in each slot `skip` gives up that we haven't learned
+        yet, and returns those no-ops.
+        """
+        skipped = []
+        for slot in skip.slots():
+            if slot < cls.next_slot or slot in cls.out_of_order:
+                continue
+            learn = Learn(prepare=Prepare(id=-1, key=None, predicate=NOOP, slot=slot))
+            cls.learn(learn)
+            skipped.append(learn)
+        return skipped
+
+    @classmethod
+    def accepted(cls, accepted, quorum):
+        """
+        Counts one acceptor's `Accepted`. Once `quorum` covers the acceptors
+        that accepted the same ballot, the value is chosen: it is learned
+        and the `Learn` returned. Returns None until then, or if we have
+        already learned it.
+        """
+        prepare = accepted.prepare
+        learn = Learn(prepare=prepare)
+        if learn in cls.completed_rounds:
+            return None
+        ballots = cls.tallies.setdefault(prepare.key, {})
+        _, acceptors = ballots.setdefault(prepare.id, (prepare, set()))
+        acceptors.add(accepted.acceptor)
+        if not quorum.covers(acceptors):
+            return None
+        del ballots[prepare.id]
+        if not ballots:
+            del cls.tallies[prepare.key]
+        if not cls.learn(learn):
+            return None
+        return learn
+
+    @classmethod
+    def prune(cls, learned):
+        """
+        Stops counting Accepteds for ballots of `learned`'s key that can no
+        longer be chosen: lower ones for the same instance, and ones for
+        slots we have already learned.
+        """
+        ballots = cls.tallies.get(learned.key)
+        if not ballots:
+            return
+        for id, (prepare, _) in list(ballots.items()):
+            if (prepare.slot == learned.slot and id <= learned.id) or (
+                    prepare.slot is not None and prepare.slot < cls.next_slot):
+                del ballots[id]
+        if not ballots:
+            del cls.tallies[learned.key]
+
+    @classmethod
+    def wait_for(cls, prepare):
+        """
+        A future that resolves once we have learned `prepare`.
+        """
+        learn = Learn(prepare=prepare)
+        if learn in cls.completed_rounds:
+            future = tornado.concurrent.Future()
+            future.set_result(learn)
+            return future
+        return cls.waiting.setdefault((prepare.key, prepare.id), tornado.concurrent.Future())
+
+    @classmethod
+    def capture(cls):
+        """
+        Everything a snapshot needs, taken at one point in time. The log
+        entries themselves are summarized by the latest value of each key.
+        """
+        return {
+            'cut': len(cls.ordered_rounds),
+            'base': cls.base + len(cls.ordered_rounds),
+            'learned': cls.learned,
+            'next_slot': cls.next_slot,
+            'latest': cls.completed_rounds.latest(),
+            'ids': [[learn.prepare.key, learn.prepare.id] for learn in cls.ordered_rounds
+                    if learn.prepare.slot is None],
+            'out_of_order': list(cls.out_of_order.values()),
+            'state': cls.state.to_json(),
+            'membership': Membership.to_json(),
+        }
+
+    @classmethod
+    def truncate(cls, state):
+        """
+        Drops the log entries covered by a snapshot taken with `capture`,
+        and the ids of the ballots learned before it.
+        """
+        # A new list, so readers still streaming the old one aren't shifted.
+        cls.ordered_rounds = cls.ordered_rounds[state['cut']:]
+        cls.base += state['cut']
+        cls.completed_rounds.compact()
+        for key in list(cls.key_index):
+            offsets = cls.key_index[key]
+            del offsets[:bisect.bisect_left(offsets, cls.base)]
+            if not offsets:
+                del cls.key_index[key]
+
+    @classmethod
+    def journal(cls):
+        """
+        The learned values the last snapshot doesn't cover, for the
+        write-ahead log to keep.
+        """
+        return cls.ordered_rounds + list(cls.out_of_order.values())
+
+    @classmethod
+    def restore(cls, snapshot):
+        cls.reset()
+        cls.base = snapshot['base']
+        cls.learned = snapshot['learned']
+        cls.next_slot = snapshot['next_slot']
+        # The ballots the snapshot covers, so a log that wasn't compacted
+        # after it doesn't have them learned again.
+        for key, id in snapshot.get('ids', []):
+            cls.completed_rounds.add(Learn(prepare=Prepare(id=id, key=key)))
+        for prepare in snapshot['latest']:
+            cls.completed_rounds.add(Learn(prepare=Prepare(**prepare)))
+        for prepare in snapshot['out_of_order']:
+            learn = Learn(prepare=Prepare(**prepare))
+            cls.out_of_order[learn.prepare.slot] = learn
+        if 'state' in snapshot:
+            cls.state = KeyValueState.from_json(snapshot['state'])
+        if 'membership' in snapshot:
+            Membership.restore(snapshot['membership'])
+
+    @classmethod
+    def offset_of_slot(cls, slot):
+        """
+        The log offset of the first entry at or after `slot`. Only
+        meaningful when every entry carries a slot.
+        """
+        lo, hi = 0, len(cls.ordered_rounds)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_slot = cls.ordered_rounds[mid].prepare.slot
+            if entry_slot is not None and entry_slot < slot:
+                lo = mid + 1
+            else:
+                hi = mid
+        return cls.base + lo
+
+    @classmethod
+    def offsets(cls, key=None, offset=None, since_slot=None, limit=None):
+        """
+        The log offsets of the entries from `offset` (or from `since_slot`)
+        on, optionally only those for `key`, at most `limit`; and the
+        offset to continue from after them. Costs O(log n), plus the size
+        of the result for a `key`, not of the log.
+        """
+        start = max(offset or 0, cls.base)
+        if since_slot is not None:
+            start = max(start, cls.offset_of_slot(since_slot))
+        stop = cls.base + len(cls.ordered_rounds)
+        if key is None:
+            offsets = range(start, stop if limit is None else min(stop, start + limit))
+        else:
+            index = cls.key_index.get(key, [])
+            first = bisect.bisect_left(index, start)
+            offsets = index[first:] if limit is None else index[first:first + limit]
+        return offsets, offsets[-1] + 1 if offsets else stop
+
+    @classmethod
+    def entries_at(cls, offsets):
+        """
+        Lazily yields `(offset, learn)` for `offsets`, from the log as it is
+        now: a snapshot truncating it meanwhile doesn't shift them.
+        """
+        rounds, base = cls.ordered_rounds, cls.base
+        return ((entry_offset, rounds[entry_offset - base]) for entry_offset in offsets)
+
+    @classmethod
+    def entries(cls, key=None, offset=None, since_slot=None, limit=None):
+        """
+        `(offset, learn)` for the entries `offsets` picks out.
+        """
+        offsets, _ = cls.offsets(key=key, offset=offset, since_slot=since_slot, limit=limit)
+        return cls.entries_at(offsets)
 
     @tornado.gen.coroutine
     def post(self):
         learn = Learn.from_request(self.request)
-        logger.info("Adding new learn, %s, to completed rounds.", learn.to_json())
-        Learner.completed_rounds.add(learn)
-        Learner.ordered_rounds.append(learn)
+        logger.info("Adding new learn, %s, to completed rounds.", learn.prepare)
+        if Learner.learn(learn):
+            yield log(LEARN, prepare=learn.prepare.to_json())
+        elif learn not in Learner.completed_rounds:
+            logger.warning("Slot %s already holds another value; not learning %s", learn.prepare.slot, learn.prepare)
+            self.respond(code=409, message=learn)
+            return
         success = Success(prepare=learn.prepare)
         self.respond(code=200, message=success)
 
-    def which_multipromises_to_send(self):
+
+class AcceptedLearner(Handler):
+    bare = True
+
+    @tornado.gen.coroutine
+    def post(self):
+        accepted = Accepted.from_request(self.request)
+        learn = Learner.accepted(accepted, quorums.phase2(agents.all()))
+        if learn is not None:
+            logger.info("A quorum accepted %s; learned it.", learn.prepare)
+            yield log(LEARN, prepare=learn.prepare.to_json())
+        self.respond(code=200, message=Success(prepare=accepted.prepare))
+
+
+class SkipLearner(Handler):
+    bare = True
+
+    @tornado.gen.coroutine
+    def post(self):
+        skip = Skip.from_request(self.request)
+        skipped = Learner.skip(skip)
+        logger.info("Agent %s of %s skipped slots %s to %s", skip.owner, skip.owners, skip.start, skip.stop)
+        yield [log(LEARN, prepare=learn.prepare.to_json()) for learn in skipped]
+        self.respond(code=200, message=skip)
+
+
+registry.gauge('paxos_log_entries', 'Learned entries still held in memory.', lambda: len(Learner.ordered_rounds))
+registry.gauge('paxos_learned', 'Values this agent has learned.', lambda: Learner.learned)
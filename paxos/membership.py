@@ -0,0 +1,130 @@
+import logging
+
+from tornado.options import options
+
+from paxos import quorums
+from paxos.models import Agent, agents
+from settings import MENCIUS, PIPELINE_WINDOW
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+RECONFIGURE = 'reconfigure'
+
+
+class Membership:
+    """
+    Which agents are acceptors, and what their quorums are, as decided by
+    the log itself.
+
+    A reconfiguration is an ordinary write with the `reconfigure` predicate
+    whose argument is the new configuration:
+
+        {
+            members: [<port>],
+            phase1: <int>, phase2: <int>,  # optional, as PHASE1/2_QUORUM
+            grid: [[<port>]],  # optional, as QUORUM_GRID
+            at: <slot>  # optional
+        }
+
+    Every learner applies it once it has learned the log up to slot `at`.
+    That is never sooner than PIPELINE_WINDOW slots after the entry itself,
+    because the leader may already have that many instances in flight under
+    the old configuration. Without quorum settings the current rules are
+    kept.
+
+    An agent only votes (answers Prepare and Propose) while it is a member
+    of the configuration it has learned, so one that is added votes only
+    once it has caught up to its own addition.
+    """
+    config = None  # The configuration in force; None for SHARDS/settings.py.
+    pending = None  # (slot, configuration) waiting to take effect.
+    voting = True
+
+    @classmethod
+    def reset(cls):
+        cls.config = None
+        cls.pending = None
+        cls.voting = True
+
+    @classmethod
+    def members(cls):
+        return [agent.port for agent in agents.all()]
+
+    @classmethod
+    def check(cls, config):
+        """
+        Raises ValueError unless the current configuration can safely be
+        changed to `config`, and we can still commit writes under it.
+        """
+        members = config.get('members')
+        if not members or not all(isinstance(port, int) for port in members):
+            raise ValueError("A configuration needs a list of member ports")
+        if MENCIUS:
+            raise ValueError("Slot owners are fixed at startup with MENCIUS; restart to change members")
+        if len(set(members) ^ set(cls.members())) > 1:
+            raise ValueError("Add or remove one member at a time, so old and new quorums overlap")
+        if not PIPELINE_WINDOW and set(members) - set(cls.members()):
+            raise ValueError("New members can only catch up on a slotted log; set PIPELINE_WINDOW")
+        cls.quorums(config).check(cls.agents(members), proposer=options.port)
+
+    @classmethod
+    def quorums(cls, config):
+        if any(config.get(name) is not None for name in ('phase1', 'phase2', 'grid')):
+            return quorums.get(config.get('phase1'), config.get('phase2'), config.get('grid'))
+        return quorums.system.system
+
+    @classmethod
+    def agents(cls, members):
+        current = {agent.port: agent for agent in agents.all()}
+        template = next(iter(current.values()), None)
+        return [current.get(port) or Agent(template.url, port, transport=template.transport)
+                for port in members]
+
+    @classmethod
+    def learned(cls, learn):
+        """
+        Called with every entry appended to the log, in log order.
+        """
+        prepare = learn.prepare
+        next_slot = None if prepare.slot is None else prepare.slot + 1
+        if prepare.predicate == RECONFIGURE:
+            config = prepare.argument
+            at = None if next_slot is None else max(config.get('at') or 0, next_slot + PIPELINE_WINDOW)
+            cls.pending = (at, config)
+        cls.advance(next_slot)
+
+    @classmethod
+    def advance(cls, next_slot):
+        if cls.pending is None:
+            return
+        at, config = cls.pending
+        if at is not None and (next_slot is None or next_slot < at):
+            return
+        cls.pending = None
+        cls.apply(config)
+
+    @classmethod
+    def apply(cls, config):
+        try:
+            system = cls.quorums(config)
+            members = cls.agents(config['members'])
+            system.check(members)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Ignoring configuration %s: %s", config, e)
+            return
+        logger.warning("Members are now %s", config['members'])
+        agents.update(members)
+        quorums.system.use(system)
+        cls.config = config
+        cls.voting = options.port in config['members']
+
+    @classmethod
+    def to_json(cls):
+        return {'config': cls.config, 'pending': cls.pending, 'members': cls.members(), 'voting': cls.voting}
+
+    @classmethod
+    def restore(cls, js):
+        if js.get('config') is not None:
+            cls.apply(js['config'])
+        cls.pending = tuple(js['pending']) if js.get('pending') else None
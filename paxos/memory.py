@@ -0,0 +1,54 @@
+"""
+Measures how much memory the learner holds per learned entry.
+
+    python -m paxos.memory [entries] [keys]
+
+This resets the learner's class-level state, so run it on its own rather
+than inside an agent.
+"""
+import gc
+import sys
+import tracemalloc
+
+from paxos.kv import KeyValueState
+from paxos.learner import Learner
+from paxos.models import Learn, Prepare
+
+
+def learn(start, stop, keys):
+    for i in range(start, stop):
+        key = 'key-{}'.format(i % keys)  # A fresh string each time, like one parsed off the wire.
+        Learner.learn(Learn(prepare=Prepare(id=i, key=key, predicate='set', argument=i)))
+
+
+def bytes_per_entry(entries=100000, keys=1000):
+    """
+    Learns `entries` small values spread over `keys` keys and returns the
+    traced allocations per entry, in bytes. The bounded caches (the
+    outcomes of recent writes) are filled first, so only what keeps
+    growing with the log is counted.
+    """
+    Learner.reset()
+    gc.collect()
+    tracemalloc.start()
+    warm_up = 2 * KeyValueState.keep
+    learn(0, warm_up, keys)
+    before = tracemalloc.take_snapshot()
+    learn(warm_up, warm_up + entries, keys)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    ours = [tracemalloc.Filter(False, tracemalloc.__file__)]  # Not the snapshots themselves.
+    total = sum(stat.size_diff for stat in after.filter_traces(ours).compare_to(before.filter_traces(ours), 'filename'))
+    Learner.reset()
+    return total / float(entries)
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    keys = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    print("{:.1f} bytes per learned entry ({} entries over {} keys)".format(
+        bytes_per_entry(entries, keys), entries, keys))
+
+
+if __name__ == '__main__':
+    main()
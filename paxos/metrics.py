@@ -0,0 +1,170 @@
+import contextlib
+import math
+import time
+
+
+def format_labels(labels, extra=None):
+    pairs = sorted((labels or {}).items()) + list((extra or {}).items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name, format_labels(self.labels), self.value
+
+
+class Gauge:
+    """
+    Either moved up and down with `inc` and `dec`, or read from `fn`
+    whenever it is scraped, which costs nothing in between.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, fn=None, labels=None):
+        self.name = name
+        self.labels = labels
+        self.fn = fn
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def samples(self):
+        yield self.name, format_labels(self.labels), self.fn() if self.fn else self.value
+
+
+class Histogram:
+    """
+    Latencies in log-linear buckets, like HdrHistogram: `sub_buckets`
+    buckets per power of two from 2 ** `lowest` to 2 ** `highest` seconds,
+    so a bucket's bound is never more than 1 / `sub_buckets` above what
+    was recorded in it. Recording is a frexp and a list increment.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, labels=None, lowest=-20, highest=7, sub_buckets=4):
+        self.name = name
+        self.labels = labels
+        self.lowest = lowest
+        self.sub_buckets = sub_buckets
+        self.bounds = [2.0 ** octave * (1 + (sub + 1) / sub_buckets)
+                       for octave in range(lowest, highest) for sub in range(sub_buckets)]
+        self.counts = [0] * (len(self.bounds) + 1)  # The last one is +Inf.
+        self.count = 0
+        self.sum = 0.0
+
+    def index(self, value):
+        if value <= 0:
+            return 0
+        mantissa, exponent = math.frexp(value)  # value = mantissa * 2 ** exponent, 0.5 <= mantissa < 1
+        i = (exponent - 1 - self.lowest) * self.sub_buckets + int((2 * mantissa - 1) * self.sub_buckets)
+        return min(max(i, 0), len(self.bounds))
+
+    def observe(self, value):
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started)
+
+    def quantile(self, q):
+        """
+        The upper bound of the bucket holding the `q` quantile.
+        """
+        return quantile(list(zip(self.bounds + [float('inf')], self.counts)), q)
+
+    def samples(self):
+        labels = self.labels or {}
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield self.name + '_bucket', format_labels(labels, {'le': repr(bound)}), cumulative
+        yield self.name + '_bucket', format_labels(labels, {'le': '+Inf'}), self.count
+        yield self.name + '_sum', format_labels(labels), self.sum
+        yield self.name + '_count', format_labels(labels), self.count
+
+
+def quantile(buckets, q):
+    """
+    The `q` quantile of `(upper bound, count)` buckets, as a bucket bound.
+    """
+    total = sum(count for _, count in buckets)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in buckets:
+        seen += count
+        if seen >= q * total:
+            return bound
+    return buckets[-1][0]
+
+
+class Registry:
+    """
+    Every metric this agent keeps, rendered for Prometheus by `render`.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.help = {}
+
+    def add(self, metric, help):
+        self.metrics.append(metric)
+        self.help.setdefault(metric.name, help)
+        return metric
+
+    def counter(self, name, help, labels=None):
+        return self.add(Counter(name, labels=labels), help)
+
+    def gauge(self, name, help, fn=None, labels=None):
+        return self.add(Gauge(name, fn, labels=labels), help)
+
+    def histogram(self, name, help, labels=None):
+        return self.add(Histogram(name, labels=labels), help)
+
+    def render(self):
+        families = {}
+        for metric in self.metrics:
+            families.setdefault(metric.name, []).append(metric)
+        lines = []
+        for name, metrics in families.items():
+            lines.append('# HELP {} {}'.format(name, self.help[name]))
+            lines.append('# TYPE {} {}'.format(name, metrics[0].kind))
+            for metric in metrics:
+                for sample, labels, value in metric.samples():
+                    lines.append('{}{} {}'.format(sample, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+PHASE_HELP = 'Time the proposer spends in each phase of a round.'
+PREPARE_SECONDS = registry.histogram('paxos_phase_seconds', PHASE_HELP, labels={'phase': 'prepare'})
+PROPOSE_SECONDS = registry.histogram('paxos_phase_seconds', PHASE_HELP, labels={'phase': 'propose'})
+LEARN_SECONDS = registry.histogram('paxos_phase_seconds', PHASE_HELP, labels={'phase': 'learn'})
+WRITE_SECONDS = registry.histogram('paxos_write_seconds', 'Time to answer a /write.')
+WRITES = registry.counter('paxos_writes_total', 'Writes this agent committed as proposer.')
+CONFLICTS = registry.counter('paxos_conflicts_total', 'Rounds turned down because of a higher ballot.')
+RETRIES = registry.counter('paxos_retries_total', 'Rounds retried with a new ballot after backing off.')
+IN_FLIGHT = registry.gauge('paxos_proposals_in_flight', 'Proposals this agent is committing right now.')
@@ -1,13 +1,20 @@
+import bisect
+import collections
+import heapq
+import itertools
 import threading
 import logging
-import collections
 import random
-import json
+import sys
+import time
 
 import tornado.httpclient
 import tornado.gen
 
-from settings import AGENT_URL, AGENT_PORTS
+from paxos import codec
+from paxos import transport as transports
+from paxos.fanout import Fanout
+from settings import AGENT_URL, AGENT_PORTS, STREAM_PORT_OFFSET, STREAM_TIMEOUT, TRANSPORT, WIRE_CODEC
 
 logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
 prepare_id_mutex = threading.Lock()
@@ -16,20 +23,21 @@ logger = logging.getLogger('agent')
 
 class Agent:
 
-    def __init__(self, url, port):
+    def __init__(self, url, port, transport=None):
         self.url = url
         self.port = port
+        self.transport = transport or transports.HTTP
 
     @tornado.gen.coroutine
-    def send(self, message):
-        http_client = tornado.httpclient.AsyncHTTPClient()
-        request = tornado.httpclient.HTTPRequest(
-            url=self.url + ':' + str(self.port) + message.endpoint,
-            method='POST',
-            headers={'Content-Type': 'application/json'},
-            body=json.dumps(message.to_json())
-        )
-        resp = yield http_client.fetch(request, raise_error=False)
+    def send(self, message, body=None):
+        """
+        Sends `message` to this agent. Pass the already encoded `body` when
+        sending the same message to several agents.
+        """
+        wire_codec = codec.get(WIRE_CODEC)
+        if body is None:
+            body = wire_codec.encode(message.to_json())
+        resp = yield self.transport.send(self, message.endpoint, wire_codec.content_type, body)
         raise tornado.gen.Return(resp)
 
     def __repr__(self):
@@ -41,21 +49,32 @@ class Agents:
     def __init__(self, agnts):
         self.agents = agnts
 
+    def majority(self):
+        return int(len(self.agents) / 2) + 1
+
+    def peers(self, excluding=None):
+        return [a for a in self.agents if a.port != excluding]
+
     def quorum(self, excluding=None):
         random.shuffle(self.agents)
-        agnts = [a for a in self.agents if a.port != excluding]
-        required_for_quorum = int(len(self.agents) / 2) + 1
-        return agnts[0:required_for_quorum]
+        return self.peers(excluding=excluding)[0:self.majority()]
 
     def all(self):
         return self.agents
 
+    def update(self, agnts):
+        self.agents = agnts
+
 
-agents = Agents([Agent(AGENT_URL, port)
+default_transport = transports.get(TRANSPORT, port_offset=STREAM_PORT_OFFSET, timeout=STREAM_TIMEOUT)
+agents = Agents([Agent(AGENT_URL, port, transport=default_transport)
                  for port in AGENT_PORTS])
 
 
 class Phase:
+    # Messages are kept by the million in the learner, so none of them get
+    # a per-instance __dict__. `endpoint` is normally a class attribute.
+    __slots__ = ('prepare', 'endpoint')
 
     def __init__(self, prepare=None):
         self.prepare = prepare
@@ -67,7 +86,7 @@ class Phase:
 
     @classmethod
     def from_request(cls, request):
-        js = json.loads(request.body)
+        js = codec.decode(request)
         prepare = None
         if js.get('prepare'):
             prepare = Prepare(**js.get('prepare'))
@@ -77,104 +96,273 @@ class Phase:
     def from_response(cls, response):
         return cls.from_request(response)
 
+    def broadcast(self, targets, required=None):
+        """
+        Starts sending this message to all of `targets` concurrently and
+        returns the running `Fanout`. Use this over `send` when you need the
+        stragglers' responses as well.
+        """
+        if not hasattr(self, 'endpoint'):
+            raise NotImplementedError("Set an endpoint for the model.")
+        return Fanout(self, targets, required=required).start()
+
     @tornado.gen.coroutine
-    def fanout(self, expected=None):
+    def fanout(self, expected=None, required=None):
         if not hasattr(self, 'endpoint'):
             raise NotImplementedError("Set an endpoint for the model")
-        responses = []
-        for agent in agents.all():
-            resp = yield agent.send(self)
-            if expected is not None:
-                responses.append(expected.from_response(resp))
-        raise tornado.gen.Return(responses)
+        responses, _, _ = yield self.broadcast(agents.all(), required=required).done
+        if expected is None:
+            raise tornado.gen.Return([])
+        # Anything but a 200 (a 599 has no body at all) counts as a failure.
+        raise tornado.gen.Return([expected.from_response(resp) for resp in responses
+                                  if resp.code == 200])
 
     @tornado.gen.coroutine
-    def send(self, quorum):
+    def send(self, quorum, required=None):
+        """
+        Sends to every agent in `quorum` at once. Resolves as soon as
+        `required` (default: all of them) have issued, or as soon as one
+        conflicts.
+        """
         if not hasattr(self, 'endpoint'):
             raise NotImplementedError("Set an endpoint for the model.")
-        responses, issued, conflicting = [], [], []
-        for agent in quorum:
-            logger.info("Sending request to agent %s", agent)
-            resp = yield agent.send(self)
-            responses.append(resp)
-            if resp.code == 200:
-                issued.append(resp)
-            elif resp.code == 400:
-                conflicting.append(resp)
-        raise tornado.gen.Return(tuple([responses, issued, conflicting]))
+        result = yield self.broadcast(quorum, required=required).done
+        raise tornado.gen.Return(result)
 
 
+# noinspection PyMissingConstructor
 class MultiPrepare(Phase):
-
-    def __init__(self, start=0, stop=float('inf'), key=None):
+    """
+    Asks for a promise on every proposal id in [start, stop) for `key`. The
+    open-ended range lets a stable leader skip Phase 1 for all of its
+    subsequent writes to the key.
+
+    With a `lease` (in seconds), the acceptors also promise not to grant
+    any other ballot for the key until it runs out.
+    """
+    __slots__ = ('start', 'stop', 'key', 'lease')
+    endpoint = '/multiprepare'
+
+    def __init__(self, start=0, stop=float('inf'), key=None, lease=None):
         self.start = start
         self.stop = stop
         self.key = key
+        self.lease = lease
 
     def to_json(self):
-        return {
+        js = {
             'start': self.start,
-            'stop': self.stop,
+            'stop': None if self.stop == float('inf') else self.stop,
             'key': self.key
         }
+        if self.lease:
+            js['lease'] = self.lease
+        return js
+
+    @classmethod
+    def from_json(cls, js):
+        stop = js.get('stop')
+        return cls(start=js.get('start'),
+                   stop=float('inf') if stop is None else stop,
+                   key=js.get('key'),
+                   lease=js.get('lease'))
+
+    @classmethod
+    def from_request(cls, request):
+        return cls.from_json(codec.decode(request))
+
+    def __repr__(self):
+        return "<MultiPrepare key={} start={} stop={}>".format(self.key, self.start, self.stop)
 
 
 # noinspection PyMissingConstructor
 class Prepare(Phase):
+    """
+    `_id` is the next ballot this agent hands out. Each agent only uses the
+    ids congruent to its node number modulo `_stride`, so ballots from
+    different agents never collide.
+    """
+    __slots__ = ('id', 'key', 'predicate', 'argument', 'slot')
     _id = 0
+    _stride = 1
     endpoint = '/prepare'
 
-    def __init__(self, id=None, key=None, predicate=None, argument=None):
+    def __init__(self, id=None, key=None, predicate=None, argument=None, slot=None):
         self.id = id
         if id is None:
             with prepare_id_mutex:
                 self.id = Prepare._id
-                Prepare._id += 1
+                Prepare._id += Prepare._stride
 
-        self.key = key
-        self.predicate = predicate
+        # Keys and predicates repeat across entries; share one copy of each.
+        self.key = sys.intern(key) if isinstance(key, str) else key
+        self.predicate = sys.intern(predicate) if isinstance(predicate, str) else predicate
         self.argument = argument
+        self.slot = slot  # Position in the log, when the leader is pipelining.
 
     def to_json(self):
-        return {
+        js = {
             'id': self.id,
             'key': self.key,
             'predicate': self.predicate,
             'argument': self.argument
         }
+        if self.slot is not None:
+            js['slot'] = self.slot
+        return js
+
+    @classmethod
+    def number(cls, node, stride):
+        """
+        Hands out ballots `node`, `node + stride`, `node + 2 * stride`, ...
+        from here on.
+        """
+        if not 0 <= node < stride:
+            raise ValueError("Node {} doesn't fit a ballot stride of {}".format(node, stride))
+        with prepare_id_mutex:
+            cls._stride = stride
+            cls._id += (node - cls._id) % stride
+
+    @classmethod
+    def observe(cls, id):
+        """
+        Moves our next ballot past `id`, e.g. a competitor's.
+        """
+        with prepare_id_mutex:
+            if id >= cls._id:
+                cls._id += ((id - cls._id) // cls._stride + 1) * cls._stride
 
     @classmethod
     def from_request(cls, request):
-        return Prepare(**json.loads(request.body))
+        return Prepare(**codec.decode(request))
 
     def __repr__(self):
         return "<Prepare id={}>".format(self.id)
 
 
 class MultiPromise(Phase):
-
+    __slots__ = ('expires',)
     endpoint = '/promise'
 
-    def __init__(self, prepare):
+    def __init__(self, prepare, expires=None):
         self.prepare = prepare
+        self.expires = expires  # time.monotonic() when the lease runs out.
 
     @classmethod
     def from_response(cls, response):
-        resp = json.loads(response.body)
-        return MultiPromise(**resp)
+        resp = codec.decode(response)
+        return MultiPromise(MultiPrepare.from_json(resp['prepare']))
 
     def to_json(self):
         return {
-            'prepare': self.prepare
+            'prepare': self.prepare.to_json()
         }
 
+    def covers(self, prepare):
+        return self.prepare.start <= prepare.id < self.prepare.stop
+
+    def leased(self, now=None):
+        """
+        Whether the range is still whole and its lease hasn't run out.
+        """
+        if self.expires is None or self.prepare.stop != float('inf'):
+            return False
+        return (time.monotonic() if now is None else now) < self.expires
+
+    def preempt(self, id):
+        """
+        Closes the range at `id` so a higher ballot from another proposer
+        takes over from there.
+        """
+        self.prepare.stop = min(self.prepare.stop, id)
+
+    def __repr__(self):
+        return "<MultiPromise prepare={}>".format(self.prepare)
+
+
+class MultiPromises:
+    """
+    Open-ended promises, one per key. `granted` holds the ones this agent
+    gave out as an acceptor and `held` the ones it owns as the leader.
+    """
+    granted = None
+    held = None
+
+    @classmethod
+    def initialize(cls):
+        cls.granted = MultiPromises()
+        cls.held = MultiPromises()
+
+    def __init__(self):
+        self.promises = {}
+
+    def add(self, promise):
+        self.promises[promise.prepare.key] = promise
+
+    def get(self, key):
+        return self.promises.get(key)
+
+    def remove(self, key):
+        self.promises.pop(key, None)
+
+    def clear(self):
+        self.promises = {}
+
+
+class Slots:
+    """
+    One Paxos instance per log slot, as this agent votes in it as an
+    acceptor: the highest ballot it has promised in each slot, and the
+    highest numbered proposal it has accepted there. Slots our own learner
+    has learned are dropped with `prune`.
+    """
+    current = None
+
+    @classmethod
+    def initialize(cls):
+        cls.current = Slots()
+
+    def __init__(self):
+        # In the order the slots were first seen, which is close to slot
+        # order, so `prune` only has to look at the front.
+        self.promised = collections.OrderedDict()  # slot -> highest ballot id promised
+        self.accepted = collections.OrderedDict()  # slot -> highest numbered prepare accepted
+
+    def allows(self, prepare):
+        """
+        Whether no higher ballot than `prepare`'s has been promised in its
+        slot. Unslotted prepares always are.
+        """
+        return prepare.slot is None or prepare.id >= self.promised.get(prepare.slot, prepare.id)
+
+    def promise(self, prepare):
+        if prepare.slot is not None and self.allows(prepare):
+            self.promised[prepare.slot] = prepare.id
+
+    def accept(self, prepare):
+        if prepare.slot is not None and self.allows(prepare):
+            self.promised[prepare.slot] = prepare.id
+            self.accepted[prepare.slot] = prepare
+
+    def rejection(self, prepare):
+        """
+        The response turning `prepare` away: the ballot promised in its slot.
+        """
+        return Promise(prepare=Prepare(id=self.promised[prepare.slot], key=prepare.key, slot=prepare.slot))
+
+    def prune(self, below):
+        for slots in (self.promised, self.accepted):
+            while slots and next(iter(slots)) < below:
+                slots.popitem(last=False)
+
 
 class Promise(Phase):
+    __slots__ = ()
     endpoint = '/promise'
 
     @classmethod
     def from_response(cls, response):
-        resp = json.loads(response.body)
+        resp = codec.decode(response)
         prepare = resp.get('prepare')
         if prepare:
             return Promise(
@@ -189,6 +377,14 @@ class Promise(Phase):
 
 
 class Promises(Phase):
+    """
+    Promises by key and ballot id.
+
+    Alongside the promises themselves we keep, per key, the ids in sorted
+    order and the highest one, plus a heap over every key's highest id. So
+    the highest promise for a key is O(1), the highest overall is O(log n)
+    amortized, and lookups never change the container.
+    """
     current = None
     completed = None
 
@@ -199,31 +395,65 @@ class Promises(Phase):
 
     # noinspection PyMissingConstructor
     def __init__(self, promises=None):
-        self.promises = collections.defaultdict(dict)
+        self.clear()
         if promises is None:
             return
         for promise in promises:
-            self.promises[promise.prepare.key][promise.prepare.id] = promise
-
-    def prefetch(self):
-        # Get lots of promises here.
-        pass
+            self.add(promise)
 
     def clear(self):
-        self.promises = collections.defaultdict(dict)
+        self.promises = {}  # key -> {id: promise}
+        self.ids = {}  # key -> ids, ascending
+        self.highest = {}  # key -> highest id
+        self.heap = []  # (-id, tiebreak, key), may hold stale entries
+        self.pushes = itertools.count()
+
+    def compact(self):
+        """
+        Drops everything but the highest numbered promise for each key.
+        """
+        for key, id in self.highest.items():
+            if len(self.ids[key]) > 1:
+                self.promises[key] = {id: self.promises[key][id]}
+                self.ids[key] = [id]
+
+    def latest(self):
+        return [self.promises[key][id] for key, id in self.highest.items()]
 
     def __contains__(self, promise):
         key = promise.prepare.key
         id = promise.prepare.id
         return key in self.promises and id in self.promises[key]
 
+    def __len__(self):
+        return sum(len(ids) for ids in self.ids.values())
+
     def remove(self, prepare):
+        key, id = prepare.key, prepare.id
         try:
-            del self.promises[prepare.key][prepare.id]
-            if not self.promises[prepare.key]:
-                del self.promises[prepare.key]
+            del self.promises[key][id]
         except KeyError:
             logger.warning("Already removed promise %s", prepare)
+            return
+        ids = self.ids[key]
+        del ids[bisect.bisect_left(ids, id)]
+        if not ids:
+            del self.promises[key]
+            del self.ids[key]
+            del self.highest[key]
+        elif self.highest[key] == id:
+            self.highest[key] = ids[-1]
+            self.push(key, ids[-1])
+
+    def forget_slot(self, prepare):
+        """
+        Drops the promises for `prepare`'s key in its slot that are numbered
+        below it: once a higher ballot is promised in the slot they can no
+        longer be accepted there, so there is nothing left to repair.
+        """
+        for id, promise in list(self.promises.get(prepare.key, {}).items()):
+            if promise.prepare.slot == prepare.slot and id < prepare.id:
+                self.remove(promise.prepare)
 
     @classmethod
     def from_responses(cls, responses):
@@ -232,42 +462,120 @@ class Promises(Phase):
         return Promises([p for p in promises if p.prepare is not None])
 
     def highest_promise_for_key(self, key):
-        promises = self.promises[key]
-        if promises:
-            return promises[max(promises)]
+        id = self.highest.get(key)
+        if id is not None:
+            return self.promises[key][id]
 
     def highest_numbered(self, key=None):
-        highest = None
         if key:
             return self.highest_promise_for_key(key)
-        for key in self.promises:
-            promise = self.highest_promise_for_key(key)
-            if promise.prepare:
-                if not highest:
-                    highest = promise
-                elif highest.prepare.id < promise.prepare.id:
-                    highest = promise
-        return highest
+        while self.heap:
+            neg_id, _, key = self.heap[0]
+            if self.highest.get(key) == -neg_id:
+                return self.promises[key][-neg_id]
+            heapq.heappop(self.heap)  # Stale: removed or superseded.
+        return None
 
     def add(self, promise):
-        self.promises[promise.prepare.key][promise.prepare.id] = promise
+        key, id = promise.prepare.key, promise.prepare.id
+        if key not in self.promises:
+            self.promises[key] = {}
+            self.ids[key] = []
+        promises, ids = self.promises[key], self.ids[key]
+        if id not in promises:
+            if not ids or ids[-1] < id:
+                ids.append(id)
+            else:
+                bisect.insort(ids, id)
+        promises[id] = promise
+        if key not in self.highest or self.highest[key] < id:
+            self.highest[key] = id
+            self.push(key, id)
+
+    def push(self, key, id):
+        heapq.heappush(self.heap, (-id, next(self.pushes), key))
+        if len(self.heap) > 2 * len(self.highest) + 64:  # Too many stale entries; rebuild.
+            self.heap = [(-top, next(self.pushes), k) for k, top in self.highest.items()]
+            heapq.heapify(self.heap)
 
     def get(self, key):
-        if not self.promises[key]:
-            return
-        id = max(self.promises[key])  # Returns the maximum value by id. Introspection has it wrong.
-        return self.promises[key][id]
+        return self.highest_promise_for_key(key)
 
 
 class Propose(Phase):
+    __slots__ = ()
     endpoint = '/propose'
 
 
 class Accept(Phase):
+    __slots__ = ()
     endpoint = '/accept'
 
 
+class Accepted(Phase):
+    """
+    Sent by an acceptor straight to every learner once it has accepted
+    `prepare`, when DIRECT_LEARN is on. `acceptor` is its port.
+    """
+    __slots__ = ('acceptor',)
+    endpoint = '/accepted'
+
+    def __init__(self, prepare=None, acceptor=None):
+        self.prepare = prepare
+        self.acceptor = acceptor
+
+    def to_json(self):
+        return {
+            'prepare': self.prepare.to_json(),
+            'acceptor': self.acceptor,
+        }
+
+    @classmethod
+    def from_request(cls, request):
+        js = codec.decode(request)
+        return cls(prepare=Prepare(**js['prepare']), acceptor=js.get('acceptor'))
+
+
+class Skip(Phase):
+    """
+    Mencius: agent number `owner` of `owners` won't propose in any of its
+    slots from `start` up to `stop`, so learners can treat them as no-ops.
+    """
+    __slots__ = ('owner', 'owners', 'start', 'stop')
+    endpoint = '/skip'
+
+    def __init__(self, owner, owners, start, stop):
+        super(Skip, self).__init__()
+        self.owner = owner
+        self.owners = owners
+        self.start = start
+        self.stop = stop
+
+    def slots(self):
+        first = self.start + (self.owner - self.start) % self.owners
+        return range(first, self.stop, self.owners)
+
+    def to_json(self):
+        return {'owner': self.owner, 'owners': self.owners, 'start': self.start, 'stop': self.stop}
+
+    @classmethod
+    def from_request(cls, request):
+        js = codec.decode(request)
+        return cls(js['owner'], js['owners'], js['start'], js['stop'])
+
+
+class Recover(Phase):
+    """
+    Phase 1 for a single log slot, before filling it: asks for a promise
+    on the prepare's ballot in its slot, and for the highest numbered value
+    accepted there (or the value learned there, as a `Success`).
+    """
+    __slots__ = ()
+    endpoint = '/recover'
+
+
 class Learn(Phase):
+    __slots__ = ()
     endpoint = '/learn'
 
     def __repr__(self):
@@ -275,10 +583,22 @@ class Learn(Phase):
 
 
 class Success(Phase):
+    """
+    `outcome`, when set, says what applying the write did to its key: see
+    `KeyValueState`.
+    """
+    __slots__ = ('outcome',)
+
+    def __init__(self, prepare=None, outcome=None):
+        super(Success, self).__init__(prepare=prepare)
+        self.outcome = outcome
 
     def to_json(self):
-        return {
+        js = {
             'prepare': self.prepare.to_json(),
             'status': 'SUCCESS',
         }
+        if self.outcome is not None:
+            js['outcome'] = self.outcome
+        return js
 
@@ -0,0 +1,78 @@
+import logging
+
+import tornado.gen
+import tornado.locks
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+NOOP = 'noop'
+
+
+class Pipeline:
+    """
+    Lets the leader keep up to `window` log instances in flight at once.
+
+    Every proposal is given the next log slot when it is admitted, so the
+    learners can put them back in order no matter which instance finishes
+    first. A slot whose proposal fails is handed to `fill`, which gets it
+    decided so that it doesn't hold back the slots behind it.
+
+    With `rotate`, the slots are shared out round-robin between a group's
+    agents (Mencius) and we only hand out our own: those congruent to
+    `owner` modulo `owners`.
+    """
+
+    def __init__(self, commit, window, first_slot=0, fill=None):
+        self.commit = commit
+        self.fill = fill
+        self.window = window
+        self.next_slot = first_slot
+        self.in_flight = 0
+        self.semaphore = tornado.locks.Semaphore(window)
+        self.owner = 0
+        self.owners = 1
+
+    def rotate(self, owner, owners):
+        self.owner = owner
+        self.owners = owners
+
+    def owns(self, slot):
+        return slot % self.owners == self.owner
+
+    def assign(self, prepare, floor=0):
+        slot = max(self.next_slot, floor)
+        prepare.slot = slot + (self.owner - slot) % self.owners
+        self.next_slot = prepare.slot + 1
+        return prepare
+
+    def skip_to(self, slot):
+        """
+        Gives up the slots below `slot` we haven't handed out yet. Returns
+        the range `(start, stop)` given up, or None if there were none.
+        """
+        if slot <= self.next_slot:
+            return None
+        start, self.next_slot = self.next_slot, slot
+        return start, slot
+
+    @tornado.gen.coroutine
+    def submit(self, prepare, floor=0):
+        """
+        Waits for room in the window, then commits `prepare` in the next
+        slot. `floor` is the lowest slot that may still be handed out, e.g.
+        the next slot our own learner expects.
+        """
+        with (yield self.semaphore.acquire()):
+            self.assign(prepare, floor=floor)
+            self.in_flight += 1
+            try:
+                committed = yield self.commit(prepare)
+            except Exception:
+                logger.error("Slot %s failed; filling it.", prepare.slot)
+                if self.fill is not None:
+                    yield self.fill(prepare)
+                raise
+            finally:
+                self.in_flight -= 1
+        raise tornado.gen.Return(committed)
@@ -1,6 +1,7 @@
+import datetime
 import logging
 import collections
-import json
+import time
 
 import tornado.httpclient
 import tornado.ioloop
@@ -10,33 +11,344 @@ import tornado.web
 import tornado.gen
 from tornado.options import options
 
+from paxos import codec
 from paxos.api import Handler
+from paxos.batcher import Batcher
+from paxos.contention import contention
+from paxos.metrics import IN_FLIGHT, LEARN_SECONDS, PREPARE_SECONDS, PROPOSE_SECONDS, WRITE_SECONDS, WRITES
+from paxos.learner import Learner
+from paxos.membership import RECONFIGURE
+from paxos.pipeline import NOOP, Pipeline
+from paxos.quorums import system as quorums
+from paxos.sharding import shards
 
 from paxos.models import (
     agents,
     Learn,
     MultiPrepare,
     MultiPromise,
+    MultiPromises,
     Prepare,
     Promise,
     Promises,
     Propose,
+    Recover,
+    Skip,
     Success
 )
+from settings import (
+    BATCH_LINGER, BATCH_MAX_SIZE, DIRECT_LEARN, DIRECT_LEARN_TIMEOUT, LEASE_DRIFT, LEASE_DURATION, MULTI_PAXOS,
+    OUTCOME_TIMEOUT, PIPELINE_WINDOW
+)
 
 logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
 logger = logging.getLogger('agent')
 
 
-def get_promises_for_key(key, start=None, stop=None):
+@tornado.gen.coroutine
+def get_promises_for_key(key, start=0):
+    """
+    Makes the initial request for all promises [start, inf) for a given `key`.
+
+    The acceptors respond with any promise they still have in progress for
+    the key, which we repair before using the range. Returns the held
+    `MultiPromise`, or None if some other proposer has a higher ballot.
+
+    With leases on, asking again for the range we already hold renews its
+    lease. Our copy of the lease is counted from before we sent the
+    request, less LEASE_DRIFT, so it always runs out before the acceptors'.
+    """
+    mp = MultiPrepare(key=key, start=start, lease=LEASE_DURATION or None)
+    sent_at = time.monotonic()
+    required = quorums.phase1(agents.all())
+    with PREPARE_SECONDS.time():
+        responses, issued, conflicting = yield mp.send(
+            agents.peers(excluding=options.port), required=required)
+    if conflicting or not required.reached(issued):
+        logger.warning("Could not acquire %s", mp)
+        raise tornado.gen.Return(None)
+
+    earlier_promise = Promises.from_responses(issued).highest_numbered(key)
+    if earlier_promise and earlier_promise not in Promises.current:  # Repair.
+        earlier = earlier_promise.prepare
+        if earlier.slot is not None:  # Something else may have been chosen in its slot since.
+            try:
+                yield recover(earlier.key, earlier.slot)
+            except tornado.web.HTTPError as e:
+                logger.warning("Could not recover slot %s: %s", earlier.slot, e)
+                raise tornado.gen.Return(None)
+        else:
+            if earlier.id < start:  # The acceptors only take ballots in our range now.
+                earlier = Prepare(key=earlier.key, predicate=earlier.predicate, argument=earlier.argument)
+            learned = yield accept_and_learn(earlier)
+            if not learned:
+                raise tornado.gen.Return(None)
+
+    expires = sent_at + mp.lease * (1 - LEASE_DRIFT) if mp.lease else None
+    multi_promise = MultiPromise(mp, expires=expires)
+    MultiPromises.held.add(multi_promise)
+    raise tornado.gen.Return(multi_promise)
+
+
+@tornado.gen.coroutine
+def read_lease(key):
+    """
+    Makes sure we hold an unexpired lease on `key`, taking or renewing it
+    if we have to. While we do, no other proposer can get a value chosen
+    for the key, so our learner's view of it is up to date. Returns the
+    held `MultiPromise`, or None if we couldn't get the lease.
+    """
+    if not LEASE_DURATION:
+        raise tornado.gen.Return(None)
+    held = MultiPromises.held.get(key)
+    if held is not None and held.leased():
+        raise tornado.gen.Return(held)
+    start = held.prepare.start if held is not None else Prepare().id
+    held = yield get_promises_for_key(key, start=start)
+    if held is None:
+        MultiPromises.held.remove(key)
+    raise tornado.gen.Return(held)
+
+
+@tornado.gen.coroutine
+def accept_and_learn(prepare):
+    """
+    Runs Phase 2 for `prepare` and, once a quorum accepts, has every agent
+    learn it. Returns False if the proposal was pre-empted.
+    """
+    required = quorums.phase2(agents.all())
+    with PROPOSE_SECONDS.time():
+        responses, issued, conflicting = yield Propose(prepare=prepare).send(
+            agents.peers(excluding=options.port), required=required)
+    if not required.reached(issued):
+        if conflicting:
+            raise tornado.gen.Return(False)
+        raise tornado.web.HTTPError(status_code=500,
+                                    log_message='Failed to acquire quorum on Accept')
+    logger.info("Got success for propose %s. Learning...", prepare)
+    learned = yield learn(prepare)
+    if not learned:
+        raise tornado.web.HTTPError(status_code=500,
+                                    log_message='Failed to acquire quorum on Learn')
+    raise tornado.gen.Return(True)
+
+
+@tornado.gen.coroutine
+def learn(prepare):
+    """
+    Has every agent learn `prepare` once a quorum has accepted it. With
+    DIRECT_LEARN the acceptors have already told the learners, so we only
+    wait until we have learned it ourselves. Returns whether it worked.
+    """
+    if DIRECT_LEARN:
+        try:
+            with LEARN_SECONDS.time():
+                yield tornado.gen.with_timeout(datetime.timedelta(seconds=DIRECT_LEARN_TIMEOUT),
+                                               Learner.wait_for(prepare))
+        except tornado.gen.TimeoutError:
+            logger.error("Didn't learn %s within %ss", prepare, DIRECT_LEARN_TIMEOUT)
+            Learner.waiting.pop((prepare.key, prepare.id), None)
+            raise tornado.gen.Return(False)
+        raise tornado.gen.Return(True)
+    members = len(agents.all())  # Learning a reconfiguration can change it under us.
+    with LEARN_SECONDS.time():
+        successes = yield Learn(prepare).fanout(expected=Success)
+    if len(successes) != members:
+        logger.error("Got %s successes with a required quorum of %s", len(successes), members)
+        raise tornado.gen.Return(False)
+    raise tornado.gen.Return(True)
+
+
+@tornado.gen.coroutine
+def commit(prepare):
+    """
+    Runs a full Prepare/Propose/Learn round for `prepare`, retrying with a
+    new ballot when pre-empted. Returns the prepare that was learned.
+
+    Retries back off for a random, growing time and use a ballot above the
+    highest competing one we heard about.
+    """
+    learned = False
+    attempt = 0
+    prepares = collections.deque([prepare])
+    Promises.current.add(Promise(prepare=prepare))
+    peers = agents.peers(excluding=options.port)
+    phase1 = quorums.phase1(agents.all())
+    phase2 = quorums.phase2(agents.all())
+    while prepares:  # TODO: Timeout here.
+        prepare = prepares.popleft()
+        logger.info("Sending prepare for %s", prepare)
+        with PREPARE_SECONDS.time():
+            responses, issued, conflicting = yield prepare.send(peers, required=phase1)
+        logger.info("Got %s issued and %s conflicting", len(issued), len(conflicting))
+        if conflicting:  # Issue another promise.
+            logger.warning("%s was pre-empted by a higher ballot. retrying.", prepare.id)
+            attempt += 1
+            contention.conflict(prepare.key, conflicting)
+            yield contention.backoff(prepare.key, attempt)
+            prepares.append(
+                Prepare(key=prepare.key,
+                        predicate=prepare.predicate,
+                        argument=prepare.argument,
+                        slot=prepare.slot))
+            continue
+        elif not phase1.reached(issued):
+            raise tornado.web.HTTPError(status_code=500,
+                                        log_message='FAILED to acquire quorum on Promise')
+        promises = Promises.from_responses(issued)
+        earlier_promise = promises.highest_numbered()
+        if earlier_promise and earlier_promise not in Promises.current:  # Repair.
+            prepares.append(prepare)
+            prepare = earlier_promise.prepare
+
+        # Now we have a promise.
+        with PROPOSE_SECONDS.time():
+            responses, issued, conflicting = yield Propose(prepare=prepare).send(peers, required=phase2)
+        if phase2.reached(issued):
+            logger.info("Got success for propose %s. Learning...", prepare)
+            learned = yield learn(prepare)
+        elif conflicting:
+            logger.error("Conflicting promise detected. Will re-issue.")
+            contention.conflict(prepare.key, conflicting)
+        else:
+            raise tornado.web.HTTPError(status_code=500,
+                                        log_message='Failed to acquire quorum on Accept')
+
+    if learned:
+        Promises.current.remove(prepare)
+        raise tornado.gen.Return(prepare)
+    raise tornado.web.HTTPError(status_code=500,
+                                log_message='Failed to acquire quorum on Learn')
+
+
+@tornado.gen.coroutine
+def commit_as_leader(prepare):
+    """
+    Multi-Paxos: once we hold a promise over the key's open-ended range we
+    go straight to Propose. If a higher ballot pre-empts us, we drop the
+    range and fall back to a full round.
     """
-    Makes the initial request for all promises [0, inf] for a given `key`.
+    held = MultiPromises.held.get(prepare.key)
+    if held is not None and prepare.id < held.prepare.start:
+        # Queued before we took the range; give it a ballot inside it.
+        prepare = Prepare(key=prepare.key,
+                          predicate=prepare.predicate,
+                          argument=prepare.argument,
+                          slot=prepare.slot)
+    if held is None or not held.covers(prepare):
+        held = yield get_promises_for_key(prepare.key, start=prepare.id)
+    if held is not None:
+        learned = yield accept_and_learn(prepare)
+        if learned:
+            raise tornado.gen.Return(prepare)
+        logger.warning("Lost the lead on %s to a higher ballot.", prepare.key)
+        MultiPromises.held.remove(prepare.key)
+        prepare = Prepare(key=prepare.key,
+                          predicate=prepare.predicate,
+                          argument=prepare.argument,
+                          slot=prepare.slot)
+    prepare = yield commit(prepare)
+    raise tornado.gen.Return(prepare)
+
+
+@tornado.gen.coroutine
+def commit_instance(prepare):
+    IN_FLIGHT.inc()
+    try:
+        prepare = yield choose_commit(prepare)(prepare)
+    finally:
+        IN_FLIGHT.dec()
+    WRITES.inc()
+    raise tornado.gen.Return(prepare)
+
+
+def choose_commit(prepare):
+    # Once we hold a key's range (e.g. for a read lease) our own Prepares
+    # for it would be turned away, so its writes go through the range too.
+    if MULTI_PAXOS or MultiPromises.held.get(prepare.key) is not None:
+        return commit_as_leader
+    return commit
 
-    The acceptor will respond with the
+
+@tornado.gen.coroutine
+def recover(key, slot):
+    """
+    Runs Phase 1 for `slot` alone and gets whatever may have been chosen
+    there learned, under our ballot: the value an agent has learned in
+    the slot, else the highest numbered value an acceptor accepted there,
+    else a no-op. Returns the prepare learned; raises if it couldn't.
     """
-    mp = MultiPrepare(key=key)
-    quorum = agents.quorum(excluding=options.port)
-    Promises.current.add(MultiPromise(mp))
+    ballot = Prepare(key=key, predicate=NOOP, slot=slot)
+    required = quorums.phase1(agents.all())
+    with PREPARE_SECONDS.time():
+        responses, issued, conflicting = yield Recover(prepare=ballot).send(
+            agents.peers(excluding=options.port), required=required)
+    if conflicting:
+        contention.conflict(key, conflicting)
+        raise tornado.web.HTTPError(status_code=500, log_message='Recovering slot {} was pre-empted'.format(slot))
+    if not required.reached(issued):
+        raise tornado.web.HTTPError(status_code=500, log_message='Failed to acquire quorum on Recover')
+    chosen = [Success.from_response(resp).prepare for resp in issued
+              if codec.decode(resp).get('status') == 'SUCCESS']
+    accepted = Promises.from_responses(issued).highest_numbered()
+    value = chosen[0] if chosen else accepted.prepare if accepted else ballot
+    prepare = Prepare(id=ballot.id, key=value.key, predicate=value.predicate, argument=value.argument, slot=slot)
+    logger.info("Filling slot %s with %s", slot, prepare)
+    learned = yield accept_and_learn(prepare)
+    if not learned:
+        raise tornado.web.HTTPError(status_code=500, log_message='Recovering slot {} was pre-empted'.format(slot))
+    raise tornado.gen.Return(prepare)
+
+
+@tornado.gen.coroutine
+def fill(prepare):
+    """
+    Gets the slot of `prepare`, whose commit failed, decided so that it
+    doesn't hold back the slots after it. The write may still have been
+    chosen there, so the slot is recovered rather than given a no-op
+    outright. Keeps trying, backing off in between, until it works.
+    """
+    attempt = 0
+    while True:
+        try:
+            filled = yield recover(prepare.key, prepare.slot)
+        except tornado.web.HTTPError as e:
+            attempt += 1
+            logger.error("Could not fill slot %s: %s", prepare.slot, e)
+            yield contention.backoff(prepare.key, attempt)
+            continue
+        raise tornado.gen.Return(filled)
+
+
+pipeline = Pipeline(commit_instance, window=PIPELINE_WINDOW, fill=fill)
+
+
+def propose(prepare):
+    """
+    Commits `prepare` in the next log slot when pipelining, otherwise as a
+    standalone instance.
+    """
+    if pipeline.window:
+        return pipeline.submit(prepare, floor=Learner.next_slot)
+    return commit_instance(prepare)
+
+
+def skip_past(slot):
+    """
+    Mencius: once another agent is proposing in `slot`, gives up our own
+    slots below it that we haven't handed out, telling every agent to learn
+    them as no-ops. Returns the running `Fanout`, or None if there was
+    nothing to give up.
+    """
+    if pipeline.owns(slot):
+        return None
+    given_up = pipeline.skip_to(slot)
+    if given_up is None:
+        return None
+    return Skip(pipeline.owner, pipeline.owners, *given_up).broadcast(agents.all())
+
+
+batcher = Batcher(propose, max_size=BATCH_MAX_SIZE, linger=BATCH_LINGER)
 
 
 class Proposer(Handler):
@@ -50,50 +362,20 @@ class Proposer(Handler):
             argument: <str|int>
         }
         """
-        successes = []
-        request = json.loads(self.request.body)
-        prepare = Prepare(**request)
-        prepares = collections.deque([prepare])
-        Promises.current.add(Promise(prepare=prepare))
-        quorum = agents.quorum(excluding=options.port)
-        while prepares:  # TODO: Timeout here.
-            prepare = prepares.popleft()
-            logging.info("Sending prepare for %s", prepare)
-            send_response = yield prepare.send(quorum)
-            responses, issued, conflicting = send_response
-            logger.info("Got %s issued and %s conflicting", len(issued), len(conflicting))
-            logger.info("Response codes: %s", ", ".join([str(r.code) for r in responses]))
-            if conflicting:  # Issue another promise.
-                logger.warning("%s was pre-empted by a higher ballot. retrying.".format(prepare.id))
-                prepares.append(
-                    Prepare(key=prepare.key,
-                            predicate=prepare.predicate,
-                            argument=prepare.argument))
-                continue
-            elif len(issued) != len(quorum):
-                raise tornado.web.HTTPError(status_code=500,
-                                            log_message='FAILED to acquire quorum on Promise')
-            promises = Promises.from_responses(responses)
-            earlier_promise = promises.highest_numbered()
-            if earlier_promise and earlier_promise not in Promises.current:  # Repair.
-                prepares.append(prepare)
-                prepare = earlier_promise.prepare
-
-            # Now we have a promise.
-            responses, issued, conflicting = yield Propose(prepare=prepare).send(quorum)
-            if len(issued) == len(quorum):
-                logger.info("Got success for propose %s. Learning...", prepare)
-                successes = yield Learn(prepare).fanout(expected=Success)
-            elif conflicting:
-                logger.error("Conflicting promise detected. Will re-issue.")
+        with WRITE_SECONDS.time():
+            request = codec.decode(self.request)
+            if not shards.owns(options.port, request.get('key')):
+                raise tornado.web.HTTPError(status_code=400,
+                                            log_message='Key belongs to another shard; use the router')
+            if request.get('predicate') == RECONFIGURE:
+                raise tornado.web.HTTPError(status_code=400, log_message='Reconfigure through /reconfigure')
+            if batcher.max_size > 1:
+                prepare, position = yield batcher.submit(request)
             else:
-                raise tornado.web.HTTPError(status_code=500,
-                                            log_message='Failed to acquire quorum on Accept')
-
-        if len(successes) == len(agents.all()):
-            Promises.current.remove(prepare)
-            self.respond(Success(prepare))
-        else:
-            logger.error("Got %s successes with a required quorum of %s", len(successes), len(agents.all()))
-            raise tornado.web.HTTPError(status_code=500,
-                                        log_message='Failed to acquire quorum on Learn')
+                prepare, position = (yield propose(Prepare(**request))), 0
+            try:
+                outcome = yield Learner.outcome(prepare, position, timeout=OUTCOME_TIMEOUT)
+            except tornado.gen.TimeoutError:
+                raise tornado.web.HTTPError(status_code=504, log_message='{} was learned but not applied within '
+                                                                         '{}s'.format(prepare, OUTCOME_TIMEOUT))
+            self.respond(Success(prepare, outcome=outcome))
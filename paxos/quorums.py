@@ -0,0 +1,171 @@
+from settings import PHASE1_QUORUM, PHASE2_QUORUM, QUORUM_GRID
+
+
+def peers(members, proposer=None):
+    """
+    The agents a proposer on port `proposer` sends its Prepares and
+    Proposes to. It doesn't count its own acceptor, so quorums have to be
+    within reach of the others.
+    """
+    return [agent for agent in members if agent.port != proposer]
+
+
+class Count:
+    """
+    Any `size` agents.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def reached(self, issued):
+        return len(issued) >= self.size
+
+    def covers(self, ports):
+        return len(set(ports)) >= self.size
+
+    def __repr__(self):
+        return "<Count size={}>".format(self.size)
+
+
+class AnyRow:
+    """
+    Every agent in at least one row of the grid.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def reached(self, issued):
+        return self.covers(resp.agent.port for resp in issued)
+
+    def covers(self, ports):
+        ports = set(ports)
+        return any(ports.issuperset(row) for row in self.rows)
+
+
+class EveryRow:
+    """
+    At least one agent from each row of the grid.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def reached(self, issued):
+        return self.covers(resp.agent.port for resp in issued)
+
+    def covers(self, ports):
+        ports = set(ports)
+        return all(ports.intersection(row) for row in self.rows)
+
+
+class Majority:
+    """
+    The classic rule: more than half of the agents, in both phases.
+    """
+
+    def check(self, members, proposer=None):
+        if self.phase1(members).size > len(peers(members, proposer)):
+            raise ValueError("A majority of the {} agents is out of reach without {}'s own acceptor".format(
+                len(members), proposer))
+
+    def phase1(self, members):
+        return Count(int(len(members) / 2) + 1)
+
+    def phase2(self, members):
+        return self.phase1(members)
+
+
+class Flexible:
+    """
+    Flexible Paxos: Phase 1 needs `q1` agents and Phase 2 needs `q2`. Only
+    a Phase 1 quorum has to meet every Phase 2 quorum, so q1 + q2 > n is
+    enough. A small q2 makes the steady-state writes cheaper, at the price
+    of a bigger Phase 1 when the leader changes.
+    """
+
+    def __init__(self, q1, q2):
+        if q1 < 1 or q2 < 1:
+            raise ValueError("Quorums need at least one agent")
+        self.q1 = q1
+        self.q2 = q2
+
+    def check(self, members, proposer=None):
+        if self.q1 + self.q2 <= len(members):
+            raise ValueError("Phase 1 quorums of {} and Phase 2 quorums of {} don't intersect with {} agents".format(
+                self.q1, self.q2, len(members)))
+        reachable = len(peers(members, proposer))
+        if max(self.q1, self.q2) > reachable:
+            raise ValueError("Quorums can't be bigger than the {} agents {} sends to".format(reachable, proposer))
+
+    def phase1(self, members):
+        return Count(self.q1)
+
+    def phase2(self, members):
+        return Count(self.q2)
+
+
+class Grid:
+    """
+    Arranges the agents' ports in `rows`. Phase 1 needs a whole row and
+    Phase 2 one agent from every row, so they always share an agent. With
+    r rows of c agents a write waits on r acceptors instead of (r * c) / 2.
+    """
+
+    def __init__(self, rows):
+        if not rows or not all(rows):
+            raise ValueError("A grid needs at least one agent in every row")
+        self.rows = [set(row) for row in rows]
+
+    def check(self, members, proposer=None):
+        ports = {agent.port for agent in members}
+        missing = set().union(*self.rows) - ports
+        if missing:
+            raise ValueError("Ports {} in the grid aren't agents".format(sorted(missing)))
+        if all(proposer in row for row in self.rows):
+            raise ValueError("Every row holds {}, so it can never gather a whole row".format(proposer))
+        if {proposer} in self.rows:
+            raise ValueError("{} is alone in its row, so it can never reach every row".format(proposer))
+
+    def phase1(self, members):
+        return AnyRow(self.rows)
+
+    def phase2(self, members):
+        return EveryRow(self.rows)
+
+
+def get(phase1=None, phase2=None, grid=None):
+    if grid is not None:
+        return Grid(grid)
+    if phase1 is not None or phase2 is not None:
+        if phase1 is None or phase2 is None:
+            raise ValueError("Set both PHASE1_QUORUM and PHASE2_QUORUM")
+        return Flexible(phase1, phase2)
+    return Majority()
+
+
+class Current:
+    """
+    The quorum system in force. Modules hold on to this one object, so
+    `use` can swap the rules underneath them when the cluster is
+    reconfigured.
+    """
+
+    def __init__(self, system):
+        self.system = system
+
+    def use(self, system):
+        self.system = system
+
+    def check(self, members, proposer=None):
+        self.system.check(members, proposer=proposer)
+
+    def phase1(self, members):
+        return self.system.phase1(members)
+
+    def phase2(self, members):
+        return self.system.phase2(members)
+
+
+system = Current(get(PHASE1_QUORUM, PHASE2_QUORUM, QUORUM_GRID))
@@ -0,0 +1,106 @@
+import json
+import logging
+
+import tornado.gen
+import tornado.httpclient
+
+from paxos.catchup import catchup
+from paxos.learner import Learner
+from paxos.metrics import registry
+from paxos.models import agents, Learn, Prepare
+from settings import SUBSCRIBE_TIMEOUT
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+RECEIVED = registry.counter('paxos_replica_entries_total', 'Log entries a learner-only replica has received.')
+RESTORES = registry.counter('paxos_replica_snapshots_total', 'Snapshots a learner-only replica has started from.')
+
+
+class Subscriber:
+    """
+    Keeps a learner-only replica's log in step with one member's.
+
+    We hold a /subscribe stream open to a member and learn each entry as it
+    arrives, resubscribing from where we got to whenever the member ends
+    the stream. If it fails we move on to the next member. Log offsets are
+    only comparable between agents for slotted logs, so when we switch
+    members after having learned anything we start again from the new
+    member's snapshot, as we also do when the offset we need has been
+    compacted.
+
+    Replicas aren't members, so they never answer Prepare or Propose and
+    aren't sent Learns.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.upstream = None  # Port of the member we follow.
+        self.buffer = b''
+
+    @staticmethod
+    def offset():
+        return Learner.base + len(Learner.ordered_rounds)
+
+    @tornado.gen.coroutine
+    def run(self):
+        failures = 0
+        while True:
+            members = agents.all()
+            member = next((a for a in members if a.port == self.upstream), members[failures % len(members)])
+            followed = yield self.follow(member)
+            if followed:
+                failures = 0
+                continue
+            self.upstream = None
+            failures += 1
+            yield tornado.gen.sleep(min(1.0, 0.05 * failures))
+
+    @tornado.gen.coroutine
+    def follow(self, member):
+        """
+        Subscribes to `member` until it ends the stream. Resolves to whether
+        it is worth subscribing to it again.
+        """
+        if member.port != self.upstream and (Learner.learned or Learner.base):
+            restored = yield self.restore(member)
+            if not restored:
+                raise tornado.gen.Return(False)
+        self.upstream = member.port
+        self.buffer = b''
+        url = '{}:{}/subscribe?offset={}'.format(member.url, member.port, self.offset())
+        try:
+            resp = yield tornado.httpclient.AsyncHTTPClient().fetch(tornado.httpclient.HTTPRequest(
+                url, streaming_callback=self.receive, request_timeout=2 * self.timeout), raise_error=False)
+        except OSError as e:
+            logger.info("Lost %s: %s", member, e)
+            raise tornado.gen.Return(False)
+        if resp.code == 410:
+            logger.info("%s has compacted offset %s", member, self.offset())
+            restored = yield self.restore(member)
+            raise tornado.gen.Return(restored)
+        if resp.code != 200:
+            logger.info("%s answered %s to /subscribe", member, resp.code)
+        raise tornado.gen.Return(resp.code == 200)
+
+    def receive(self, chunk):
+        lines = (self.buffer + chunk).split(b'\n')
+        self.buffer = lines.pop()
+        lines = [line for line in lines if line]
+        for line in lines:
+            Learner.learn(Learn(prepare=Prepare(**json.loads(line)['prepare'])))
+        RECEIVED.inc(len(lines))
+
+    @tornado.gen.coroutine
+    def restore(self, member):
+        resp = yield catchup.get(member, '/snapshot')
+        if resp is None:
+            raise tornado.gen.Return(False)
+        snapshot = json.loads(resp.body)
+        logger.warning("Starting over from %s's snapshot at offset %s", member, snapshot['base'])
+        Learner.restore(snapshot)
+        RESTORES.inc()
+        raise tornado.gen.Return(True)
+
+
+subscriber = Subscriber(SUBSCRIBE_TIMEOUT)
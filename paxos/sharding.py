@@ -0,0 +1,59 @@
+import bisect
+import zlib
+
+from settings import SHARD_BOUNDARIES, SHARDS
+
+
+class Shards:
+    """
+    Splits the key space over independent Paxos groups, each with its own
+    agents, leader and state.
+
+    Keys are hash partitioned by default. With `boundaries`, a sorted list
+    of one split key fewer than there are groups, they are range
+    partitioned instead: group i holds the keys below boundaries[i].
+    """
+
+    def __init__(self, groups, boundaries=None):
+        if boundaries is not None and len(boundaries) != len(groups) - 1:
+            raise ValueError("Need exactly one boundary between each pair of shards")
+        self.groups = groups
+        self.boundaries = boundaries
+
+    def index(self, key):
+        key = '' if key is None else str(key)
+        if self.boundaries is not None:
+            return bisect.bisect_right(self.boundaries, key)
+        return zlib.crc32(key.encode('utf-8')) % len(self.groups)
+
+    def group(self, key):
+        return self.groups[self.index(key)]
+
+    def proposer(self, key, spread=False):
+        """
+        The agent that should lead writes to `key`: its group's distinguished
+        proposer (the first agent), or with `spread` (for Mencius) one
+        picked by the key, so the load is shared out but all of a key's
+        writes still go to the same agent.
+        """
+        group = self.group(key)
+        if not spread:
+            return group[0]
+        key = '' if key is None else str(key)
+        return group[zlib.adler32(key.encode('utf-8')) % len(group)]
+
+    def group_of(self, port):
+        for group in self.groups:
+            if port in group:
+                return group
+        return None
+
+    def owns(self, port, key):
+        """
+        Whether the agent on `port` belongs to the group that holds `key`.
+        Agents outside every group (e.g. in tests) own everything.
+        """
+        return self.group_of(port) is None or port in self.group(key)
+
+
+shards = Shards(SHARDS, SHARD_BOUNDARIES)
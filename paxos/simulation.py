@@ -0,0 +1,403 @@
+"""
+A deterministic, in-memory network for running a whole cluster in one
+process on a virtual clock.
+
+`Network` is a transport like `HTTPTransport`: hand it to `Agent` and
+messages are delivered to the other agents' handlers after a simulated
+latency instead of over a socket. It can drop messages, hold some of them
+back so they arrive out of order, slow agents down and partition them.
+Everything random comes from one seeded `random.Random`, and the clock
+only moves when nothing is left to run, so a run is the same every time
+for the same seed, however long it simulates.
+
+Agents keep their state at class level, so only the proposer's state is
+live; the other agents' state is swapped in around each message they
+handle. That needs every handler to finish without waiting on anything,
+so the write-ahead log must be off. Leases and the phase histograms
+still read the wall clock.
+
+The acceptor and learner handlers are `bare`: they are called directly
+with a stand-in that carries the request and records the response,
+rather than through tornado's request machinery. Every message still
+runs through the real coroutines, codecs and event loop, though, so a
+three agent cluster manages about 600 consensus instances per second of
+wall time, not hundreds of thousands.
+"""
+import asyncio
+import logging
+import random
+import selectors
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.httputil
+import tornado.ioloop
+import tornado.platform.asyncio
+import tornado.web
+from tornado.options import options
+
+from paxos import codec
+from paxos import quorums
+from paxos.contention import contention
+from paxos.learner import Learner
+from paxos.membership import Membership
+from paxos.metrics import Histogram
+from paxos.models import Agent, agents, MultiPromises, Prepare, Promises, Slots
+from paxos.proposer import propose
+from paxos.transport import Exchange, StreamResponse
+from settings import AGENT_URL
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+LEARNER_STATE = ('ordered_rounds', 'completed_rounds', 'next_slot', 'out_of_order', 'base', 'learned',
+                 'key_index', 'tallies', 'waiting', 'state')
+
+
+def constant(seconds):
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+
+def exponential(mean):
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+
+def lognormal(median, sigma):
+    return lambda rng: median * rng.lognormvariate(0.0, sigma)
+
+
+class VirtualSelector(selectors.SelectSelector):
+    """
+    Never blocks. When the loop would wait for its next timer, the clock
+    jumps straight to it instead.
+    """
+
+    def __init__(self):
+        super(VirtualSelector, self).__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        ready = super(VirtualSelector, self).select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            raise RuntimeError("The simulation stalled: nothing is scheduled")
+        self.now += timeout
+        return ready
+
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+
+    def __init__(self):
+        self.clock = VirtualSelector()
+        super(VirtualLoop, self).__init__(selector=self.clock)
+
+    def time(self):
+        return self.clock.now
+
+
+class VirtualIOLoop(tornado.platform.asyncio.AsyncIOLoop):
+    """
+    Tornado reads the wall clock by default; this reads the virtual one.
+    """
+
+    def time(self):
+        return self.asyncio_loop.time()
+
+
+def capture():
+    """
+    The class-level state of whichever agent is installed right now.
+    """
+    state = {name: getattr(Learner, name) for name in LEARNER_STATE}
+    state.update(port=options.port, promises=Promises.current, completed=Promises.completed,
+                 granted=MultiPromises.granted, held=MultiPromises.held, slots=Slots.current,
+                 config=Membership.config, pending=Membership.pending, voting=Membership.voting,
+                 members=agents.all(), quorums=quorums.system.system)
+    return state
+
+
+def install(state):
+    for name in LEARNER_STATE:
+        setattr(Learner, name, state[name])
+    options.port = state['port']
+    Promises.current = state['promises']
+    Promises.completed = state['completed']
+    MultiPromises.granted = state['granted']
+    MultiPromises.held = state['held']
+    Slots.current = state['slots']
+    Membership.config = state['config']
+    Membership.pending = state['pending']
+    Membership.voting = state['voting']
+    agents.update(state['members'])
+    quorums.system.use(state['quorums'])
+
+
+def blank(port):
+    """
+    State for an agent on `port` that hasn't seen anything yet.
+    """
+    saved = capture()
+    Learner.reset()
+    Promises.initialize()
+    MultiPromises.initialize()
+    Slots.initialize()
+    Membership.reset()
+    state = capture()
+    state['port'] = port
+    install(saved)
+    return state
+
+
+class Message:
+    """
+    The parts of a request that `codec.decode` reads.
+    """
+    __slots__ = ('headers', 'body')
+
+    def __init__(self, content_type, body):
+        self.headers = {'Content-Type': content_type}
+        self.body = body
+
+
+class Call:
+    """
+    Stands in for the RequestHandler when running a `bare` handler.
+    """
+
+    def __init__(self, content_type, body):
+        self.request = Message(content_type, body)
+        self.response = None
+
+    def respond(self, message, code=200):
+        response_codec = codec.get(self.request.headers['Content-Type'])
+        self.response = (code, response_codec.content_type, response_codec.encode(message.to_json()))
+
+
+def handle(application, endpoint, content_type, body):
+    """
+    Runs a message through `application`'s handler for `endpoint` and
+    returns `(code, content type, body)`. The handler has to finish
+    before this returns.
+    """
+    routes = application.settings.setdefault('simulated_routes', {})
+    if endpoint not in routes:
+        delegate = application.find_handler(tornado.httputil.HTTPServerRequest(method='POST', uri=endpoint))
+        routes[endpoint] = delegate.handler_class, delegate.handler_kwargs
+    handler_class, handler_kwargs = routes[endpoint]
+    exchange = None
+    if getattr(handler_class, 'bare', False):
+        handler = Call(content_type, body)
+    else:
+        exchange = Exchange()
+        request = tornado.httputil.HTTPServerRequest(
+            method='POST', uri=endpoint, body=body, connection=exchange,
+            headers=tornado.httputil.HTTPHeaders({'Content-Type': content_type}))
+        handler = handler_class(application, request, **handler_kwargs)
+        handler._transforms = []  # Normally set by RequestHandler._execute, which we skip.
+    try:
+        handler_class.prepare(handler)  # Every prepare() we have is synchronous.
+    except tornado.web.HTTPError as e:
+        return e.status_code, 'text/plain', b''
+    result = handler_class.post(handler)
+    if exchange is None:
+        response = handler.response
+    else:
+        response = exchange.future.result() if exchange.future.done() else None
+    if response is None:
+        if result is not None and result.done() and result.exception() is not None:
+            error = result.exception()
+            logger.warning("Handling %s failed: %s", endpoint, error)
+            return getattr(error, 'status_code', 500), 'text/plain', b''
+        raise RuntimeError("{} didn't finish at once; the simulation needs the write-ahead log off".format(endpoint))
+    return response
+
+
+class SimulatedAgent:
+    """
+    One agent on the simulated network. `state` is None for the agent
+    whose state is the live class-level state.
+    """
+
+    def __init__(self, port, application, state=None):
+        self.port = port
+        self.application = application
+        self.state = state
+
+    def handle(self, endpoint, content_type, body):
+        if self.state is None:
+            return handle(self.application, endpoint, content_type, body)
+        saved = capture()
+        install(self.state)
+        try:
+            return handle(self.application, endpoint, content_type, body)
+        finally:
+            self.state = capture()
+            install(saved)
+
+    def learner(self):
+        """
+        This agent's learner state, by the names of `Learner`'s attributes.
+        """
+        return capture() if self.state is None else self.state
+
+
+class Network:
+    """
+    Delivers each message after `latency(rng)` seconds, and its response
+    after another. A `reorder` fraction of messages is held back for up to
+    `reorder_delay` more. A lost message (one of the `drop` fraction, or
+    one between partitioned agents) leaves the sender waiting `timeout`
+    seconds for a 599, like an HTTP client timing out.
+    """
+
+    def __init__(self, seed=0, latency=None, drop=0.0, reorder=0.0, reorder_delay=0.01, timeout=1.0):
+        self.random = random.Random(seed)
+        self.latency = latency or constant(0.0005)
+        self.drop = drop
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.timeout = timeout
+        self.agents = {}
+        self.slow = {}
+        self.groups = None
+        self.stats = {'sent': 0, 'delivered': 0, 'lost': 0}
+
+    def add(self, simulated):
+        self.agents[simulated.port] = simulated
+
+    def partition(self, *groups):
+        """
+        Only agents in the same group can reach each other until `heal`.
+        """
+        self.groups = [set(group) for group in groups]
+
+    def heal(self):
+        self.groups = None
+
+    def slow_down(self, port, factor):
+        """
+        Multiplies the latency of everything to and from `port`.
+        """
+        self.slow[port] = factor
+
+    def connected(self, source, target):
+        return self.groups is None or any(source in group and target in group for group in self.groups)
+
+    def lost(self, source, target):
+        return not self.connected(source, target) or (self.drop and self.random.random() < self.drop)
+
+    def delay(self, source, target):
+        delay = self.latency(self.random) * max(self.slow.get(source, 1), self.slow.get(target, 1))
+        if self.reorder and self.random.random() < self.reorder:
+            delay += self.random.uniform(0, self.reorder_delay)
+        return delay
+
+    def send(self, agent, endpoint, content_type, body):
+        future = tornado.concurrent.Future()
+        source, target = options.port, agent.port
+        io_loop = tornado.ioloop.IOLoop.current()
+        deadline = io_loop.time() + self.timeout
+        self.stats['sent'] += 1
+        if target not in self.agents or self.lost(source, target):
+            self.time_out(io_loop, deadline, future)
+        else:
+            io_loop.call_later(self.delay(source, target), self.deliver,
+                               source, target, endpoint, content_type, body, deadline, future)
+        return future
+
+    def deliver(self, source, target, endpoint, content_type, body, deadline, future):
+        self.stats['delivered'] += 1
+        code, response_type, response = self.agents[target].handle(endpoint, content_type, body)
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self.lost(target, source):
+            self.time_out(io_loop, deadline, future)
+        else:
+            io_loop.call_later(self.delay(target, source), future.set_result,
+                               StreamResponse(code, response_type, response))
+
+    def time_out(self, io_loop, deadline, future):
+        self.stats['lost'] += 1
+        io_loop.call_at(max(deadline, io_loop.time()), future.set_result, StreamResponse(599, 'text/plain', b''))
+
+
+class Simulation:
+    """
+    A cluster of `ports` in this process, talking over `network`. The first
+    port is the proposer. `close` puts back the state that was live before.
+    """
+
+    def __init__(self, application, ports, network):
+        self.network = network
+        self.ports = list(ports)
+        self.saved = capture()
+        self.saved_ids = Prepare._id, Prepare._stride
+        agents.update([Agent(AGENT_URL, port, transport=network) for port in self.ports])
+        install(blank(self.ports[0]))
+        Prepare._id, Prepare._stride = 0, 1
+        contention.random.seed(network.random.random())
+        contention.stats = {}
+        for i, port in enumerate(self.ports):
+            network.add(SimulatedAgent(port, application, state=None if i == 0 else blank(port)))
+
+    def close(self):
+        install(self.saved)
+        Prepare._id, Prepare._stride = self.saved_ids
+
+    def run(self, func):
+        """
+        Runs `func` to completion on a fresh virtual clock.
+        """
+        io_loop = VirtualIOLoop(asyncio_loop=VirtualLoop())
+        try:
+            return io_loop.run_sync(func)
+        finally:
+            io_loop.close(all_fds=True)
+
+    def workload(self, instances, concurrency=1, keys=1):
+        """
+        Commits `instances` writes through the proposer, `concurrency` at a
+        time, spread over `keys` keys. Returns the results as a dict.
+        """
+        latency = Histogram('simulated_write_seconds')
+        counts = {'committed': 0, 'failed': 0}
+        remaining = iter(range(instances))
+
+        @tornado.gen.coroutine
+        def client():
+            io_loop = tornado.ioloop.IOLoop.current()
+            for i in remaining:
+                started = io_loop.time()
+                try:
+                    yield propose(Prepare(key='key-{}'.format(i % keys), predicate='set', argument=i))
+                except Exception as e:
+                    logger.info("Instance %s failed: %s", i, e)
+                    counts['failed'] += 1
+                    continue
+                counts['committed'] += 1
+                latency.observe(io_loop.time() - started)
+
+        @tornado.gen.coroutine
+        def drive():
+            yield [client() for _ in range(concurrency)]
+            raise tornado.gen.Return(tornado.ioloop.IOLoop.current().time())
+
+        started = time.monotonic()
+        simulated = self.run(drive)
+        wall = time.monotonic() - started
+        results = {
+            'instances': instances,
+            'simulated_seconds': simulated,
+            'wall_seconds': wall,
+            'throughput': counts['committed'] / simulated if simulated else 0.0,
+            'instances_per_wall_second': instances / wall if wall else 0.0,
+            'network': dict(self.network.stats),
+        }
+        results.update(counts)
+        results.update({'p{}'.format(p): latency.quantile(p / 100.0) for p in (50, 99)})
+        return results
@@ -0,0 +1,120 @@
+import concurrent.futures
+import json
+import logging
+import os
+
+import tornado.gen
+import tornado.ioloop
+
+from paxos.wal import WriteAheadLog
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+
+def estimate(value):
+    """
+    Roughly how many bytes `value` takes as JSON, without encoding it.
+    """
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, dict):
+        return 2 + sum(estimate(k) + estimate(v) + 2 for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 2 + sum(estimate(v) + 2 for v in value)
+    return 8
+
+
+# The field names and punctuation of a serialized Prepare.
+ENTRY_OVERHEAD = 64
+
+
+def to_json(state):
+    """
+    A snapshot as it's stored, from the learner state `Learner.capture`
+    returns.
+    """
+    return {
+        'base': state['base'],
+        'learned': state['learned'],
+        'next_slot': state['next_slot'],
+        'latest': [learn.prepare.to_json() for learn in state['latest']],
+        'ids': state['ids'],
+        'out_of_order': [learn.prepare.to_json() for learn in state['out_of_order']],
+        'state': state['state'],
+        'membership': state['membership'],
+    }
+
+
+class Snapshots:
+    """
+    Periodically writes the learner's state to `path` and truncates the
+    log entries it covers.
+
+    A snapshot is due once `max_entries` entries, or `max_bytes` bytes of
+    serialized values, have been learned since the last one. It is written
+    from a background thread; the learner is only truncated, and the
+    write-ahead log compacted, once the file is safely on disk.
+    """
+    current = None
+
+    @classmethod
+    def initialize(cls, path=None, max_entries=None, max_bytes=None):
+        cls.current = Snapshots(path, max_entries, max_bytes) if path else None
+
+    def __init__(self, path, max_entries=None, max_bytes=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.running = False
+        self.taken = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def observe(self, learner, learn):
+        """
+        Called for every learned value. Starts a snapshot when one is due.
+        """
+        if self.max_bytes:
+            prepare = learn.prepare
+            self.size += ENTRY_OVERHEAD + estimate(prepare.key) + estimate(prepare.predicate) + estimate(
+                prepare.argument)
+        if self.running:
+            return
+        if (self.max_entries and len(learner.ordered_rounds) >= self.max_entries) or (
+                self.max_bytes and self.size >= self.max_bytes):
+            self.running = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self.take, learner)
+
+    @tornado.gen.coroutine
+    def take(self, learner):
+        self.running = True
+        try:
+            state = learner.capture()
+            yield tornado.ioloop.IOLoop.current().run_in_executor(
+                self.executor, self.write, state)
+            learner.truncate(state)
+            if WriteAheadLog.current is not None:
+                yield WriteAheadLog.current.compact(learner.journal())
+            self.size = 0
+            self.taken += 1
+            logger.info("Snapshot at log offset %s written to %s", state['base'], self.path)
+        except Exception as e:
+            logger.error("Failed to write snapshot to %s: %s", self.path, e)
+        finally:
+            self.running = False
+
+    def write(self, state):
+        data = json.dumps(to_json(state))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
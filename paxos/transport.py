@@ -0,0 +1,272 @@
+import datetime
+import logging
+import struct
+import urllib.parse
+
+import tornado.concurrent
+import tornado.gen
+import tornado.httpclient
+import tornado.httputil
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpclient
+import tornado.tcpserver
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+# length of the rest of the frame, request id, status (0 for requests), meta length
+FRAME = struct.Struct('!IIHH')
+MAX_ID = 2 ** 32 - 1
+
+
+def done(result=None):
+    future = tornado.concurrent.Future()
+    future.set_result(result)
+    return future
+
+
+class HTTPTransport:
+    """
+    One HTTP request per message, through AsyncHTTPClient.
+    """
+
+    @tornado.gen.coroutine
+    def send(self, agent, endpoint, content_type, body):
+        http_client = tornado.httpclient.AsyncHTTPClient()
+        request = tornado.httpclient.HTTPRequest(
+            url=agent.url + ':' + str(agent.port) + endpoint,
+            method='POST',
+            headers={'Content-Type': content_type},
+            body=body
+        )
+        resp = yield http_client.fetch(request, raise_error=False)
+        raise tornado.gen.Return(resp)
+
+
+class StreamResponse:
+    """
+    Quacks like the parts of `tornado.httpclient.HTTPResponse` we use.
+    """
+
+    def __init__(self, code, content_type, body):
+        self.code = code
+        self.headers = tornado.httputil.HTTPHeaders({'Content-Type': content_type})
+        self.body = body
+
+    def __repr__(self):
+        return "<StreamResponse code={}>".format(self.code)
+
+
+def pack(request_id, status, meta, body):
+    meta = meta.encode('utf-8')
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return FRAME.pack(FRAME.size - 4 + len(meta) + len(body), request_id, status, len(meta)) + meta + body
+
+
+@tornado.gen.coroutine
+def read_frame(stream):
+    header = yield stream.read_bytes(FRAME.size)
+    length, request_id, status, meta_length = FRAME.unpack(header)
+    rest = yield stream.read_bytes(length - (FRAME.size - 4))
+    meta = rest[:meta_length].decode('utf-8')
+    raise tornado.gen.Return((request_id, status, meta, rest[meta_length:]))
+
+
+class Connection:
+    """
+    A persistent, multiplexed connection to one peer. Requests are tagged
+    with an id so responses can come back in any order. If the connection
+    drops, the requests waiting on it fail and the next send reconnects. A
+    request that gets no response within `timeout` seconds fails on its
+    own.
+    """
+
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.stream = None
+        self.connecting = None
+        self.pending = {}
+        self.last_id = 0
+
+    @tornado.gen.coroutine
+    def connect(self):
+        if self.stream is not None and not self.stream.closed():
+            raise tornado.gen.Return(self.stream)
+        if self.connecting is None:
+            self.connecting = tornado.gen.convert_yielded(
+                tornado.tcpclient.TCPClient().connect(self.host, self.port))
+        try:
+            stream = yield self.connecting
+        finally:
+            self.connecting = None
+        if self.stream is not stream:
+            logger.info("Connected to %s:%s", self.host, self.port)
+            stream.set_nodelay(True)
+            self.stream = stream
+            tornado.ioloop.IOLoop.current().spawn_callback(self.read, stream)
+        raise tornado.gen.Return(stream)
+
+    @tornado.gen.coroutine
+    def read(self, stream):
+        try:
+            while True:
+                request_id, status, content_type, body = yield read_frame(stream)
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(StreamResponse(status, content_type, body))
+        except Exception as e:
+            logger.warning("Lost connection to %s:%s: %s", self.host, self.port, e)
+            stream.close()
+            self.fail(e)
+
+    def fail(self, error):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def next_id(self):
+        """
+        The next request id, wrapping around to fit the frame's 32 bits and
+        passing over any still waiting for a response.
+        """
+        while True:
+            self.last_id = self.last_id % MAX_ID + 1
+            if self.last_id not in self.pending:
+                return self.last_id
+
+    @tornado.gen.coroutine
+    def send(self, endpoint, content_type, body):
+        stream = yield self.connect()
+        request_id = self.next_id()
+        future = tornado.concurrent.Future()
+        self.pending[request_id] = future
+        try:
+            stream.write(pack(request_id, 0, endpoint + '\n' + content_type, body))
+            if self.timeout:
+                future = tornado.gen.with_timeout(datetime.timedelta(seconds=self.timeout), future)
+            resp = yield future
+        finally:
+            self.pending.pop(request_id, None)
+        raise tornado.gen.Return(resp)
+
+
+class StreamTransport:
+    """
+    Sends messages over one persistent, length-framed TCP connection per
+    peer instead of an HTTP request each. The peer's `StreamServer` listens
+    on its HTTP port plus `port_offset`. Requests time out after
+    `timeout` seconds, like an HTTP request's.
+    """
+
+    def __init__(self, port_offset, timeout=None):
+        self.port_offset = port_offset
+        self.timeout = timeout
+        self.connections = {}
+
+    def connection(self, agent):
+        host = urllib.parse.urlparse(agent.url).hostname
+        port = agent.port + self.port_offset
+        if (host, port) not in self.connections:
+            self.connections[(host, port)] = Connection(host, port, timeout=self.timeout)
+        return self.connections[(host, port)]
+
+    def send(self, agent, endpoint, content_type, body):
+        return self.connection(agent).send(endpoint, content_type, body)
+
+
+class Exchange(tornado.httputil.HTTPConnection):
+    """
+    Stands in for the HTTP connection so a frame can be run through the
+    application's normal request handlers. `future` resolves to the
+    handler's response.
+    """
+
+    def __init__(self):
+        self.future = tornado.concurrent.Future()
+        self.code = None
+        self.content_type = None
+        self.chunks = []
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        self.code = start_line.code
+        self.content_type = headers.get('Content-Type', '')
+        return self.write(chunk, callback=callback)
+
+    def write(self, chunk, callback=None):
+        if chunk:
+            self.chunks.append(chunk)
+        if callback is not None:
+            callback()
+        return done()
+
+    def finish(self):
+        if not self.future.done():
+            self.future.set_result((self.code, self.content_type, b''.join(self.chunks)))
+
+
+class StreamServer(tornado.tcpserver.TCPServer):
+    """
+    Serves the framed protocol by handing every request to `application`,
+    so the same handlers answer both transports.
+    """
+
+    def __init__(self, application, **kwargs):
+        super(StreamServer, self).__init__(**kwargs)
+        self.application = application
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        stream.set_nodelay(True)
+        try:
+            while True:
+                request_id, _, meta, body = yield read_frame(stream)
+                endpoint, content_type = meta.split('\n', 1)
+                tornado.ioloop.IOLoop.current().spawn_callback(
+                    self.dispatch, stream, request_id, endpoint, content_type, body)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    @tornado.gen.coroutine
+    def dispatch(self, stream, request_id, endpoint, content_type, body):
+        try:
+            code, response_type, response = yield self.run(endpoint, content_type, body)
+        except Exception as e:
+            logger.error("Failed to handle %s over the stream: %s", endpoint, e)
+            code, response_type, response = 500, 'text/plain', b''
+        if not stream.closed():
+            stream.write(pack(request_id, code, response_type, response))
+
+    @tornado.gen.coroutine
+    def run(self, endpoint, content_type, body):
+        exchange = Exchange()
+        delegate = self.application.start_request(None, exchange)
+        headers = tornado.httputil.HTTPHeaders({'Host': '127.0.0.1',
+                                                'Content-Type': content_type,
+                                                'Content-Length': str(len(body))})
+        started = delegate.headers_received(
+            tornado.httputil.RequestStartLine('POST', endpoint, 'HTTP/1.1'), headers)
+        if started is not None:
+            yield started
+        received = delegate.data_received(body)
+        if received is not None:
+            yield received
+        delegate.finish()
+        result = yield exchange.future
+        raise tornado.gen.Return(result)
+
+
+HTTP = HTTPTransport()
+
+
+def get(name, port_offset=None, timeout=None):
+    if name == 'stream':
+        return StreamTransport(port_offset, timeout=timeout)
+    return HTTP
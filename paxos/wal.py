@@ -0,0 +1,174 @@
+import concurrent.futures
+import json
+import logging
+import os
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+from paxos.models import MultiPromises, Prepare, Promises, Slots
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('agent')
+
+PROMISE = 'promise'
+ACCEPT = 'accept'
+MULTI_PROMISE = 'multipromise'
+PREEMPT = 'preempt'
+SLOT_PROMISE = 'slotpromise'
+LEARN = 'learn'
+
+
+class WriteAheadLog:
+    """
+    An append-only journal of acceptor and learner state changes.
+
+    Records are buffered and written by a single background thread. While
+    one fsync is running, every record appended in the meantime waits for
+    the next one, so concurrent requests share a flush instead of paying
+    for one each.
+
+    Once a snapshot covers the learned values, `compact` rewrites the log
+    as just the state it still has to restore, so it doesn't grow without
+    bound.
+    """
+    current = None
+
+    @classmethod
+    def initialize(cls, path=None):
+        cls.current = WriteAheadLog(path) if path else None
+
+    def __init__(self, path):
+        self.path = path
+        self.repair()
+        self.file = open(path, 'ab')
+        self.buffer = []
+        self.waiters = []
+        self.flushing = False
+        self.flushes = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def append(self, record):
+        """
+        Queues `record` and returns a future that resolves once it is on
+        disk.
+        """
+        future = tornado.concurrent.Future()
+        self.buffer.append(json.dumps(record) + '\n')
+        self.waiters.append(future)
+        if not self.flushing:
+            self.flushing = True
+            tornado.ioloop.IOLoop.current().add_callback(self.flush)
+        return future
+
+    @tornado.gen.coroutine
+    def flush(self):
+        while self.buffer:
+            data = ''.join(self.buffer).encode('utf-8')
+            waiters = self.waiters
+            self.buffer, self.waiters = [], []
+            try:
+                yield tornado.ioloop.IOLoop.current().run_in_executor(
+                    self.executor, self.write, data)
+            except Exception as e:
+                logger.error("Failed to write %s records to %s: %s", len(waiters), self.path, e)
+                for waiter in waiters:
+                    waiter.set_exception(e)
+                continue
+            self.flushes += 1
+            for waiter in waiters:
+                waiter.set_result(None)
+        self.flushing = False
+
+    def repair(self):
+        """
+        Cuts off a torn record at the end (from a crash mid-write), so the
+        next record isn't appended onto it.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            size = end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - 4096)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                logger.warning("Truncating a torn record at the end of %s", self.path)
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+
+    @tornado.gen.coroutine
+    def compact(self, learns):
+        """
+        Replaces the log with the promises and leases we have granted, the
+        slots we still vote in and `learns`, the learned values no snapshot
+        covers yet. Records
+        appended before this are still written, after the new log; they
+        are already part of the state it holds, and replaying them again
+        is harmless.
+        """
+        records = [{'type': PROMISE, 'prepare': promise.prepare.to_json()}
+                   for promises in Promises.current.promises.values()
+                   for promise in promises.values()]
+        records += [{'type': MULTI_PROMISE, 'prepare': promise.prepare.to_json()}
+                    for promise in MultiPromises.granted.promises.values()]
+        if Slots.current is not None:
+            records += [{'type': ACCEPT, 'prepare': prepare.to_json()} for prepare in Slots.current.accepted.values()]
+            records += [{'type': SLOT_PROMISE, 'prepare': Prepare(id=id, slot=slot).to_json()}
+                        for slot, id in Slots.current.promised.items()]
+        records += [{'type': LEARN, 'prepare': learn.prepare.to_json()} for learn in learns]
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        yield tornado.ioloop.IOLoop.current().run_in_executor(self.executor, self.replace, data)
+        logger.info("Compacted %s to %s records", self.path, len(records))
+
+    def replace(self, data):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.file.close()
+        self.file = open(self.path, 'ab')
+
+    def write(self, data):
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def records(self):
+        """
+        Yields every record in the log, oldest first. A torn record at the
+        end (from a crash mid-write) is skipped.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    yield json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logger.warning("Skipping torn record in %s", self.path)
+
+    def close(self):
+        self.file.close()
+        self.executor.shutdown(wait=True)
+
+
+def log(type, **fields):
+    """
+    Journals one state change. Resolves immediately when there's no log.
+    """
+    if WriteAheadLog.current is None:
+        future = tornado.concurrent.Future()
+        future.set_result(None)
+        return future
+    fields['type'] = type
+    return WriteAheadLog.current.append(fields)
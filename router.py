@@ -0,0 +1,119 @@
+import logging
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.options
+import tornado.process
+import tornado.web
+import tornado.gen
+from tornado.options import define, options
+
+from paxos import codec
+from paxos.sharding import shards
+
+from settings import AGENT_URL, MENCIUS, TORNADO_SETTINGS
+
+define("port", default=8888, help="run on the given port", type=int)
+define("processes", default=1, help="number of router processes; 0 for one per core", type=int)
+
+logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
+logger = logging.getLogger('router')
+
+FORWARDED_HEADERS = ['Content-Type', 'X-Next-Offset']
+
+
+class Forwarder(tornado.web.RequestHandler):
+
+    @tornado.gen.coroutine
+    def forward(self, port, method, body=None):
+        """
+        Sends this request on to the agent on `port`.
+        """
+        request = tornado.httpclient.HTTPRequest(
+            url=AGENT_URL + ':' + str(port) + self.request.uri,
+            method=method,
+            headers={'Content-Type': self.request.headers.get('Content-Type', 'application/json')},
+            body=body)
+        resp = yield tornado.httpclient.AsyncHTTPClient().fetch(request, raise_error=False)
+        raise tornado.gen.Return(resp)
+
+    def relay(self, resp):
+        self.set_status(resp.code if resp.code != 599 else 502)
+        for header in FORWARDED_HEADERS:
+            if header in resp.headers:
+                self.set_header(header, resp.headers[header])
+        if resp.body:
+            self.write(resp.body)
+        self.finish()
+
+
+class WriteRouter(Forwarder):
+
+    @tornado.gen.coroutine
+    def post(self):
+        key = codec.decode(self.request).get('key')
+        resp = yield self.forward(shards.proposer(key, spread=MENCIUS), 'POST', body=self.request.body)
+        self.relay(resp)
+
+
+class ReadRouter(Forwarder):
+
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        A read for one key goes to that key's shard. A read without a key
+        is answered by every shard in turn; offsets are then per shard.
+        """
+        key = self.get_argument('key', None)
+        if key is not None:
+            resp = yield self.forward(shards.proposer(key, spread=MENCIUS), 'GET')
+            self.relay(resp)
+            return
+        self.set_header('Content-Type', 'application/json')
+        for group in shards.groups:
+            resp = yield self.forward(group[0], 'GET')
+            if resp.code != 200:
+                raise tornado.web.HTTPError(status_code=502,
+                                            log_message='Shard {} failed to read'.format(group))
+            self.write(resp.body)
+            yield self.flush()
+        self.finish()
+
+
+class GetRouter(Forwarder):
+
+    @tornado.gen.coroutine
+    def get(self):
+        resp = yield self.forward(shards.proposer(self.get_argument('key', None), spread=MENCIUS), 'GET')
+        self.relay(resp)
+
+
+def get_app(**settings):
+    return tornado.web.Application([
+        (r"/read", ReadRouter),
+        (r"/get", GetRouter),
+        (r"/write", WriteRouter),
+    ], **dict(TORNADO_SETTINGS, **settings))
+
+
+def main():
+    """
+    Routes client requests to the shard that owns their key. Run as many
+    of these as you like; they hold no state.
+    """
+    tornado.options.parse_command_line()
+    sockets = tornado.netutil.bind_sockets(options.port)
+    if options.processes != 1:
+        tornado.process.fork_processes(options.processes)
+    # Autoreload can't restart forked children.
+    app = get_app() if options.processes == 1 else get_app(autoreload=False)
+    http_server = tornado.httpserver.HTTPServer(app)
+    http_server.add_sockets(sockets)
+    logger.info("Routing %s shards on port %s", len(shards.groups), options.port)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,117 @@
 AGENT_PORTS = [9999, 9998, 9997]
 AGENT_URL = 'http://127.0.0.1'
 
+# Independent Paxos groups, each a list of agent ports. Keys are hashed
+# over the groups, or split at SHARD_BOUNDARIES (one fewer than there are
+# groups) when given. router.py sends each request to the right group.
+SHARDS = [AGENT_PORTS]
+SHARD_BOUNDARIES = None
+
 TORNADO_SETTINGS = {'autoreload': True}
 
+# Hold an open-ended promise per key and skip Phase 1 for later writes.
+MULTI_PAXOS = False
+
+# Writes to the same key arriving within BATCH_LINGER seconds of each other
+# are committed together, up to BATCH_MAX_SIZE per ballot. 1 turns it off.
+BATCH_MAX_SIZE = 1
+BATCH_LINGER = 0.002
+
+# /write answers with what applying the write did (its `outcome`, e.g.
+# 'rejected' for a failed cas) once the proposer's own log has got that
+# far. If that takes more than OUTCOME_TIMEOUT seconds it answers 504.
+OUTCOME_TIMEOUT = 1.0
+
+# How many log slots the leader keeps in flight at once. 0 turns off slot
+# numbering and pipelining.
+PIPELINE_WINDOW = 0
+
+# Mencius: share the log slots out round-robin between a group's agents, so
+# each can lead writes in its own slots without dueling the others. An
+# agent that sees a proposal for a later slot gives up its unused slots
+# below it as no-ops. Needs PIPELINE_WINDOW > 0.
+MENCIUS = False
+
+# Where each agent journals its promises, accepts and learned values so a
+# restart doesn't lose them. Overridden per agent with --wal. None keeps
+# everything in memory only.
+WAL_PATH = None
+
+# Where each agent snapshots its learned state (overridden with --snapshot).
+# A snapshot is taken, and the log entries it covers dropped from memory,
+# once SNAPSHOT_ENTRIES entries or SNAPSHOT_BYTES bytes of values have been
+# learned since the last one. None never compacts.
+SNAPSHOT_PATH = None
+SNAPSHOT_ENTRIES = 100000
+SNAPSHOT_BYTES = 64 * 1024 * 1024
+
+# Content-Type agents use to talk to each other: 'application/json', or
+# 'application/x-paxos' for the compact binary encoding. Agents answer in
+# whatever encoding they were sent, so mixed clusters keep working.
+WIRE_CODEC = 'application/json'
+
+# How agents reach each other: 'http' sends one HTTP request per message,
+# 'stream' keeps one framed TCP connection open per peer, on the peer's
+# port + STREAM_PORT_OFFSET. A message that gets no response over the
+# stream within STREAM_TIMEOUT seconds fails, as an HTTP request would.
+TRANSPORT = 'http'
+STREAM_PORT_OFFSET = 1000
+STREAM_TIMEOUT = 20.0
+
+# /read flushes to the client every READ_CHUNK_SIZE entries.
+READ_CHUNK_SIZE = 500
+
+# Learner-only replicas (agent.py --learner) follow a member's log through
+# /subscribe, which sends up to SUBSCRIBE_BATCH entries per write as they
+# are learned. Each subscription is ended after SUBSCRIBE_TIMEOUT seconds
+# and the replica resubscribes, so a member that disappears is noticed.
+SUBSCRIBE_BATCH = 1000
+SUBSCRIBE_TIMEOUT = 30.0
+
+# How long, in seconds, acceptors promise the leader of a key not to accept
+# any other ballot for it, so the leader can answer linearizable reads on
+# its own. The leader stops trusting its lease LEASE_DRIFT (a fraction)
+# early, to allow for clocks running at different rates. 0 turns leases off.
+LEASE_DURATION = 0
+LEASE_DRIFT = 0.1
+
+# Flexible Paxos. Set both to have Phase 1 (Prepare) wait on PHASE1_QUORUM
+# acceptors and Phase 2 (Propose) on PHASE2_QUORUM; they must add up to
+# more than the number of agents. Or set QUORUM_GRID to rows of agent
+# ports: Phase 1 then needs a whole row and Phase 2 one agent per row.
+# None for all three means a majority in both phases.
+PHASE1_QUORUM = None
+PHASE2_QUORUM = None
+QUORUM_GRID = None
+
+# Ballots are unique across agents: each agent gets a node number below
+# BALLOT_STRIDE and only uses the ids congruent to it. Must be more than
+# the number of agents in SHARDS; agents that join take the numbers above
+# theirs.
+BALLOT_STRIDE = 64
+
+# A proposer whose ballot is turned down waits a random time of up to
+# BACKOFF_BASE * 2 ** attempt seconds, but never more than BACKOFF_MAX,
+# before it tries again.
+BACKOFF_BASE = 0.005
+BACKOFF_MAX = 1.0
+
+# Acceptors send what they accept straight to every learner, which learns
+# a value once a Phase 2 quorum has accepted it. The proposer answers as
+# soon as it has learned the value itself (or fails after
+# DIRECT_LEARN_TIMEOUT seconds), instead of running a separate Learn round.
+DIRECT_LEARN = False
+DIRECT_LEARN_TIMEOUT = 1.0
+
+# Agents that have fallen behind (missed Learns, or just restarted) pull
+# the slots they are missing from their peers, CATCHUP_BATCH per request
+# and at most CATCHUP_RATE per second, or a peer's snapshot if it has
+# already compacted them. They check every CATCHUP_INTERVAL seconds; 0
+# turns it off. Only slotted logs (PIPELINE_WINDOW > 0) have gaps to find.
+CATCHUP_INTERVAL = 5.0
+CATCHUP_BATCH = 1000
+CATCHUP_RATE = 10000
+
+# How often, in seconds, an agent started with --join pulls from its peers
+# until it has caught up to the reconfiguration that adds it and can vote.
+JOIN_CATCHUP_INTERVAL = 0.1
@@ -0,0 +1,71 @@
+"""
+Runs a cluster in this process over a simulated network and prints the
+results as one JSON object. Time is virtual, so a run with a one second
+timeout costs no more wall time than one without, and a run is repeated
+exactly by passing the same --seed.
+
+    python simulate.py --agents=5 --instances=10000 --drop=0.01 --slow=9997 --slow_factor=10
+
+See paxos/simulation.py for what is and isn't simulated.
+"""
+import json
+
+import tornado.options
+from tornado.options import define, options
+
+from agent import get_app
+from paxos import simulation
+
+define("agents", default=3, help="number of agents", type=int)
+define("instances", default=10000, help="consensus instances to run", type=int)
+define("concurrency", default=16, help="instances in flight at once", type=int)
+define("keys", default=1000, help="number of distinct keys", type=int)
+define("distribution", default="exponential", help="latency distribution: constant, uniform, exponential or lognormal",
+       type=str)
+define("latency", default=0.0005, help="mean (median for lognormal) one-way latency in seconds", type=float)
+define("sigma", default=0.5, help="shape of the lognormal distribution", type=float)
+define("drop", default=0.0, help="fraction of messages lost", type=float)
+define("reorder", default=0.0, help="fraction of messages held back", type=float)
+define("reorder_delay", default=0.01, help="longest a held back message waits, in seconds", type=float)
+define("timeout", default=1.0, help="seconds before a lost message counts as failed", type=float)
+define("slow", default=[], help="ports of agents that are slow", type=int, multiple=True)
+define("slow_factor", default=10.0, help="how many times slower the slow agents are", type=float)
+define("isolate", default=[], help="ports of agents partitioned from the rest", type=int, multiple=True)
+define("seed", default=0, help="random seed for the network", type=int)
+
+FIRST_PORT = 9000
+
+
+def latency():
+    if options.distribution == 'constant':
+        return simulation.constant(options.latency)
+    if options.distribution == 'uniform':
+        return simulation.uniform(0, 2 * options.latency)
+    if options.distribution == 'lognormal':
+        return simulation.lognormal(options.latency, options.sigma)
+    return simulation.exponential(options.latency)
+
+
+def main():
+    options.logging = 'error'  # Every message is a request; pass --logging=info to see them all.
+    tornado.options.parse_command_line()
+    ports = [FIRST_PORT + i for i in range(options.agents)]
+    network = simulation.Network(seed=options.seed, latency=latency(), drop=options.drop, reorder=options.reorder,
+                                 reorder_delay=options.reorder_delay, timeout=options.timeout)
+    for port in options.slow:
+        network.slow_down(port, options.slow_factor)
+    if options.isolate:
+        network.partition(options.isolate, [port for port in ports if port not in options.isolate])
+    sim = simulation.Simulation(get_app(), ports, network)
+    try:
+        results = sim.workload(options.instances, concurrency=options.concurrency, keys=options.keys)
+    finally:
+        sim.close()
+    results['config'] = {name: options[name] for name in
+                         ['agents', 'instances', 'concurrency', 'keys', 'distribution', 'latency', 'drop',
+                          'reorder', 'timeout', 'slow', 'slow_factor', 'isolate', 'seed']}
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
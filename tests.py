@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 from unittest import mock
 import json
@@ -6,12 +8,34 @@ import tornado.testing
 import tornado.gen
 import tornado.httpclient
 import tornado.concurrent
+import tornado.tcpserver
+import tornado.web
 
 import agent
+import benchmark
+from paxos import codec
+from paxos.batcher import BATCH, Batcher
+from paxos.catchup import CatchUp
+from paxos.contention import node_id
+from paxos.client import Client, ClientError
+from paxos.kv import KeyValueState
+from paxos.membership import Membership, RECONFIGURE
+from paxos.memory import bytes_per_entry
+from paxos.metrics import Histogram, PREPARE_SECONDS, Registry
+from paxos.pipeline import NOOP, Pipeline
+from paxos.proposer import fill
+from paxos import quorums
+from paxos.quorums import Flexible, Grid
+from paxos.replica import Subscriber
+from paxos.sharding import Shards
+from paxos.simulation import constant, Network, Simulation, VirtualIOLoop, VirtualLoop
+from paxos.snapshot import Snapshots, to_json
+from paxos.transport import Connection, FRAME, MAX_ID, read_frame, StreamResponse, StreamServer, StreamTransport
+from paxos.wal import LEARN, log, PROMISE, WriteAheadLog
 from paxos.learner import Learner
 from paxos.models import (
-    Accept, agents, Learn, Phase, Prepare, Promise,
-    Promises, Propose, Success
+    Accept, Accepted, Agent, agents, Learn, MultiPrepare, MultiPromise, MultiPromises,
+    Phase, Prepare, Promise, Promises, Propose, Recover, Skip, Slots, Success
 )
 
 
@@ -53,6 +77,7 @@ class TestPhase(tornado.testing.AsyncTestCase):
 
         fut = tornado.concurrent.Future()
         response = mock.Mock()
+        response.code = 200
         response.body = json.dumps(phase.to_json())
         fut.set_result(response)
 
@@ -66,6 +91,25 @@ class TestPhase(tornado.testing.AsyncTestCase):
             successes = yield phase.fanout(expected=Success)
             self.assertEqual(len(successes), len(agents.all()))
 
+    @tornado.testing.gen_test
+    def test_fanout_counts_unreachable_agents_as_failures(self):
+        phase = Phase(prepare=Prepare(id=1, key='foo', predicate='incr', argument=1))
+        phase.endpoint = '/testing'
+        ok = mock.Mock(code=200, body=json.dumps(phase.to_json()))
+        unreachable = mock.Mock(code=599, body=b'')
+        responses = iter([ok] + [unreachable] * len(agents.all()))
+
+        def fetch(*args, **kwargs):
+            fut = tornado.concurrent.Future()
+            fut.set_result(next(responses))
+            return fut
+
+        client = mock.Mock()
+        client.fetch = mock.Mock(side_effect=fetch)
+        with mock.patch('tornado.httpclient.AsyncHTTPClient', return_value=client):
+            successes = yield phase.fanout(expected=Success)
+        self.assertEqual(len(successes), 1)
+
     @tornado.testing.gen_test
     def test_fanout_raises_not_implemented(self):
         prepare = Prepare(id=1,
@@ -82,6 +126,7 @@ class TestPhase(tornado.testing.AsyncTestCase):
 
         fut = tornado.concurrent.Future()
         response = mock.Mock()
+        response.code = 200
         response.body = json.dumps(phase.to_json())
         fut.set_result(response)
 
@@ -96,6 +141,493 @@ class TestPhase(tornado.testing.AsyncTestCase):
             self.assertEqual(len(responses), len(agents.quorum()))
 
 
+class FakeAgent:
+
+    def __init__(self, port):
+        self.port = port
+        self.future = tornado.concurrent.Future()
+        self.sent = []
+
+    def send(self, message, body=None):
+        self.sent.append(message)
+        return self.future
+
+    def reply(self, code):
+        response = mock.Mock()
+        response.code = code
+        response.body = '{}'
+        self.future.set_result(response)
+
+
+class TestFanout(tornado.testing.AsyncTestCase):
+
+    def get_phase(self):
+        phase = Phase(prepare=Prepare(id=1, key='foo', predicate='incr', argument=1))
+        phase.endpoint = '/testing'
+        return phase
+
+    @tornado.testing.gen_test
+    def test_send_resolves_on_majority(self):
+        targets = [FakeAgent(port) for port in range(5)]
+        fanout = self.get_phase().broadcast(targets, required=3)
+        self.assertTrue(all(len(t.sent) == 1 for t in targets))
+        targets[4].reply(200)
+        targets[1].reply(200)
+        yield tornado.gen.moment
+        self.assertFalse(fanout.done.done())
+        targets[2].reply(200)
+        responses, issued, conflicting = yield fanout.done
+        self.assertEqual(len(issued), 3)
+        self.assertFalse(fanout.finished.done())
+
+        targets[0].reply(200)
+        targets[3].reply(400)
+        responses, issued, conflicting = yield fanout.finished
+        self.assertEqual(len(responses), 5)
+        self.assertEqual(len(conflicting), 1)
+
+    @tornado.testing.gen_test
+    def test_send_resolves_on_conflict(self):
+        targets = [FakeAgent(port) for port in range(3)]
+        send = self.get_phase().send(targets, required=2)
+        targets[1].reply(400)
+        responses, issued, conflicting = yield send
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(len(conflicting), 1)
+
+
+class TestQuorums(tornado.testing.AsyncTestCase):
+
+    def test_flexible_quorums_must_intersect(self):
+        members = [FakeAgent(port) for port in range(5)]
+        Flexible(4, 2).check(members)
+        with self.assertRaises(ValueError):
+            Flexible(3, 2).check(members)
+        self.assertEqual(Flexible(4, 2).phase2(members).size, 2)
+
+    def test_quorums_must_be_reachable_without_the_proposers_acceptor(self):
+        members = [FakeAgent(port) for port in range(3)]
+        Flexible(3, 1).check(members)
+        with self.assertRaises(ValueError):
+            Flexible(3, 1).check(members, proposer=0)
+        Flexible(2, 2).check(members, proposer=0)
+
+    def test_grid_rows_must_be_reachable_without_the_proposers_acceptor(self):
+        members = [FakeAgent(port) for port in range(4)]
+        Grid([[0, 1], [2, 3]]).check(members, proposer=0)
+        with self.assertRaises(ValueError):
+            Grid([[0], [1, 2, 3]]).check(members, proposer=0)
+        with self.assertRaises(ValueError):
+            Grid([[0, 1, 2, 3]]).check(members, proposer=0)
+
+    @tornado.testing.gen_test
+    def test_grid_phase2_needs_one_agent_per_row(self):
+        targets = [FakeAgent(port) for port in range(6)]
+        grid = Grid([[0, 1, 2], [3, 4, 5]])
+        grid.check(targets)
+        phase = Phase(prepare=Prepare(id=1, key='foo', predicate='incr', argument=1))
+        phase.endpoint = '/testing'
+        fanout = phase.broadcast(targets, required=grid.phase2(targets))
+        targets[0].reply(200)
+        targets[1].reply(200)
+        yield tornado.gen.moment
+        self.assertFalse(fanout.done.done())
+        targets[5].reply(200)
+        responses, issued, conflicting = yield fanout.done
+        self.assertEqual(len(issued), 3)
+        self.assertFalse(grid.phase1(targets).reached(issued))
+
+
+class TestClient(tornado.testing.AsyncTestCase):
+
+    def get_client(self, answers, **kwargs):
+        """
+        A client for one group of agents 1, 2 and 3 that gets `answers[port]`
+        (a list of codes) from each, and records the ports it tried.
+        """
+        self.tried = []
+        client = Client(groups=[[1, 2, 3]], transport='http', backoff=0, **kwargs)
+
+        def fetch(request, **kwargs):
+            port = int(request.url.split(':')[2].split('/')[0])
+            self.tried.append(port)
+            future = tornado.concurrent.Future()
+            code = answers[port].pop(0)
+            if code is None:
+                future.set_exception(ConnectionRefusedError())
+            else:
+                body = json.dumps({'prepare': {'id': len(self.tried)}, 'status': 'SUCCESS'})
+                future.set_result(StreamResponse(code, 'application/json', body))
+            return future
+
+        client.http.fetch = fetch
+        return client
+
+    @tornado.testing.gen_test
+    def test_follows_the_leader_when_it_goes_away(self):
+        client = self.get_client({1: [None], 2: [200, 200]})
+        prepare = yield client.write('foo', 'set', 1)
+        self.assertEqual(prepare, {'id': 2})
+        yield client.write('foo', 'set', 2)
+        self.assertEqual(self.tried, [1, 2, 2])
+
+    @tornado.testing.gen_test
+    def test_retries_failures_but_not_rejections(self):
+        client = self.get_client({1: [500, 500, 400, 500, 500]}, retries=1)
+        results = yield client.write_many([('foo', 'set', 1), ('bar', 'set', 2), ('baz', 'set', 3)])
+        self.assertEqual([r.code for r in results], [500, 500, 400])
+        self.assertTrue(all(isinstance(r, ClientError) for r in results))
+        self.assertEqual(self.tried, [1] * 5)
+
+    @tornado.testing.gen_test
+    def test_does_not_retry_writes_that_are_not_idempotent(self):
+        client = self.get_client({1: [500, None], 2: [200]})
+        results = yield client.write_many([('foo', 'incr', 1), ('foo', 'incr', 1)])
+        self.assertEqual([r.code for r in results], [500, 599])
+        self.assertEqual(self.tried, [1, 1])
+        self.assertEqual((yield client.write('foo', 'incr', 1)), {'id': 3})
+
+    @tornado.testing.gen_test
+    def test_bounds_requests_in_flight(self):
+        client = Client(groups=[[1]], transport='http', concurrency=2)
+        pending = []
+
+        def fetch(request, **kwargs):
+            pending.append(tornado.concurrent.Future())
+            return pending[-1]
+
+        client.http.fetch = fetch
+        writes = client.write_many([('foo', 'set', i) for i in range(5)])
+        yield tornado.gen.moment
+        self.assertEqual(len(pending), 2)
+        while not writes.done():
+            for future in pending:
+                if not future.done():
+                    future.set_result(StreamResponse(200, 'application/json', '{"prepare": {"id": 1}}'))
+            yield tornado.gen.moment
+        self.assertEqual(len(pending), 5)
+        self.assertEqual((yield writes), [{'id': 1}] * 5)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_percentiles_are_nearest_rank(self):
+        self.assertEqual(benchmark.percentiles(range(1, 101)), {'p50': 50, 'p95': 95, 'p99': 99})
+        self.assertEqual(benchmark.percentiles([3]), {'p50': 3, 'p95': 3, 'p99': 3})
+        self.assertEqual(benchmark.percentiles([])['p99'], None)
+
+    def test_skewed_workload_favors_the_first_keys(self):
+        workload = benchmark.Workload(keys=100, skew=1.5, reads=0.5, seed=1)
+        picks = [workload.next() for _ in range(1000)]
+        self.assertGreater(sum(1 for _, key in picks if key == 'key-0'), 300)
+        self.assertEqual({op for op, _ in picks}, {'read', 'write'})
+        again = benchmark.Workload(keys=100, skew=1.5, reads=0.5, seed=1)
+        self.assertEqual([again.next() for _ in range(1000)], picks)
+
+
+class TestSimulation(unittest.TestCase):
+
+    def simulate(self, network, instances=50, **kwargs):
+        sim = Simulation(agent.get_app(), [1, 2, 3], network)
+        try:
+            results = sim.workload(instances, **kwargs)
+            logs = [[learn.prepare.argument for learn in simulated.learner()['ordered_rounds']]
+                    for simulated in network.agents.values()]
+        finally:
+            sim.close()
+        return results, logs
+
+    def test_virtual_clock_skips_ahead(self):
+        io_loop = VirtualIOLoop(asyncio_loop=VirtualLoop())
+        try:
+            io_loop.run_sync(lambda: tornado.gen.sleep(3600))
+            self.assertAlmostEqual(io_loop.time(), 3600)
+        finally:
+            io_loop.close(all_fds=True)
+
+    def test_every_agent_learns_every_instance(self):
+        results, logs = self.simulate(Network(seed=1, latency=constant(0.001)), concurrency=4, keys=5)
+        self.assertEqual(results['committed'], 50)
+        self.assertEqual(results['network']['sent'], 50 * 7)  # 2 prepares, 2 proposes, 3 learns.
+        self.assertEqual([sorted(log) for log in logs], [list(range(50))] * 3)
+
+    def test_runs_are_reproducible_from_the_seed(self):
+        first, _ = self.simulate(Network(seed=7, drop=0.05, reorder=0.2), concurrency=8)
+        second, _ = self.simulate(Network(seed=7, drop=0.05, reorder=0.2), concurrency=8)
+        for results in (first, second):
+            del results['wall_seconds'], results['instances_per_wall_second']
+        self.assertEqual(first, second)
+        self.assertGreater(first['failed'], 0)
+
+    def test_partitioned_proposer_times_out(self):
+        network = Network(timeout=2.0)
+        network.partition([1], [2, 3])
+        results, logs = self.simulate(network, instances=1)
+        self.assertEqual(results['failed'], 1)
+        self.assertAlmostEqual(results['simulated_seconds'], 2.0)
+        self.assertEqual(logs, [[], [], []])
+
+    def fill(self, accepted_by=(), learned_by=()):
+        """
+        Fills slot 0 after a write to it was accepted by the agents in
+        `accepted_by` and learned by those in `learned_by`. Returns what it
+        was filled with and each agent's log.
+        """
+        network = Network(latency=constant(0.001))
+        sim = Simulation(agent.get_app(), [1, 2, 3], network)
+        try:
+            written = Prepare(key='foo', predicate='set', argument='a', slot=0)
+            for port in accepted_by:
+                body = json.dumps(Propose(prepare=written).to_json())
+                self.assertEqual(network.agents[port].handle('/propose', 'application/json', body)[0], 200)
+            for port in learned_by:
+                body = json.dumps(Learn(prepare=written).to_json())
+                self.assertEqual(network.agents[port].handle('/learn', 'application/json', body)[0], 200)
+            filled = sim.run(lambda: fill(written))
+            logs = [[(l.prepare.slot, l.prepare.predicate) for l in simulated.learner()['ordered_rounds']]
+                    for simulated in network.agents.values()]
+        finally:
+            sim.close()
+        return filled, logs
+
+    def test_fill_recovers_a_value_that_was_partly_learned(self):
+        filled, logs = self.fill(accepted_by=[2, 3], learned_by=[2])
+        self.assertEqual((filled.predicate, filled.argument), ('set', 'a'))
+        self.assertEqual(logs, [[(0, 'set')]] * 3)
+
+    def test_fill_recovers_a_value_a_single_acceptor_accepted(self):
+        filled, logs = self.fill(accepted_by=[3])
+        self.assertEqual(filled.predicate, 'set')
+        self.assertEqual(logs, [[(0, 'set')]] * 3)
+
+    def test_fill_learns_a_noop_when_nothing_was_accepted(self):
+        filled, logs = self.fill()
+        self.assertEqual(filled.predicate, NOOP)
+        self.assertEqual(logs, [[(0, NOOP)]] * 3)
+
+    def test_agents_that_are_not_voting_turn_messages_away(self):
+        network = Network()
+        sim = Simulation(agent.get_app(), [1, 2, 3], network)
+        try:
+            network.agents[3].state['voting'] = False
+            body = json.dumps(Prepare(id=1, key='foo', predicate='set', argument='a').to_json())
+            self.assertEqual(network.agents[3].handle('/prepare', 'application/json', body)[0], 503)
+            self.assertEqual(network.agents[2].handle('/prepare', 'application/json', body)[0], 200)
+            self.assertTrue(Membership.voting)
+            results = sim.workload(1)
+        finally:
+            sim.close()
+        self.assertEqual(results['failed'], 1)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_buckets_are_tight(self):
+        histogram = Histogram('test_seconds')
+        for value in [0.0001, 0.003, 0.003, 0.25, 1000]:
+            histogram.observe(value)
+            bound = histogram.bounds[histogram.index(value)] if value < 128 else float('inf')
+            self.assertTrue(value <= bound <= value * 1.25 or bound == float('inf'))
+        self.assertEqual(histogram.count, 5)
+        self.assertLessEqual(histogram.quantile(0.5), 0.003 * 1.25)
+        self.assertEqual(histogram.quantile(1.0), float('inf'))
+
+    def test_prometheus_text_format(self):
+        metrics = Registry()
+        first = metrics.histogram('test_seconds', 'Test.', labels={'phase': 'a'})
+        metrics.counter('test_total', 'Things.').inc(3)
+        metrics.histogram('test_seconds', 'Test.', labels={'phase': 'b'})
+        first.observe(0.5)
+        lines = metrics.render().splitlines()
+        self.assertEqual(lines[:2], ['# HELP test_seconds Test.', '# TYPE test_seconds histogram'])
+        self.assertIn('test_seconds_bucket{phase="a",le="+Inf"} 1', lines)
+        self.assertIn('test_seconds_count{phase="b"} 0', lines)
+        self.assertEqual(lines[-3:], ['# HELP test_total Things.', '# TYPE test_total counter', 'test_total 3'])
+
+
+class TestBatcher(tornado.testing.AsyncTestCase):
+
+    def get_batcher(self, max_size, linger=10):
+        self.committed = []
+
+        @tornado.gen.coroutine
+        def commit(prepare):
+            self.committed.append(prepare)
+            raise tornado.gen.Return(prepare)
+
+        return Batcher(commit, max_size=max_size, linger=linger)
+
+    @tornado.testing.gen_test
+    def test_full_batch_commits_once(self):
+        batcher = self.get_batcher(max_size=3)
+        futures = [batcher.submit({'key': 'foo', 'predicate': 'set', 'argument': i})
+                   for i in range(3)]
+        results = yield futures
+        self.assertEqual(len(self.committed), 1)
+        self.assertEqual(self.committed[0].predicate, BATCH)
+        self.assertEqual([(r.argument, position) for r, position in results], [(0, 0), (1, 1), (2, 2)])
+        self.assertEqual({r.id for r, _ in results}, {self.committed[0].id})
+
+    @tornado.testing.gen_test
+    def test_linger_flushes_a_partial_batch(self):
+        batcher = self.get_batcher(max_size=10, linger=0.01)
+        first = batcher.submit({'key': 'foo', 'predicate': 'set', 'argument': 1})
+        other = batcher.submit({'key': 'bar', 'predicate': 'set', 'argument': 2})
+        result, position = yield first
+        yield other
+        self.assertEqual((result.predicate, position), ('set', 0))
+        self.assertEqual(len(self.committed), 2)
+
+
+class TestPipeline(tornado.testing.AsyncTestCase):
+
+    @tornado.testing.gen_test
+    def test_window_bounds_instances_in_flight(self):
+        started = []
+        decided = {}
+
+        @tornado.gen.coroutine
+        def commit(prepare):
+            started.append(prepare)
+            decided[prepare.slot] = tornado.concurrent.Future()
+            yield decided[prepare.slot]
+            raise tornado.gen.Return(prepare)
+
+        pipeline = Pipeline(commit, window=2)
+        futures = [pipeline.submit(Prepare(key='foo', predicate='set', argument=i))
+                   for i in range(3)]
+        yield tornado.gen.moment
+        self.assertEqual([p.slot for p in started], [0, 1])
+        self.assertEqual(pipeline.in_flight, 2)
+
+        decided[1].set_result(None)
+        yield futures[1]
+        yield tornado.gen.moment
+        self.assertEqual([p.slot for p in started], [0, 1, 2])
+        decided[0].set_result(None)
+        decided[2].set_result(None)
+        results = yield futures
+        self.assertEqual([r.argument for r in results], [0, 1, 2])
+
+    @tornado.testing.gen_test
+    def test_failed_slot_is_filled(self):
+        filled = []
+
+        @tornado.gen.coroutine
+        def commit(prepare):
+            raise tornado.web.HTTPError(500)
+
+        @tornado.gen.coroutine
+        def fill(prepare):
+            filled.append(prepare.slot)
+
+        pipeline = Pipeline(commit, window=1, first_slot=7, fill=fill)
+        with self.assertRaises(tornado.web.HTTPError):
+            yield pipeline.submit(Prepare(key='foo', predicate='set', argument=1))
+        self.assertEqual(filled, [7])
+
+    def test_rotated_pipeline_only_hands_out_its_own_slots(self):
+        pipeline = Pipeline(None, window=1)
+        pipeline.rotate(1, 3)
+        self.assertEqual([pipeline.assign(Prepare(key='foo')).slot for _ in range(3)], [1, 4, 7])
+        self.assertEqual(pipeline.assign(Prepare(key='foo'), floor=9).slot, 10)
+        self.assertEqual(pipeline.skip_to(20), (11, 20))
+        self.assertIsNone(pipeline.skip_to(15))
+        self.assertEqual(pipeline.assign(Prepare(key='foo')).slot, 22)
+
+
+class TestWriteAheadLog(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestWriteAheadLog, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(TestWriteAheadLog, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_concurrent_appends_share_a_flush(self):
+        log = WriteAheadLog(self.path)
+        yield [log.append({'type': 'learn', 'n': i}) for i in range(50)]
+        self.assertEqual(log.flushes, 1)
+        yield log.append({'type': 'learn', 'n': 50})
+        self.assertEqual(log.flushes, 2)
+        log.close()
+        self.assertEqual([r['n'] for r in WriteAheadLog(self.path).records()], list(range(51)))
+
+    def test_torn_record_is_skipped(self):
+        with open(self.path, 'w') as f:
+            f.write('{"type": "learn"}\n{"type": "le')
+        self.assertEqual(list(WriteAheadLog(self.path).records()), [{'type': 'learn'}])
+
+    @tornado.testing.gen_test
+    def test_appends_after_a_torn_record(self):
+        with open(self.path, 'w') as f:
+            f.write('{"type": "learn"}\n{"type": "le')
+        log = WriteAheadLog(self.path)
+        yield log.append({'type': 'promise'})
+        log.close()
+        self.assertEqual(list(WriteAheadLog(self.path).records()), [{'type': 'learn'}, {'type': 'promise'}])
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_binary_round_trips(self):
+        prepare = Prepare(id=7, key='foo', predicate='set', argument={'a': [1, 2]})
+        slotted = Prepare(id=8, key='bar', predicate=None, argument=None, slot=3)
+        messages = [
+            prepare.to_json(),
+            slotted.to_json(),
+            Promise().to_json(),
+            Learn(prepare=prepare).to_json(),
+            Success(prepare=slotted).to_json(),
+            MultiPrepare(key='foo', start=4).to_json(),
+            Prepare(id=2 ** 70, key='foo').to_json(),
+            Prepare(id=9, key='k' * codec.BinaryCodec.NONE, predicate='p' * codec.BinaryCodec.NONE).to_json(),
+            Prepare(id=10, key=0, predicate=0).to_json(),
+            Prepare(id=11, key='', predicate='').to_json(),
+        ]
+        for message in messages:
+            self.assertEqual(codec.BINARY.decode(codec.BINARY.encode(message)), message)
+
+    def test_binary_is_smaller_than_json(self):
+        message = Learn(prepare=Prepare(id=123456, key='foo', predicate='set', argument=1)).to_json()
+        self.assertLess(len(codec.BINARY.encode(message)), len(codec.JSON.encode(message)))
+
+    def test_unknown_content_type_is_json(self):
+        self.assertIs(codec.get('application/json; charset=UTF-8'), codec.JSON)
+        self.assertIs(codec.get(None), codec.JSON)
+        self.assertIs(codec.get(codec.BINARY.content_type), codec.BINARY)
+
+
+class TestShards(unittest.TestCase):
+
+    def test_hash_partitioning_is_stable(self):
+        shards = Shards([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+        placed = {shards.index('key{}'.format(i)) for i in range(100)}
+        self.assertEqual(placed, {0, 1, 2})
+        self.assertEqual(shards.group('foo'), shards.group('foo'))
+        self.assertTrue(shards.owns(shards.group('foo')[1], 'foo'))
+        self.assertTrue(shards.owns(8888, 'foo'))
+
+    def test_range_partitioning(self):
+        shards = Shards([[1], [2], [3]], boundaries=['g', 'p'])
+        self.assertEqual([shards.group(k) for k in ['apple', 'g', 'melon', 'zebra']],
+                         [[1], [2], [2], [3]])
+        self.assertFalse(shards.owns(1, 'zebra'))
+        with self.assertRaises(ValueError):
+            Shards([[1], [2]], boundaries=[])
+
+    def test_spread_proposers_follow_the_key(self):
+        shards = Shards([[1, 2, 3]])
+        self.assertEqual({shards.proposer('key{}'.format(i)) for i in range(100)}, {1})
+        spread = [shards.proposer('key{}'.format(i), spread=True) for i in range(100)]
+        self.assertEqual(set(spread), {1, 2, 3})
+        self.assertEqual(spread[7], shards.proposer('key7', spread=True))
+
+
 class TestSubclasses(tornado.testing.AsyncTestCase):
 
     @tornado.gen.coroutine
@@ -141,6 +673,32 @@ class TestSubclasses(tornado.testing.AsyncTestCase):
         target = Prepare.from_request(request)
         self.assertEqual(target.to_json(), prepare.to_json())
 
+    def test_ballots_are_unique_per_node(self):
+        saved = Prepare._id, Prepare._stride
+        try:
+            Prepare._id = 0
+            Prepare.number(2, 5)
+            self.assertEqual([Prepare().id, Prepare().id], [2, 7])
+            Prepare.observe(20)
+            self.assertEqual(Prepare().id, 22)
+            Prepare.observe(3)
+            self.assertEqual(Prepare().id, 27)
+            with self.assertRaises(ValueError):
+                Prepare.number(5, 5)
+        finally:
+            Prepare._id, Prepare._stride = saved
+
+    def test_joining_agents_number_past_the_static_members(self):
+        groups = [[9997, 9998, 9999], [9985, 9986, 9987]]
+        static = [node_id(port, groups, stride=64) for port in [9985, 9986, 9987, 9997, 9998, 9999]]
+        self.assertEqual(static, list(range(6)))
+        for port in (10048, 9985 + 64, 10000, 12345):
+            self.assertNotIn(node_id(port, groups, stride=64), static)
+            self.assertLess(node_id(port, groups, stride=64), 64)
+        self.assertEqual(node_id(9998, groups, stride=6), 4)
+        with self.assertRaises(ValueError):
+            node_id(10048, groups, stride=6)
+
     def test_promise(self):
         promise = Promise()
         self.assertEqual(promise.prepare, None)
@@ -182,6 +740,14 @@ class TestSubclasses(tornado.testing.AsyncTestCase):
             url='/learn')
         self.assertEqual(learn.to_json(), Learn.from_request(request).to_json())
 
+    def test_messages_are_compact(self):
+        prepare = Prepare(id=3, key=''.join(['b', 'iz']), predicate='set', argument='a')
+        for message in [prepare, Learn(prepare=prepare), Promise(), Success(prepare=prepare)]:
+            self.assertFalse(hasattr(message, '__dict__'))
+        self.assertIs(prepare.key, Prepare(id=4, key=''.join(['bi', 'z'])).key)
+        # About 230 bytes; before messages had __slots__ it was over 370.
+        self.assertLess(bytes_per_entry(entries=2000, keys=10), 300)
+
     def test_success(self):
         prepare = Prepare(id=3, key='biz', predicate='set', argument='a')
         success = Success(prepare=prepare)
@@ -209,6 +775,38 @@ class TestContainers(tornado.testing.AsyncTestCase):
         self.assertEqual(promises.highest_numbered(key='biz').to_json(),
                          promise3.to_json())
 
+    def test_lookups_do_not_add_keys(self):
+        promises = Promises()
+        self.assertIsNone(promises.get('missing'))
+        self.assertIsNone(promises.highest_numbered('missing'))
+        self.assertIsNone(promises.highest_numbered())
+        self.assertEqual(promises.promises, {})
+
+    def test_highest_is_maintained_through_removals(self):
+        promises = Promises()
+        for id, key in [(5, 'a'), (9, 'b'), (7, 'a'), (6, 'a'), (8, 'c')]:
+            promises.add(Promise(prepare=Prepare(id=id, key=key)))
+        self.assertEqual(promises.get('a').prepare.id, 7)
+        self.assertEqual(promises.highest_numbered().prepare.id, 9)
+
+        promises.remove(Prepare(id=9, key='b'))
+        self.assertEqual(promises.highest_numbered().prepare.id, 8)
+        promises.remove(Prepare(id=7, key='a'))
+        self.assertEqual(promises.get('a').prepare.id, 6)
+        promises.remove(Prepare(id=8, key='c'))
+        self.assertEqual(promises.highest_numbered().prepare.id, 6)
+        self.assertEqual(promises.ids['a'], [5, 6])
+        self.assertEqual(len(promises), 2)
+
+    def test_stale_heap_entries_are_bounded(self):
+        promises = Promises()
+        for id in range(1000):
+            prepare = Prepare(id=id, key='foo')
+            promises.add(Promise(prepare=prepare))
+            promises.remove(prepare)
+        self.assertLess(len(promises.heap), 100)
+        self.assertIsNone(promises.highest_numbered())
+
 
 class Base(tornado.testing.AsyncHTTPTestCase):
 
@@ -226,13 +824,64 @@ class Base(tornado.testing.AsyncHTTPTestCase):
         return Prepare(id=1, key='foo', predicate='set', argument='a')
 
     def setUp(self):
+        Promises.initialize()
+        MultiPromises.initialize()
+        Slots.initialize()
         Promises.current.clear()
         Learner.completed_rounds.clear()
+        Learner.reset()
         super(Base, self).setUp()
 
 
 class TestProposer(Base):
 
+    def write_and_learn(self, body, failed=0):
+        """
+        Posts `body` to /write with every phase succeeding, learning the
+        value locally in place of the Learn round. `failed` more acceptors
+        fail Phase 1 as an unreachable one does, with a 599 and no body.
+        """
+        ok = mock.Mock()
+        ok.code = 200
+        ok.body = json.dumps(Promise().to_json())
+        unreachable = mock.Mock()
+        unreachable.code = 599
+        unreachable.body = None
+        prepared = tornado.concurrent.Future()
+        prepared.set_result(tuple([[ok, ok] + [unreachable] * failed, [ok, ok], []]))
+        promised = tornado.concurrent.Future()
+        promised.set_result(tuple([[ok, ok], [ok, ok], []]))
+
+        def fanout(learn, expected=None):
+            Learner.learn(learn)
+            future = tornado.concurrent.Future()
+            future.set_result([Success(prepare=learn.prepare)] * len(agents.all()))
+            return future
+
+        with mock.patch('paxos.models.Prepare.send', return_value=prepared), \
+                mock.patch('paxos.models.Propose.send', return_value=promised), \
+                mock.patch('paxos.models.Learn.fanout', autospec=True, side_effect=fanout):
+            return self.post('/write', body=body)
+
+    def test_ignores_failed_responses_once_phase1_is_reached(self):
+        response = self.write_and_learn({'key': 'foo', 'predicate': 'set', 'argument': 'a'}, failed=1)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(Learner.state.get('foo'), ('a', 1))
+
+    def test_reports_whether_the_write_applied(self):
+        responses = [self.write_and_learn({'key': 'foo', 'predicate': 'cas', 'argument': argument})
+                     for argument in ({'expected': None, 'value': 1}, {'expected': 5, 'value': 2})]
+        self.assertEqual([r.code for r in responses], [200, 200])
+        self.assertEqual([json.loads(r.body)['outcome'] for r in responses], ['applied', 'rejected'])
+        self.assertEqual(Learner.state.get('foo'), (1, 1))
+
+    def test_answers_504_when_the_write_is_not_applied_in_time(self):
+        with mock.patch('paxos.proposer.OUTCOME_TIMEOUT', 0.01), \
+                mock.patch('paxos.learner.Learner.append'):
+            response = self.write_and_learn({'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 504)
+        self.assertEqual(Learner.applying, {})
+
     def test_allows_non_conflicting_writes(self):
         prepare = Prepare(id=0, key='foo', predicate='set', argument='a')
         promise = Promise()
@@ -263,6 +912,192 @@ class TestProposer(Base):
 
         self.assertEqual(response.code, 200)
 
+    def test_phase2_waits_on_the_phase2_quorum(self):
+        ok = mock.Mock()
+        ok.code = 200
+        ok.body = json.dumps(Promise().to_json())
+        prepared = tornado.concurrent.Future()
+        prepared.set_result(tuple([[ok, ok], [ok, ok], []]))
+        accepted = tornado.concurrent.Future()
+        accepted.set_result(tuple([[ok], [ok], []]))
+        learn_fut = tornado.concurrent.Future()
+        learn_fut.set_result([Success()] * len(agents.all()))
+        with mock.patch('paxos.proposer.quorums', Flexible(3, 1)):
+            with mock.patch('paxos.models.Prepare.send', return_value=prepared) as prepare_send:
+                with mock.patch('paxos.models.Propose.send', return_value=accepted) as propose_send:
+                    with mock.patch('paxos.models.Learn.fanout', return_value=learn_fut):
+                        response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 500)  # Only two of the three Phase 1 acceptors answered.
+        self.assertFalse(propose_send.called)
+
+        prepared = tornado.concurrent.Future()
+        prepared.set_result(tuple([[ok, ok, ok], [ok, ok, ok], []]))
+        with mock.patch('paxos.proposer.quorums', Flexible(3, 1)):
+            with mock.patch('paxos.models.Prepare.send', return_value=prepared) as prepare_send:
+                with mock.patch('paxos.models.Propose.send', return_value=accepted) as propose_send:
+                    with mock.patch('paxos.models.Learn.fanout', return_value=learn_fut):
+                        response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(propose_send.call_args[1]['required'].size, 1)
+
+    def test_retries_back_off_and_outbid_the_competitor(self):
+        competitor = Prepare(id=Prepare._id + 100, key='foo', predicate='set', argument='b')
+        rejected = mock.Mock()
+        rejected.code = 400
+        rejected.body = json.dumps(Promise(prepare=competitor).to_json())
+        ok = mock.Mock()
+        ok.code = 200
+        ok.body = json.dumps(Promise().to_json())
+        outcomes = [tuple([[rejected], [], [rejected]]), tuple([[ok, ok], [ok, ok], []])]
+
+        def prepare_send(*args, **kwargs):
+            fut = tornado.concurrent.Future()
+            fut.set_result(outcomes.pop(0))
+            return fut
+
+        accepted = tornado.concurrent.Future()
+        accepted.set_result(tuple([[ok, ok], [ok, ok], []]))
+        learn_fut = tornado.concurrent.Future()
+        learn_fut.set_result([Success()] * len(agents.all()))
+        with mock.patch('paxos.contention.contention.stats', {}):
+            with mock.patch('paxos.contention.contention.delay', return_value=0) as delay:
+                with mock.patch('paxos.models.Prepare.send', side_effect=prepare_send):
+                    with mock.patch('paxos.models.Propose.send', return_value=accepted):
+                        with mock.patch('paxos.models.Learn.fanout', return_value=learn_fut):
+                            response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+                stats = json.loads(self.fetch('/contention?key=foo').body)['foo']
+        self.assertEqual(response.code, 200)
+        self.assertGreater(json.loads(response.body)['prepare']['id'], competitor.id)
+        delay.assert_called_once_with(1)
+        self.assertEqual(stats['conflicts'], 1)
+        self.assertEqual(stats['backoffs'], 1)
+        self.assertEqual(stats['highest_competitor'], competitor.id)
+
+    def test_direct_learn_skips_the_learn_round(self):
+        ok = mock.Mock()
+        ok.code = 200
+        ok.body = json.dumps(Promise().to_json())
+        prepared = tornado.concurrent.Future()
+        prepared.set_result(tuple([[ok, ok], [ok, ok], []]))
+
+        def propose_send(propose, peers, required=None):
+            for port in [9998, 9997]:  # Their Accepted messages arrive.
+                Learner.accepted(Accepted(prepare=propose.prepare, acceptor=port), required)
+            fut = tornado.concurrent.Future()
+            fut.set_result(tuple([[ok, ok], [ok, ok], []]))
+            return fut
+
+        with mock.patch('paxos.proposer.DIRECT_LEARN', True):
+            with mock.patch('paxos.models.Prepare.send', return_value=prepared):
+                with mock.patch.object(Propose, 'send', autospec=True, side_effect=propose_send):
+                    with mock.patch('paxos.models.Learn.fanout') as fanout:
+                        response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 200)
+        self.assertFalse(fanout.called)
+        self.assertEqual(Learner.ordered_rounds[0].prepare.argument, 'a')
+
+    def test_write_is_timed_per_phase(self):
+        before = PREPARE_SECONDS.count
+        self.test_allows_non_conflicting_writes()
+        self.assertEqual(PREPARE_SECONDS.count, before + 1)
+        metrics = self.fetch('/metrics').body.decode('utf-8')
+        self.assertIn('paxos_phase_seconds_count{{phase="prepare"}} {}'.format(before + 1), metrics)
+        self.assertIn('paxos_writes_total', metrics)
+
+
+class TestRouting(Base):
+
+    def test_proposer_rejects_keys_from_other_shards(self):
+        with mock.patch('paxos.proposer.shards', Shards([[8888], [9999]], boundaries=['m'])):
+            with mock.patch('paxos.proposer.options') as options:
+                options.port = 8888
+                response = self.post('/write', body={'key': 'zebra', 'predicate': 'set', 'argument': 1})
+        self.assertEqual(response.code, 400)
+
+
+class TestMultiPaxos(Base):
+
+    def test_leader_skips_prepare_while_it_holds_the_range(self):
+        held = MultiPromise(MultiPrepare(key='foo', start=0))
+        MultiPromises.held.add(held)
+        ok = mock.Mock()
+        ok.code = 200
+        ok.body = '{}'
+        fut = tornado.concurrent.Future()
+        fut.set_result(tuple([[ok, ok], [ok, ok], []]))
+        learn_fut = tornado.concurrent.Future()
+        learn_fut.set_result([Success()] * len(agents.all()))
+        with mock.patch('paxos.proposer.MULTI_PAXOS', True):
+            with mock.patch('paxos.models.Prepare.send') as prepare_send:
+                with mock.patch('paxos.models.Propose.send', return_value=fut):
+                    with mock.patch('paxos.models.Learn.fanout', return_value=learn_fut):
+                        response = self.post('/write', body={
+                            'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 200)
+        self.assertFalse(prepare_send.called)
+
+    def test_higher_prepare_preempts_the_range(self):
+        mp = MultiPrepare(key='foo', start=10)
+        response = self.post('/multiprepare', mp.to_json())
+        self.assertEqual(response.code, 200)
+        self.assertEqual(MultiPromises.granted.get('foo').prepare.start, 10)
+
+        lower = self.post('/multiprepare', MultiPrepare(key='foo', start=5).to_json())
+        self.assertEqual(lower.code, 400)
+
+        in_range = Prepare(id=11, key='foo', predicate='set', argument='a')
+        self.assertEqual(self.post('/propose', Propose(prepare=in_range).to_json()).code, 200)
+
+        self.assertEqual(self.post('/prepare', Prepare(
+            id=20, key='foo', predicate='set', argument='b').to_json()).code, 200)
+        after = Prepare(id=21, key='foo', predicate='set', argument='c')
+        self.assertEqual(self.post('/propose', Propose(prepare=after).to_json()).code, 400)
+
+
+class TestLeases(Base):
+
+    def test_lease_holds_off_other_ballots_until_it_expires(self):
+        self.assertEqual(self.post('/multiprepare', MultiPrepare(key='foo', start=10, lease=5).to_json()).code, 200)
+        higher = Prepare(id=20, key='foo', predicate='set', argument='b')
+        self.assertEqual(self.post('/prepare', higher.to_json()).code, 400)
+        self.assertEqual(self.post('/multiprepare', MultiPrepare(key='foo', start=30).to_json()).code, 400)
+
+        renewal = self.post('/multiprepare', MultiPrepare(key='foo', start=10, lease=5).to_json())
+        self.assertEqual(renewal.code, 200)
+
+        MultiPromises.granted.get('foo').expires = 0
+        self.assertEqual(self.post('/prepare', higher.to_json()).code, 200)
+        self.assertEqual(MultiPromises.granted.get('foo').prepare.stop, 20)
+
+    def test_proposal_below_the_range_is_rejected_while_leased(self):
+        self.assertEqual(self.post('/multiprepare', MultiPrepare(key='foo', start=10, lease=30).to_json()).code, 200)
+        below = Prepare(id=3, key='foo', predicate='set', argument='a')
+        response = self.post('/propose', Propose(prepare=below).to_json())
+        self.assertEqual(response.code, 400)
+        self.assertEqual(json.loads(response.body)['prepare']['id'], 10)
+
+    def test_leaseholder_reads_without_a_round_trip(self):
+        Learner.learn(Learn(prepare=Prepare(id=3, key='foo', predicate='set', argument='a')))
+        MultiPromises.held.add(MultiPromise(MultiPrepare(key='foo', start=0, lease=5), expires=float('inf')))
+        with mock.patch('paxos.proposer.LEASE_DURATION', 5):
+            with mock.patch('paxos.models.MultiPrepare.send') as send:
+                response = self.fetch('/read?key=foo&linearizable=1')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['prepare']['argument'], 'a')
+        self.assertFalse(send.called)
+
+    def test_read_fails_without_the_lease(self):
+        rejected = mock.Mock()
+        rejected.code = 400
+        fut = tornado.concurrent.Future()
+        fut.set_result(tuple([[rejected], [], [rejected]]))
+        with mock.patch('paxos.proposer.LEASE_DURATION', 5):
+            with mock.patch('paxos.models.MultiPrepare.send', return_value=fut):
+                response = self.fetch('/read?key=foo&linearizable=1')
+        self.assertEqual(response.code, 503)
+        self.assertIsNone(MultiPromises.held.get('foo'))
+        self.assertEqual(self.fetch('/read?linearizable=1').code, 400)
+
 
 class TestPrepareAcceptor(Base):
 
@@ -299,6 +1134,17 @@ class TestPrepareAcceptor(Base):
 
 class TestProposeAcceptor(Base):
 
+    def test_answers_in_the_encoding_it_was_sent(self):
+        propose = Propose(prepare=self.get_prepare())
+        response = self.fetch('/propose',
+                              method='POST',
+                              body=codec.BINARY.encode(propose.to_json()),
+                              headers={'Content-Type': codec.BINARY.content_type})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], codec.BINARY.content_type)
+        self.assertEqual(Accept.from_response(response).to_json(),
+                         {'prepare': self.get_prepare().to_json()})
+
     def test_propose_acceptor_removes_promise(self):
         promise = Promise(prepare=self.get_prepare())
         Promises.current.add(promise)
@@ -315,9 +1161,598 @@ class TestProposeAcceptor(Base):
 
         self.assertIsNone(Promises.current.highest_numbered())
 
+    def test_tells_the_learners_directly(self):
+        with mock.patch('paxos.acceptor.DIRECT_LEARN', True):
+            with mock.patch('paxos.models.Accepted.broadcast') as broadcast:
+                response = self.post('/propose', Propose(prepare=self.get_prepare()).to_json())
+        self.assertEqual(response.code, 200)
+        broadcast.assert_called_once_with(agents.all())
+
+    def test_a_slot_keeps_to_the_highest_ballot_promised_in_it(self):
+        recover = Recover(prepare=Prepare(id=10, key='foo', predicate=NOOP, slot=5))
+        response = self.post('/recover', recover.to_json())
+        self.assertEqual(response.code, 200)
+        self.assertIsNone(Promise.from_response(response).prepare)
+
+        lower = Prepare(id=3, key='foo', predicate='set', argument='a', slot=5)
+        rejected = self.post('/propose', Propose(prepare=lower).to_json())
+        self.assertEqual(rejected.code, 400)
+        self.assertEqual(Promise.from_response(rejected).prepare.id, 10)
+        self.assertEqual(self.post('/prepare', lower.to_json()).code, 400)
+
+        higher = Prepare(id=12, key='foo', predicate='set', argument='b', slot=5)
+        self.assertEqual(self.post('/propose', Propose(prepare=higher).to_json()).code, 200)
+        self.assertEqual(self.post('/recover', recover.to_json()).code, 400)
+        response = self.post('/recover', Recover(prepare=Prepare(id=20, key='foo', predicate=NOOP, slot=5)).to_json())
+        self.assertEqual(Promise.from_response(response).prepare.to_json(), higher.to_json())
+
+    def test_recover_answers_with_what_was_learned_in_the_slot(self):
+        learned = Prepare(id=4, key='foo', predicate='set', argument='a', slot=0)
+        Learner.learn(Learn(prepare=learned))
+        response = self.post('/recover', Recover(prepare=Prepare(id=9, key='foo', predicate=NOOP, slot=0)).to_json())
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), Success(prepare=learned).to_json())
+
+    def test_mencius_skips_our_slots_below_anothers_proposal(self):
+        prepare = Prepare(id=1, key='foo', predicate='set', argument='a', slot=5)
+        with mock.patch('paxos.acceptor.MENCIUS', True), \
+                mock.patch.multiple(agent.pipeline, owner=0, owners=3, next_slot=0), \
+                mock.patch('paxos.models.Skip.broadcast') as broadcast:
+            self.assertEqual(self.post('/propose', Propose(prepare=prepare).to_json()).code, 200)
+            self.assertEqual(agent.pipeline.next_slot, 5)
+            self.assertEqual(self.post('/propose', Propose(prepare=prepare).to_json()).code, 200)
+        broadcast.assert_called_once_with(agents.all())
+
+
+class TestRecovery(Base):
+
+    def setUp(self):
+        super(TestRecovery, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        WriteAheadLog.initialize(self.path)
+
+    def tearDown(self):
+        WriteAheadLog.current.close()
+        WriteAheadLog.initialize()
+        os.remove(self.path)
+        super(TestRecovery, self).tearDown()
+
+    def test_restart_recovers_promises_and_learns(self):
+        promised = Prepare(id=40, key='foo', predicate='set', argument='a')
+        learned = Prepare(id=41, key='bar', predicate='set', argument='b')
+        self.assertEqual(self.post('/prepare', promised.to_json()).code, 200)
+        self.assertEqual(self.post('/learn', Learn(prepare=learned).to_json()).code, 200)
+
+        Promises.initialize()
+        Learner.reset()
+        agent.recover(WriteAheadLog.current)
+
+        self.assertEqual(Promises.current.get('foo').prepare.to_json(), promised.to_json())
+        self.assertEqual([l.prepare.to_json() for l in Learner.ordered_rounds], [learned.to_json()])
+        self.assertGreater(Prepare._id, 41)
+
+    def test_restart_recovers_the_slots(self):
+        recover = Recover(prepare=Prepare(id=10, key='foo', predicate=NOOP, slot=5))
+        accepted = Prepare(id=11, key='foo', predicate='set', argument='a', slot=6)
+        self.assertEqual(self.post('/recover', recover.to_json()).code, 200)
+        self.assertEqual(self.post('/propose', Propose(prepare=accepted).to_json()).code, 200)
+
+        Slots.initialize()
+        agent.recover(WriteAheadLog.current)
+
+        self.assertEqual(dict(Slots.current.promised), {5: 10, 6: 11})
+        self.assertEqual(Slots.current.accepted[6].to_json(), accepted.to_json())
+
+    def test_skips_the_learns_a_snapshot_covers_by_slot(self):
+        for slot in range(3, 8):
+            learn = Learn(prepare=Prepare(id=slot, key='n', predicate='incr', slot=slot))
+            self.assertEqual(self.post('/learn', learn.to_json()).code, 200)
+        snapshot = {'base': 5, 'learned': 1000, 'next_slot': 5, 'latest': [], 'out_of_order': [],
+                    'state': {'values': {'n': 5}, 'versions': {'n': 5}, 'applied': 5}}
+
+        Learner.reset()
+        agent.recover(WriteAheadLog.current, snapshot=snapshot)
+
+        self.assertEqual([l.prepare.slot for l in Learner.ordered_rounds], [5, 6, 7])
+        self.assertEqual((Learner.next_slot, Learner.base), (8, 5))
+        self.assertEqual(Learner.state.get('n'), (8, 8))
+
+
+class TestSnapshots(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestSnapshots, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+        Learner.reset()
+        Snapshots.initialize(self.path, max_entries=3)
+
+    def tearDown(self):
+        Snapshots.initialize()
+        Learner.reset()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        super(TestSnapshots, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_snapshot_truncates_the_log(self):
+        for i in range(4):
+            Learner.learn(Learn(prepare=Prepare(id=i, key='k{}'.format(i % 2), predicate='set', argument=i)))
+            while Snapshots.current.running:
+                yield tornado.gen.sleep(0.001)
+        self.assertEqual(Snapshots.current.taken, 1)
+        self.assertEqual(Learner.base, 3)
+        self.assertEqual([l.prepare.id for l in Learner.ordered_rounds], [3])
+        self.assertEqual(len(Learner.completed_rounds.promises['k0']), 1)
+
+        snapshot = Snapshots.current.load()
+        Learner.restore(snapshot)
+        self.assertEqual(Learner.base, 3)
+        self.assertEqual(Learner.learned, 3)
+        self.assertEqual(Learner.completed_rounds.highest_numbered('k0').prepare.argument, 2)
+        self.assertEqual(Learner.state.get('k0'), (2, 2))
+        self.assertEqual(Learner.state.applied, 3)
+
+    def test_estimates_the_size_of_what_it_learns(self):
+        arguments = ('x' * 1000,
+                     {'expected': 'a' * 500, 'value': 'b' * 500},
+                     [{'predicate': 'set', 'argument': 1}] * 50)
+        for argument in arguments:
+            prepare = Prepare(id=1, key='foo', predicate='set', argument=argument, slot=7)
+            actual = len(json.dumps(prepare.to_json()))
+            snapshots = Snapshots(self.path, max_bytes=10 ** 9)
+            snapshots.observe(Learner, Learn(prepare=prepare))
+            self.assertTrue(actual / 2 <= snapshots.size <= actual * 2, (snapshots.size, actual))
+
+    def test_lower_ballots_are_still_learned_after_a_snapshot(self):
+        learns = [Learn(prepare=Prepare(id=i, key='n', predicate='incr')) for i in (4, 6, 5)]
+        for learn in learns[:2]:
+            Learner.learn(learn)
+        state = Learner.capture()
+        Learner.truncate(state)
+        self.assertTrue(Learner.learn(learns[2]))
+        self.assertEqual(Learner.state.get('n'), (3, 3))
+
+        # Replaying a log the snapshot was never compacted into.
+        Learner.restore(to_json(state))
+        self.assertEqual([Learner.learn(learn) for learn in learns], [False, False, True])
+        self.assertEqual(Learner.state.get('n'), (3, 3))
+
+    @tornado.testing.gen_test
+    def test_snapshot_compacts_the_write_ahead_log(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        WriteAheadLog.initialize(path)
+        Promises.initialize()
+        MultiPromises.initialize()
+        Slots.initialize()
+        try:
+            promised = Prepare(id=10, key='foo', predicate='set', argument='a')
+            Promises.current.add(Promise(prepare=promised))
+            yield log(PROMISE, prepare=promised.to_json())
+            for i in range(4):
+                learn = Learn(prepare=Prepare(id=i, key='k', predicate='set', argument=i))
+                Learner.learn(learn)
+                yield log(LEARN, prepare=learn.prepare.to_json())
+                while Snapshots.current.running:
+                    yield tornado.gen.sleep(0.001)
+            records = list(WriteAheadLog.current.records())
+            self.assertEqual([(r['type'], r['prepare']['id']) for r in records], [(PROMISE, 10), (LEARN, 3)])
+
+            Learner.reset()
+            agent.recover(WriteAheadLog.current, snapshot=Snapshots.current.load())
+            self.assertEqual(Learner.state.get('k'), (3, 4))
+        finally:
+            WriteAheadLog.current.close()
+            WriteAheadLog.initialize()
+            os.remove(path)
+
+
+class TestCatchUp(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestCatchUp, self).setUp()
+        Learner.reset()
+        self.requests = []
+
+    def tearDown(self):
+        Learner.reset()
+        super(TestCatchUp, self).tearDown()
+
+    def peer(self, next_slot, compacted=0):
+        """
+        A client for a peer that has learned `incr` in every slot up to
+        `next_slot`, and has compacted the ones below `compacted`.
+        """
+        def fetch(url, **kwargs):
+            self.requests.append(url)
+            path, _, query = url.partition('?')
+            if path.endswith('/snapshot'):
+                body = {'base': compacted, 'learned': compacted, 'next_slot': compacted, 'latest': [],
+                        'out_of_order': [], 'state': {'values': {'n': compacted}, 'versions': {'n': compacted},
+                                                      'applied': compacted}}
+            else:
+                args = dict(arg.split('=') for arg in query.split('&'))
+                start = max(int(args['since']), compacted)
+                body = ''.join(json.dumps(Learn(prepare=Prepare(id=slot, key='n', predicate='incr', slot=slot)).to_json())
+                               + '\n' for slot in range(start, min(next_slot, start + int(args['limit']))))
+            response = StreamResponse(200, 'application/json', json.dumps(body) if isinstance(body, dict) else body.encode())
+            response.headers['X-Next-Slot'] = str(next_slot)
+            future = tornado.concurrent.Future()
+            future.set_result(response)
+            return future
+
+        client = mock.Mock()
+        client.fetch = fetch
+        return mock.patch('tornado.httpclient.AsyncHTTPClient', return_value=client)
+
+    @tornado.testing.gen_test
+    def test_pulls_missing_slots_in_batches(self):
+        for slot in [0, 1, 5]:
+            Learner.learn(Learn(prepare=Prepare(id=slot, key='n', predicate='incr', slot=slot)))
+        with self.peer(next_slot=8):
+            pulled = yield CatchUp(batch=2, rate=0).run([Agent('http://127.0.0.1', 1)])
+        self.assertEqual(pulled, 6)
+        self.assertEqual([l.prepare.slot for l in Learner.ordered_rounds], list(range(8)))
+        self.assertEqual(Learner.state.get('n'), (8, 8))
+        self.assertEqual(len([url for url in self.requests if 'limit=2' in url]), 3)
+
+    @tornado.testing.gen_test
+    def test_starts_from_a_snapshot_when_the_peer_has_compacted(self):
+        with self.peer(next_slot=7, compacted=5):
+            pulled = yield CatchUp(batch=100, rate=0).run([Agent('http://127.0.0.1', 1)])
+        self.assertEqual(pulled, 2)
+        self.assertEqual(Learner.next_slot, 7)
+        self.assertEqual(Learner.state.get('n'), (7, 7))
+        self.assertTrue(any(url.endswith('/snapshot') for url in self.requests))
+
+
+class TestSubscriber(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestSubscriber, self).setUp()
+        Learner.reset()
+
+    def tearDown(self):
+        Learner.reset()
+        super(TestSubscriber, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_learns_from_the_stream_and_resumes_from_its_offset(self):
+        urls = []
+        body = b''.join(json.dumps(Learn(prepare=Prepare(id=i, key='n', predicate='incr')).to_json()).encode() + b'\n'
+                        for i in range(3))
+
+        def fetch(request, **kwargs):
+            urls.append(request.url)
+            for i in range(0, len(body), 7):  # Lines split across chunks.
+                request.streaming_callback(body[i:i + 7])
+            future = tornado.concurrent.Future()
+            future.set_result(StreamResponse(200, 'application/json', b''))
+            return future
+
+        client = mock.Mock()
+        client.fetch = fetch
+        subscriber = Subscriber(timeout=1)
+        with mock.patch('tornado.httpclient.AsyncHTTPClient', return_value=client):
+            self.assertTrue((yield subscriber.follow(Agent('http://127.0.0.1', 1))))
+            self.assertTrue((yield subscriber.follow(Agent('http://127.0.0.1', 1))))
+        self.assertEqual([url.rpartition('=')[2] for url in urls], ['0', '3'])
+        self.assertEqual(Learner.state.get('n'), (3, 3))
+
+
+class TestStreamTransport(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestStreamTransport, self).setUp()
+        Promises.initialize()
+        MultiPromises.initialize()
+        Slots.initialize()
+        Learner.reset()
+        sock, port = tornado.testing.bind_unused_port()
+        self.server = StreamServer(agent.get_app())
+        self.server.add_sockets([sock])
+        self.servers = [self.server]
+        self.transport = StreamTransport(port_offset=0)
+        self.peer = Agent('http://127.0.0.1', port, transport=self.transport)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        super(TestStreamTransport, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_requests_share_one_connection(self):
+        learns = [Learn(prepare=Prepare(id=i, key='foo', predicate='set', argument=i))
+                  for i in range(5)]
+        responses = yield [self.peer.send(learn) for learn in learns]
+        self.assertEqual([r.code for r in responses], [200] * 5)
+        self.assertEqual([Success.from_response(r).prepare.id for r in responses], list(range(5)))
+        self.assertEqual(len(self.transport.connections), 1)
+        self.assertEqual(len(Learner.ordered_rounds), 5)
+
+    @tornado.testing.gen_test
+    def test_reconnects_after_the_connection_drops(self):
+        prepare = Prepare(id=1, key='foo', predicate='set', argument='a')
+        response = yield self.peer.send(prepare)
+        self.assertEqual(response.code, 200)
+        self.transport.connection(self.peer).stream.close()
+        yield tornado.gen.moment
+        response = yield self.peer.send(Propose(prepare=prepare))
+        self.assertEqual(response.code, 200)
+
+    def test_request_ids_wrap_around_to_fit_the_frame(self):
+        connection = Connection('127.0.0.1', 1)
+        connection.last_id = MAX_ID - 1
+        connection.pending[1] = tornado.concurrent.Future()
+        self.assertEqual([connection.next_id(), connection.next_id()], [MAX_ID, 2])
+
+    def silent_peer(self, reply=None):
+        """
+        A peer that reads every request and answers with `reply`, if anything.
+        """
+        class Silent(tornado.tcpserver.TCPServer):
+            @tornado.gen.coroutine
+            def handle_stream(self, stream, address):
+                yield read_frame(stream)
+                if reply is not None:
+                    yield stream.write(reply)
+                yield stream.read_until_close()
+
+        sock, port = tornado.testing.bind_unused_port()
+        server = Silent()
+        server.add_sockets([sock])
+        self.servers.append(server)
+        return Agent('http://127.0.0.1', port, transport=self.transport)
+
+    @tornado.testing.gen_test
+    def test_requests_time_out(self):
+        self.transport.timeout = 0.05
+        peer = self.silent_peer()
+        with self.assertRaises(tornado.gen.TimeoutError):
+            yield peer.send(Prepare(id=1, key='foo', predicate='set', argument='a'))
+        self.assertEqual(self.transport.connection(peer).pending, {})
+
+    @tornado.testing.gen_test
+    def test_a_bad_frame_fails_the_requests_waiting(self):
+        peer = self.silent_peer(reply=FRAME.pack(FRAME.size - 4 + 1, 1, 200, 1) + b'\xff')
+        with self.assertRaises(UnicodeDecodeError):
+            yield peer.send(Prepare(id=1, key='foo', predicate='set', argument='a'))
+        self.assertTrue(self.transport.connection(peer).stream.closed())
+
+
+class TestReader(Base):
+
+    def setUp(self):
+        super(TestReader, self).setUp()
+        for i in range(6):
+            Learner.learn(Learn(prepare=Prepare(
+                id=i, key='ab'[i % 2], predicate='set', argument=i, slot=i)))
+
+    def read(self, query=''):
+        response = self.fetch('/read' + query)
+        self.assertEqual(response.code, 200)
+        lines = response.body.decode('utf-8').splitlines()
+        return ([json.loads(line)['prepare']['argument'] for line in lines],
+                int(response.headers['X-Next-Offset']))
+
+    def test_reads_everything_by_default(self):
+        self.assertEqual(self.read(), ([0, 1, 2, 3, 4, 5], 6))
+
+    def test_reads_one_key_a_page_at_a_time(self):
+        self.assertEqual(self.read('?key=b&limit=2'), ([1, 3], 4))
+        self.assertEqual(self.read('?key=b&limit=2&offset=4'), ([5], 6))
+        self.assertEqual(self.read('?key=b&offset=6'), ([], 6))
+
+    def test_reads_since_a_slot(self):
+        self.assertEqual(self.read('?since=4'), ([4, 5], 6))
+        self.assertEqual(self.read('?since=1&key=a&limit=1'), ([2], 3))
+
+    def test_skips_compacted_entries(self):
+        Learner.truncate(Learner.capture())
+        Learner.learn(Learn(prepare=Prepare(id=6, key='a', predicate='set', argument=6, slot=6)))
+        self.assertEqual(self.read('?key=a'), ([6], 7))
+        self.assertEqual(Learner.key_index, {'a': [6]})
+
+    def test_entries_are_read_lazily_from_the_log_as_it_was(self):
+        entries = Learner.entries(key='a')
+        self.assertEqual(next(entries)[0], 0)
+        Learner.truncate(Learner.capture())
+        self.assertEqual([(offset, learn.prepare.argument) for offset, learn in entries], [(2, 2), (4, 4)])
+
+    def test_rejects_bad_arguments(self):
+        self.assertEqual(self.fetch('/read?limit=x').code, 400)
+
+    def test_serves_a_snapshot_for_catching_up(self):
+        self.assertEqual(self.fetch('/read?limit=0').headers['X-Next-Slot'], '6')
+        snapshot = json.loads(self.fetch('/snapshot').body)
+        self.assertEqual((snapshot['next_slot'], snapshot['base']), (6, 6))
+        self.assertEqual(snapshot['state']['values'], {'a': 4, 'b': 5})
+
+
+class TestSubscribe(Base):
+
+    @tornado.testing.gen_test
+    def test_streams_values_as_they_are_learned(self):
+        Learner.learn(Learn(prepare=Prepare(id=1, key='a', predicate='set', argument=1)))
+        chunks = []
+        with mock.patch('agent.SUBSCRIBE_TIMEOUT', 0.2):
+            response = self.http_client.fetch(self.get_url('/subscribe?offset=0'), streaming_callback=chunks.append)
+            yield tornado.gen.sleep(0.05)
+            Learner.learn(Learn(prepare=Prepare(id=2, key='b', predicate='set', argument=2)))
+            yield response
+        self.assertEqual([json.loads(line)['prepare']['id'] for line in b''.join(chunks).splitlines()], [1, 2])
+        self.assertEqual(len(chunks), 2)
+
+    def test_refuses_a_compacted_offset(self):
+        Learner.base = 5
+        self.assertEqual(self.fetch('/subscribe?offset=2').code, 410)
+
+
+class TestReplica(Base):
+
+    def get_app(self):
+        return agent.get_app(replica=True)
+
+    def test_only_serves_reads(self):
+        Learner.learn(Learn(prepare=self.get_prepare()))
+        self.assertEqual(json.loads(self.fetch('/get?key=foo').body)['value'], 'a')
+        self.assertEqual(self.fetch('/get?key=foo&linearizable=1').code, 400)
+        self.assertEqual(self.post('/write', {'key': 'foo', 'predicate': 'set', 'argument': 'b'}).code, 404)
+        self.assertEqual(self.post('/prepare', self.get_prepare().to_json()).code, 404)
+
+
+class TestKeyValueState(Base):
+
+    def test_applies_commands_in_log_order(self):
+        state = KeyValueState()
+        commands = [('set', 'a'), ('incr', 2), ('noop', None), ('incr', None),
+                    ('cas', {'expected': 2, 'value': 'b'}), ('cas', {'expected': 3, 'value': 'c'}),
+                    ('frobnicate', 1)]
+        for i, (predicate, argument) in enumerate(commands):
+            state.apply(Learn(prepare=Prepare(id=i, key='n' if i else 'x', predicate=predicate, argument=argument)))
+        self.assertEqual(state.get('x'), ('a', 1))
+        self.assertEqual(state.get('n'), ('c', 3))
+        self.assertEqual(state.get('missing'), (None, 0))
+        self.assertEqual((state.applied, state.rejected, state.unknown), (7, 1, 1))
+
+    def test_expands_batches(self):
+        state = KeyValueState()
+        state.apply(Learn(prepare=Prepare(id=1, key='k', predicate=BATCH, argument=[
+            {'predicate': 'incr', 'argument': 5}, {'predicate': 'delete', 'argument': None},
+            {'predicate': 'incr', 'argument': 1}])))
+        self.assertEqual(state.get('k'), (1, 3))
+
+    def test_get_reads_the_current_value(self):
+        for slot, argument in [(1, 3), (0, 'overwritten')]:  # Applied in slot order, not arrival order.
+            Learner.learn(Learn(prepare=Prepare(id=slot, key='k', predicate='set', argument=argument, slot=slot)))
+        response = self.fetch('/get?key=k')
+        self.assertEqual(json.loads(response.body), {'key': 'k', 'value': 3, 'version': 2})
+        self.assertEqual(self.fetch('/get').code, 400)
+
+
+class TestMembership(Base):
+
+    def setUp(self):
+        super(TestMembership, self).setUp()
+        self.saved = agents.all(), quorums.system.system
+        Membership.reset()
+
+    def tearDown(self):
+        agents.update(self.saved[0])
+        quorums.system.use(self.saved[1])
+        Membership.reset()
+        super(TestMembership, self).tearDown()
+
+    def reconfigure(self, slot, **config):
+        prepare = Prepare(id=slot, key=RECONFIGURE, predicate=RECONFIGURE, argument=config, slot=slot)
+        return self.post('/learn', Learn(prepare=prepare).to_json())
+
+    def test_takes_effect_once_the_window_has_passed(self):
+        members = Membership.members() + [9996]
+        with mock.patch('paxos.membership.PIPELINE_WINDOW', 2):
+            self.reconfigure(0, members=members, phase1=3, phase2=2)
+            self.assertEqual(Membership.pending[0], 3)
+            self.post('/learn', Learn(prepare=Prepare(id=1, key='foo', predicate='set', slot=1)).to_json())
+            self.assertEqual(len(agents.all()), 3)
+            self.post('/learn', Learn(prepare=Prepare(id=2, key='foo', predicate='set', slot=2)).to_json())
+        self.assertEqual(Membership.members(), members)
+        self.assertEqual(quorums.system.phase2(agents.all()).size, 2)
+        self.assertFalse(Membership.voting)  # The test agent isn't a member.
+        self.assertEqual(Learner.state.unknown, 0)
+        self.assertEqual(self.post('/prepare', self.get_prepare().to_json()).code, 503)
+
+    def test_only_one_member_changes_at_a_time(self):
+        response = self.post('/reconfigure', {'members': Membership.members() + [9996, 9995]})
+        self.assertEqual(response.code, 400)
+        response = self.post('/reconfigure', {'members': Membership.members()[:2], 'phase1': 1, 'phase2': 1})
+        self.assertEqual(response.code, 400)  # Those quorums don't intersect.
+        response = self.post('/write', {'key': 'foo', 'predicate': RECONFIGURE, 'argument': {'members': [1]}})
+        self.assertEqual(response.code, 400)
+
+    def test_membership_survives_a_snapshot(self):
+        self.reconfigure(0, members=Membership.members()[:2])
+        snapshot = json.loads(self.fetch('/snapshot').body)
+        agents.update(self.saved[0])
+        Learner.restore(snapshot)
+        self.assertEqual(Membership.members(), [a.port for a in self.saved[0][:2]])
+
 
 class TestLearner(Base):
 
+    def test_skip_fills_the_owners_slots_with_noops(self):
+        for slot in [1, 2, 3]:
+            self.post('/learn', Learn(prepare=Prepare(id=slot, key='foo', predicate='set', slot=slot)).to_json())
+        response = self.post('/skip', Skip(owner=0, owners=3, start=0, stop=7).to_json())
+        self.assertEqual(response.code, 200)
+        self.assertEqual([(l.prepare.slot, l.prepare.predicate) for l in Learner.ordered_rounds],
+                         [(0, NOOP), (1, 'set'), (2, 'set'), (3, 'set')])
+        self.assertIn(6, Learner.out_of_order)
+        self.assertEqual(Learner.state.applied, 4)
+
+    def test_learns_once_a_quorum_has_accepted(self):
+        prepare = self.get_prepare()
+        waiter = Learner.wait_for(prepare)
+        for port in [9998, 9998]:
+            self.assertEqual(self.post('/accepted', Accepted(prepare=prepare, acceptor=port).to_json()).code, 200)
+        self.assertFalse(waiter.done())
+        self.assertEqual(Learner.ordered_rounds, [])
+
+        self.post('/accepted', Accepted(prepare=prepare, acceptor=9997).to_json())
+        self.post('/accepted', Accepted(prepare=prepare, acceptor=9999).to_json())
+        self.assertEqual([l.prepare.id for l in Learner.ordered_rounds], [prepare.id])
+        self.assertEqual(waiter.result().prepare.id, prepare.id)
+        self.assertEqual(Learner.tallies, {})
+
+    def test_learning_a_ballot_stops_counting_lower_ones(self):
+        lower = Prepare(id=1, key='foo', predicate='set', argument='a')
+        higher = Prepare(id=5, key='foo', predicate='set', argument='b')
+        self.post('/accepted', Accepted(prepare=lower, acceptor=9998).to_json())
+        self.post('/accepted', Accepted(prepare=Prepare(id=2, key='bar', predicate='set'), acceptor=9998).to_json())
+        self.assertEqual(self.post('/learn', Learn(prepare=higher).to_json()).code, 200)
+        self.assertEqual(list(Learner.tallies), ['bar'])
+
+    def test_learner_orders_by_slot(self):
+        for slot in [1, 2, 0, 4]:
+            prepare = Prepare(id=10 + slot, key='foo', predicate='set', argument=slot, slot=slot)
+            self.assertEqual(self.post('/learn', Learn(prepare=prepare).to_json()).code, 200)
+        self.assertEqual([l.prepare.slot for l in Learner.ordered_rounds], [0, 1, 2])
+        self.assertEqual(Learner.next_slot, 3)
+        self.assertIn(4, Learner.out_of_order)
+
+    def test_refuses_another_value_for_a_learned_slot(self):
+        learned = Learn(prepare=Prepare(id=3, key='foo', predicate='set', argument='a', slot=0))
+        self.assertEqual(self.post('/learn', learned.to_json()).code, 200)
+        other = Learn(prepare=Prepare(id=8, key=None, predicate=NOOP, slot=0))
+        self.assertEqual(self.post('/learn', other.to_json()).code, 409)
+        self.assertEqual(self.post('/learn', learned.to_json()).code, 200)
+        self.assertEqual([l.prepare.id for l in Learner.ordered_rounds], [3])
+
+    @tornado.testing.gen_test
+    def test_outcome_waits_for_its_own_entry(self):
+        later = Prepare(id=5, key='foo', predicate='set', argument='b', slot=1)
+        Learner.learn(Learn(prepare=later))
+        outcome = Learner.outcome(later, timeout=5)
+        self.assertFalse(outcome.done())
+        Learner.learn(Learn(prepare=Prepare(id=4, key='bar', predicate='set', argument='a', slot=0)))
+        self.assertEqual((yield outcome), 'applied')
+
+        gapped = Prepare(id=7, key='foo', predicate='set', argument='c', slot=3)
+        Learner.learn(Learn(prepare=gapped))
+        with self.assertRaises(tornado.gen.TimeoutError):
+            yield Learner.outcome(gapped, timeout=0.01)
+        self.assertEqual(Learner.applying, {})
+
+    def test_relearning_a_ballot_applies_it_once(self):
+        learn = Learn(prepare=Prepare(id=3, key='n', predicate='incr'))
+        for _ in range(2):
+            self.assertEqual(self.post('/learn', learn.to_json()).code, 200)
+        self.assertEqual(len(Learner.ordered_rounds), 1)
+        self.assertEqual(Learner.learned, 1)
+        self.assertEqual(Learner.state.get('n'), (1, 1))
+
     def test_learner_learns(self):
         learn = Learn(prepare=self.get_prepare())
         response = self.post('/learn', learn.to_json())